@@ -0,0 +1,73 @@
+#!python
+# coding=utf-8
+"""
+    Time window reads from a merged file through netCDF4 and through its
+    column file (see pytools.netcdf.sensors.columns).
+
+        python benchmarks/bench_columns.py --records 100000 1000000 --window 1000 --reads 1000
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import netCDF4
+import numpy as np
+
+from pytools.netcdf.sensors.create import create_timeseries_file
+from pytools.netcdf.sensors.columns import ColumnCache
+
+STATION_URN = "urn:ioos:station:bench:station1"
+SENSOR_URN  = "urn:ioos:sensor:bench:station1:sea_water_temperature"
+
+
+def netcdf_window(path, start, end):
+    nc = netCDF4.Dataset(path)
+    try:
+        times = nc.variables["time"][:]
+        lo, hi = np.searchsorted(times, start), np.searchsorted(times, end, side="right")
+        return times[lo:hi], nc.variables["sea_water_temperature"][lo:hi]
+    finally:
+        nc.close()
+
+
+def cached_window(path, start, end):
+    times, heights, values = ColumnCache.open(path).window(start, end)
+    return times, values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--window",  type=int, default=1000, help="Records per window")
+    parser.add_argument("--reads",   type=int, default=1000, help="Windows read per method")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print "%10s %8s %14s %14s %10s" % ("records", "window", "netcdf ms", "columns ms", "speedup")
+    for records in args.records:
+        directory = tempfile.mkdtemp()
+        try:
+            times = 1262304000 + np.arange(records) * 60.
+            create_timeseries_file(directory, 60.0, -150.0, STATION_URN, SENSOR_URN, {}, {"units": "degC"},
+                                   times=times, verticals=np.zeros(records), values=rng.normal(10, 2, records),
+                                   output_filename="merged.nc", columns=True)
+            path = os.path.join(directory, "merged.nc")
+            starts = times[rng.randint(0, max(1, records - args.window), args.reads)]
+
+            elapsed = []
+            for reader in (netcdf_window, cached_window):
+                started = time.time()
+                for start in starts:
+                    reader(path, start, start + (args.window - 1) * 60.)
+                elapsed.append((time.time() - started) / args.reads * 1000.)
+
+            print "%10d %8d %14.3f %14.3f %10.1f" % (records, args.window, elapsed[0], elapsed[1], elapsed[0] / elapsed[1])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
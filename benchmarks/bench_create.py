@@ -0,0 +1,88 @@
+#!python
+# coding=utf-8
+"""
+    Gridding and dedup in create_timeseries_file on irregular profile data,
+    against the previous void-view unique and bisect implementations.
+
+        python benchmarks/bench_create.py --samples 10000 100000 1000000
+"""
+
+import time
+import bisect
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from pytools.netcdf.sensors.create import create_timeseries_file, unique_samples, scatter_values
+
+STATION_URN = "urn:ioos:station:bench:station1"
+SENSOR_URN  = "urn:ioos:sensor:bench:station1:sea_water_temperature"
+
+
+def irregular_profile(samples, seed=0):
+    # Heights that differ between profiles, and about 5% duplicate samples
+    rng = np.random.RandomState(seed)
+    times     = 1262304000 + rng.randint(0, samples // 8, samples) * 600
+    verticals = rng.choice([0., 1.5, 2., 5., 10., 20.], samples)
+    values    = rng.normal(10, 2, samples)
+    return times, verticals, values
+
+
+def void_unique_samples(times, verticals, values):
+    outer = np.ma.dstack((times, verticals)).reshape(times.size, 2)
+    void_to_unique = np.ascontiguousarray(outer).view(np.dtype((np.void, outer.dtype.itemsize * outer.shape[1])))
+    _, indices = np.unique(void_to_unique, return_index=True)
+    times, verticals, values = times[indices], verticals[indices], values[indices]
+    indices = np.lexsort((verticals, times))
+    return times[indices], verticals[indices], values[indices]
+
+
+def bisect_values(times, verticals, values, unique_times, unique_verticals, fillvalue):
+    used_values = np.ndarray((unique_times.size, unique_verticals.size), dtype=float)
+    used_values.fill(float(fillvalue))
+    for i in xrange(values.size):
+        used_values[bisect.bisect_left(unique_times, times[i]), bisect.bisect_left(unique_verticals, verticals[i])] = values[i]
+    return used_values
+
+
+def timed(f, *args):
+    started = time.time()
+    result = f(*args)
+    return time.time() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--skip-reference", action="store_true", help="Don't time the previous implementation")
+    args = parser.parse_args()
+
+    print "%10s %12s %12s %12s %12s %12s" % ("samples", "dedup", "dedup(old)", "grid", "grid(old)", "create")
+    for samples in args.samples:
+        times, verticals, values = irregular_profile(samples)
+
+        dedup, (ts, zs, vs) = timed(unique_samples, times, verticals, values)
+        unique_times, unique_verticals = np.unique(ts), np.unique(zs)
+        grid, gridded = timed(scatter_values, ts, zs, vs, unique_times, unique_verticals, -9999.9)
+
+        old_dedup = old_grid = float("nan")
+        if not args.skip_reference:
+            old_dedup, old = timed(void_unique_samples, times, verticals, values)
+            assert all(np.array_equal(a, b) for a, b in zip(old, (ts, zs, vs)))
+            old_grid, old_gridded = timed(bisect_values, ts, zs, vs, unique_times, unique_verticals, -9999.9)
+            assert np.array_equal(old_gridded, gridded)
+
+        directory = tempfile.mkdtemp()
+        try:
+            create, _ = timed(create_timeseries_file, directory, 60.0, -150.0, STATION_URN, SENSOR_URN, {}, {},
+                              None, times, verticals, values, -9999.9, "bench.nc")
+        finally:
+            shutil.rmtree(directory)
+
+        print "%10d %12.4f %12.4f %12.4f %12.4f %12.4f" % (samples, dedup, old_dedup, grid, old_grid, create)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!python
+# coding=utf-8
+"""
+    Scaling of merge_timeseries with the number of component files.
+
+        python benchmarks/bench_merge.py --files 10 100 1000 --samples 144
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from pytools.netcdf.sensors.create import create_timeseries_file
+from pytools.netcdf.sensors.merge import merge_timeseries
+
+STATION_URN = "urn:ioos:station:bench:station1"
+SENSOR_URN  = "urn:ioos:sensor:bench:station1:sea_water_temperature"
+
+
+def make_sensor(directory, nfiles, samples):
+    sensor_path = os.path.join(directory, SENSOR_URN)
+    start = 1262304000  # 2010-01-01
+    step  = 86400 // samples
+    for i in range(nfiles):
+        times  = start + i * 86400 + np.arange(samples) * step
+        values = np.random.normal(10, 2, samples)
+        create_timeseries_file(sensor_path, 60.0, -150.0, STATION_URN, SENSOR_URN, {}, {"units": "degC"},
+                               times=times, verticals=np.zeros(samples), values=values,
+                               output_filename="day_%05d.nc" % i)
+    return sensor_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files",   type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--samples", type=int, default=144, help="Samples per file")
+    args = parser.parse_args()
+
+    print "%8s %10s %10s %14s" % ("files", "samples", "seconds", "samples/sec")
+    for nfiles in args.files:
+        directory = tempfile.mkdtemp()
+        try:
+            make_sensor(directory, nfiles, args.samples)
+            started = time.time()
+            merge_timeseries(directory)
+            elapsed = time.time() - started
+            total = nfiles * args.samples
+            print "%8d %10d %10.3f %14.0f" % (nfiles, total, elapsed, total / elapsed)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
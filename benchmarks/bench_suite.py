@@ -0,0 +1,204 @@
+#!python
+# coding=utf-8
+"""
+    Throughput, peak RSS and scaling of the sensor entry points on synthetic
+    trees (see pytools.netcdf.sensors.synthetic).
+
+    For each scale a tree of stations x sensors x (files x scale) files is
+    generated and run through create_timeseries_file, crawl_and_copy,
+    merge_timeseries, create_ncml and clone, in that order.  Each step runs in
+    its own process so its peak RSS is its own.
+
+        python benchmarks/bench_suite.py --scales 1 4 16 --stations 4 --sensors 3 --files 10
+        python benchmarks/bench_suite.py --only merge ncml --processes 4 --json results.json
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import traceback
+import multiprocessing
+
+import netCDF4
+
+from pytools.netcdf.clone import clone
+from pytools.netcdf.sensors.synthetic import generate_tree
+from pytools.netcdf.sensors.crawl import crawl_and_copy
+from pytools.netcdf.sensors.merge import merge_timeseries, merge_timeseries_parallel
+from pytools.netcdf.sensors.ncml import create_ncml
+
+STEPS = ["create", "crawl", "merge", "ncml", "clone"]
+
+MERGED_FILENAME = "merged.nc"
+
+
+def nc_files(directory, name=None):
+    found = []
+    for root, dirs, files in os.walk(directory):
+        for f in sorted(files):
+            if os.path.splitext(f)[-1] == ".nc" and (name is None or f == name):
+                found.append(os.path.join(root, f))
+    return sorted(found)
+
+
+def file_stats(paths):
+    # (files, samples, bytes) of sensor files, samples being the valid data values
+    samples = 0
+    for path in paths:
+        nc = netCDF4.Dataset(path)
+        try:
+            # The data variable is named after the last part of the sensor URN
+            samples += nc.variables[nc.variables["instrument"].long_name.split(":")[-1]][:].count()
+        finally:
+            nc.close()
+    return len(paths), samples, sum(os.path.getsize(p) for p in paths)
+
+
+def _child(queue, workdir, func, args, kwargs):
+    try:
+        # create_ncml writes ncml_files.json into the working directory
+        os.chdir(workdir)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - started
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux
+        queue.put({ 'seconds' : elapsed, 'peak_rss' : peak * 1024, 'rss_growth' : max(0, peak - baseline) * 1024, 'error' : None })
+    except Exception:
+        queue.put({ 'seconds' : None, 'peak_rss' : None, 'rss_growth' : None, 'error' : traceback.format_exc() })
+
+
+def measure(workdir, func, *args, **kwargs):
+    """
+        Run func(*args, **kwargs) in a child process and return its seconds,
+        peak RSS and RSS growth over what it started with (bytes).
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child, args=(queue, workdir, func, args, kwargs))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _clone_all(sources, directory):
+    # clone closes the source Dataset
+    for i, path in enumerate(sources):
+        clone(netCDF4.Dataset(path), os.path.join(directory, "clone_%05d.nc" % i), [], [], [])
+
+
+def run_scale(workdir, scale, args):
+    source = os.path.join(workdir, "source")
+    copied = os.path.join(workdir, "copied")
+    cloned = os.path.join(workdir, "cloned")
+    os.makedirs(copied)
+    os.makedirs(cloned)
+
+    generate = dict(stations=args.stations, sensors_per_station=args.sensors, files_per_sensor=args.files * scale,
+                    samples_per_file=args.samples, profiles=not args.no_profiles, seed=args.seed)
+
+    steps = [s for s in STEPS if args.only is None or s in args.only]
+    results = []
+    for step in STEPS:
+        # Steps that aren't benchmarked still run, the later ones need their output
+        if step == "create":
+            call = (generate_tree, (source,), generate)
+        elif step == "crawl":
+            call = (crawl_and_copy, ([source], {}, {}), dict(perform_copy=True, output_path=copied, processes=args.processes))
+        elif step == "merge":
+            if args.processes is None:
+                call = (merge_timeseries, (copied,), dict(output_filename=MERGED_FILENAME))
+            else:
+                call = (merge_timeseries_parallel, (copied,), dict(output_filename=MERGED_FILENAME, processes=args.processes))
+        elif step == "ncml":
+            call = (create_ncml, (copied,), dict(target_file=MERGED_FILENAME, processes=args.processes))
+        elif step == "clone":
+            call = (_clone_all, (nc_files(copied, MERGED_FILENAME), cloned), {})
+
+        # What the step reads
+        if step == "create":
+            inputs = None
+        elif step == "crawl":
+            inputs = nc_files(source)
+        elif step == "merge":
+            inputs = [p for p in nc_files(copied) if os.path.basename(p) != MERGED_FILENAME]
+        else:
+            inputs = nc_files(copied, MERGED_FILENAME)
+
+        func, fargs, fkwargs = call
+        if step not in steps:
+            func(*fargs, **fkwargs)
+            continue
+
+        measured = measure(workdir, func, *fargs, **fkwargs)
+        if measured['error'] is not None:
+            print measured['error']
+            raise RuntimeError("%s failed at scale %d" % (step, scale))
+
+        files, samples, nbytes = file_stats(nc_files(source) if inputs is None else inputs)
+        seconds = measured['seconds']
+        results.append(dict(measured, step=step, scale=scale, files=files, samples=samples, bytes=nbytes,
+                            files_per_second=files / seconds,
+                            samples_per_second=samples / seconds,
+                            mb_per_second=nbytes / 1048576. / seconds))
+    return results
+
+
+def print_results(results):
+    print "%-8s %6s %7s %10s %9s %10s %12s %9s %9s %9s" % ("step", "scale", "files", "samples", "seconds", "files/s", "samples/s", "MB/s", "peak MB", "grew MB")
+    for r in results:
+        print "%-8s %6d %7d %10d %9.3f %10.1f %12.0f %9.2f %9.1f %9.1f" % (r['step'], r['scale'], r['files'], r['samples'], r['seconds'], r['files_per_second'],
+                                                                             r['samples_per_second'], r['mb_per_second'], r['peak_rss'] / 1048576., r['rss_growth'] / 1048576.)
+
+    # Scaling: time and time per file against the smallest scale, 1.00 is linear
+    print
+    print "%-8s %6s %9s %10s %12s" % ("step", "scale", "seconds", "x time", "x per file")
+    for step in STEPS:
+        rows = sorted((r for r in results if r['step'] == step), key=lambda r: r['scale'])
+        if not rows:
+            continue
+        first = rows[0]
+        for r in rows:
+            per_file = (r['seconds'] / r['files']) / (first['seconds'] / first['files'])
+            print "%-8s %6d %9.3f %10.2f %12.2f" % (step, r['scale'], r['seconds'], r['seconds'] / first['seconds'], per_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales",      type=int, nargs="+", default=[1, 4, 16], help="Multipliers of --files")
+    parser.add_argument("--stations",    type=int, default=4)
+    parser.add_argument("--sensors",     type=int, default=3, help="Sensors per station")
+    parser.add_argument("--files",       type=int, default=10, help="Files per sensor at scale 1")
+    parser.add_argument("--samples",     type=int, default=144, help="Times per file")
+    parser.add_argument("--no-profiles", action="store_true", help="Only timeSeries sensors")
+    parser.add_argument("--only",        nargs="+", choices=STEPS, help="Steps to measure, the others still run")
+    parser.add_argument("--processes",   type=int, help="Worker processes for crawl, merge and ncml")
+    parser.add_argument("--seed",        type=int, default=0)
+    parser.add_argument("--json",        help="Also write the results to this file")
+    parser.add_argument("--keep",        action="store_true", help="Keep the generated trees")
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        workdir = tempfile.mkdtemp(prefix="bench_suite_%d_" % scale)
+        try:
+            results.extend(run_scale(workdir, scale, args))
+        finally:
+            if args.keep:
+                print "Kept %s" % workdir
+            else:
+                shutil.rmtree(workdir)
+
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
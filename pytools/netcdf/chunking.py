@@ -0,0 +1,155 @@
+#!python
+# coding=utf-8
+
+import operator
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+# Roughly what HDF5 and THREDDS are happiest reading in one go
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+
+TIMESERIES = "timeseries"
+SPATIAL    = "spatial"
+POLICIES   = [TIMESERIES, SPATIAL]
+
+# Chunk length along time when no storage policy is given
+DEFAULT_CHUNK_RECORDS = 1000
+
+
+def _size(shape, itemsize):
+    return reduce(operator.mul, shape, itemsize)
+
+
+def chunk_shape(shape, dimensions, itemsize, policy, time_dimension="time", unlimited=None, target_bytes=None):
+    """
+        Compute chunk sizes for a variable of the given shape and dimension names.
+
+        policy "timeseries" puts as many records of time_dimension as fit in
+        target_bytes into each chunk, and only uses the other dimensions to fill
+        whatever is left, so reading a long record at one point touches few chunks.
+
+        policy "spatial" puts a single time step into each chunk and as much of
+        the other dimensions as fit, so reading a map or profile at one time is
+        a single chunk read.  Variables without time_dimension get as much of
+        the whole variable as fits, and 1-D variables such as coordinates are
+        chunked as under "timeseries".
+
+        Chunks never extend past the current length of a dimension, except for
+        empty unlimited dimensions (given by name in unlimited).  Returns None for
+        scalars, which can't be chunked.
+    """
+    if policy not in POLICIES:
+        raise ValueError("Unknown chunking policy '%s', expected one of %s" % (policy, POLICIES))
+    if len(shape) == 0:
+        return None
+
+    target_bytes = target_bytes or DEFAULT_CHUNK_BYTES
+    unlimited    = unlimited or []
+    budget       = max(1, target_bytes // itemsize)
+
+    if time_dimension in dimensions:
+        t = list(dimensions).index(time_dimension)
+    elif policy == TIMESERIES:
+        # Fall back to the slowest varying dimension
+        t = 0
+    else:
+        t = None
+
+    def limit(i, n):
+        n = max(1, int(n))
+        if dimensions[i] in unlimited and shape[i] == 0:
+            return n
+        return max(1, min(n, shape[i]))
+
+    if policy == TIMESERIES or len(shape) == 1:
+        # Coordinates and other 1-D variables are read whole, so chunk them as
+        # long runs under either policy
+        t = t or 0
+        chunks = [1] * len(shape)
+        chunks[t] = limit(t, budget)
+        # Whole record fits, so use what is left on the other dimensions
+        remaining = budget // chunks[t]
+        for i in reversed(range(len(shape))):
+            if i != t and remaining > 1:
+                chunks[i] = limit(i, remaining)
+                remaining //= chunks[i]
+    else:
+        # One time step per chunk, or the whole variable if it has no time
+        chunks = [limit(i, s) for i, s in enumerate(shape)]
+        if t is not None:
+            chunks[t] = 1
+        # Shrink the slowest varying dimensions until the chunk fits
+        for i in range(len(chunks)):
+            if i == t:
+                continue
+            if _size(chunks, itemsize) <= target_bytes:
+                break
+            others = _size(chunks[:i] + chunks[i + 1:], itemsize)
+            chunks[i] = max(1, target_bytes // others)
+
+    return tuple(chunks)
+
+
+def storage_options(storage, shape, dimensions, itemsize, access=None):
+    """
+        createVariable keyword arguments (chunksizes and compression) for a
+        variable of the given shape in a new timeseries file.
+
+        storage is None for the original layout: chunks of 1000 time records and
+        no compression.  Otherwise it is a dictionary with any of
+
+            access      -- "timeseries" (default) for reading long records, or
+                           "spatial" for reading whole profiles at a time
+            chunk_bytes -- target uncompressed chunk size, default
+                           DEFAULT_CHUNK_BYTES
+            zlib        -- compress, default True
+            complevel   -- zlib level, default 4
+            shuffle     -- HDF5 shuffle filter, default True
+            precision   -- pack the data values into int16 to within this step
+                           (see sensors.create.create_values)
+
+        Chunks are sized from the number of records (see chunk_shape), so
+        a short file gets one small chunk and a long one gets chunks of about
+        chunk_bytes.  access overrides the policy's access pattern.
+    """
+    if storage is None:
+        return { 'chunksizes' : (DEFAULT_CHUNK_RECORDS,) + tuple(shape[1:]) }
+
+    access = access or storage.get('access', TIMESERIES)
+    if access not in POLICIES:
+        raise ValueError("Unknown access pattern '%s', expected one of %s" % (access, POLICIES))
+    # A chunk holding a single profile is tiny, so for profile reads keep whole
+    # profiles in a chunk and fill the rest of it with as many times as fit.
+    along = dimensions[0] if access == TIMESERIES else dimensions[-1]
+    return { 'chunksizes' : chunk_shape(shape, dimensions, itemsize, TIMESERIES, time_dimension=along, unlimited=[dimensions[0]], target_bytes=storage.get('chunk_bytes')),
+             'zlib'       : storage.get('zlib', True),
+             'complevel'  : storage.get('complevel', 4),
+             'shuffle'    : storage.get('shuffle', True) }
+
+
+# Packed int16 values use -32767..32767, leaving the smallest value for the fill
+PACKED_FILL = -32768
+PACKED_LEVELS = 65534
+
+
+def pack_parameters(vmin, vmax, precision):
+    """
+        (scale_factor, add_offset) to store values between vmin and vmax as int16
+        to within precision (the step between representable values), or None if
+        that range needs more than 16 bits at that precision.
+    """
+    if precision <= 0:
+        raise ValueError("precision must be positive, got %s" % precision)
+    if (float(vmax) - float(vmin)) / precision > PACKED_LEVELS:
+        return None
+    return float(precision), (float(vmax) + float(vmin)) / 2.
+
+
+def packed_range(scale_factor, add_offset):
+    """
+        Smallest and largest values an int16 variable packed with scale_factor and add_offset can hold.
+    """
+    half = (PACKED_LEVELS // 2) * scale_factor
+    return add_offset - half, add_offset + half
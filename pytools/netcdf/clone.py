@@ -2,92 +2,426 @@
 # coding=utf-8
 
 import os
+import re
+import sys
+import glob
+import time
+import argparse
+import numbers
+import operator
+import itertools
+import traceback
+from datetime import timedelta
+
 import netCDF4
+import numpy as np
+
+from . import metrics
+from .jobs import run_jobs
+from .chunking import chunk_shape, POLICIES
 
 import logging
 logger = logging.getLogger("pytools")
 logger.addHandler(logging.NullHandler())
 
 
-def clone(src, dst_path, skip_globals, skip_dimensions, skip_variables):
+def parse_bytes(size):
     """
-        Mostly ripped from nc3tonc4 in netCDF4-python.
-        Added ability to skip dimension and variables.
-        Removed all of the unpacking logic for shorts.
+        Convert a size such as 268435456, "256MB" or "1.5G" into a number of bytes.
     """
+    if size is None:
+        return None
+    if isinstance(size, (int, long)):
+        return size
+    match = re.match(r"^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$", str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError("Could not parse a size from '%s'" % size)
+    number, unit = match.groups()
+    multiplier = 1024 ** "bkmgt".index(unit.lower() or "b")
+    return int(float(number) * multiplier)
+
+
+def slab_shape(ncvar, max_bytes):
+    """
+        Compute the shape of the hyperslab to read from ncvar at a time.
+        Slabs are made of whole on-disk chunks (or of whole trailing rows for
+        contiguous variables) and grow from the fastest varying dimension outwards
+        until they would exceed max_bytes.
+    """
+    shape = ncvar.shape
+    if len(shape) == 0:
+        return ()
+
+    itemsize = np.dtype(ncvar.dtype).itemsize or 8
+
+    chunking = ncvar.chunking()
+    if chunking == "contiguous" or chunking is None:
+        # Row-major layout, so a single trailing row is the smallest contiguous read
+        chunks = [1] * (len(shape) - 1) + [shape[-1]]
+    else:
+        chunks = list(chunking)
+    slab = [max(1, min(c, s)) for c, s in zip(chunks, shape)]
+
+    # A single chunk may already be over budget.  Shrink the slowest varying dimensions first.
+    for i in range(len(slab)):
+        if reduce(operator.mul, slab, itemsize) <= max_bytes:
+            break
+        others = reduce(operator.mul, slab[:i] + slab[i + 1:], itemsize)
+        slab[i] = max(1, max_bytes // others)
+
+    # Grow by whole chunks, fastest varying dimension first, up to the full extent.
+    for i in reversed(range(len(slab))):
+        others = reduce(operator.mul, slab[:i] + slab[i + 1:], itemsize)
+        nchunks = max(1, max_bytes // (others * slab[i]))
+        slab[i] = max(1, min(shape[i], slab[i] * nchunks))
+        if slab[i] < shape[i]:
+            break
+
+    return tuple(slab)
+
+
+def iter_slabs(shape, slab):
+    """
+        Yield tuples of slices covering an array of the given shape in slabs of the given shape.
+    """
+    if len(shape) == 0:
+        yield ()
+        return
+    ranges = [[slice(start, min(start + step, size)) for start in xrange(0, size, step)] for size, step in zip(shape, slab)]
+    for slices in itertools.product(*ranges):
+        yield slices
+
 
-    if os.path.exists(dst_path):
-        os.unlink(dst_path)
-    dst = netCDF4.Dataset(dst_path, 'w')
+def resolve_subset(src, subset):
+    """
+        Turn a dictionary of {dimension name: selector} into {dimension name: slice}
+        with concrete start and stop indexes.  A selector can be
 
-    # Global attributes
-    for attname in src.ncattrs():
-        if attname not in skip_globals:
-            setattr(dst, attname, getattr(src, attname))
+            * a slice of indexes, e.g. slice(0, 100) or slice(-720, None)
+            * a (lower, upper) tuple of coordinate values, inclusive, where either
+              end may be None and datetimes are converted using the coordinate
+              variable's units and calendar
+            * a timedelta, selecting that much time back from the last coordinate value
 
-    # Dimensions
-    unlimdim     = None
-    unlimdimname = False
-    for dimname, dim in src.dimensions.iteritems():
+        Coordinate value selectors only read the 1-D coordinate variable named
+        after the dimension.  The selected indexes must be contiguous.
+    """
+    selection = {}
+    for dimname, selector in (subset or {}).iteritems():
+        size = len(src.dimensions[dimname])
 
-        # Skip what we need to
-        if dimname in skip_dimensions:
+        if isinstance(selector, slice):
+            start, stop, step = selector.indices(size)
+            if step != 1:
+                raise ValueError("Strided selections are not supported (dimension '%s')" % dimname)
+            selection[dimname] = slice(start, max(start, stop))
             continue
 
-        if dim.isunlimited():
-            unlimdim     = dim
-            unlimdimname = dimname
-            dst.createDimension(dimname, None)
+        if dimname not in src.variables:
+            raise ValueError("Can't select by value along '%s', there is no coordinate variable" % dimname)
+        coord = src.variables[dimname]
+        values = coord[:]
+
+        if isinstance(selector, timedelta):
+            last = netCDF4.num2date(values[-1], coord.units, getattr(coord, "calendar", "standard"))
+            selector = (last - selector, None)
+
+        # Anything that isn't a number is a date (datetime or cftime)
+        lower, upper = selector
+        if lower is not None and not isinstance(lower, numbers.Number):
+            lower = netCDF4.date2num(lower, coord.units, getattr(coord, "calendar", "standard"))
+        if upper is not None and not isinstance(upper, numbers.Number):
+            upper = netCDF4.date2num(upper, coord.units, getattr(coord, "calendar", "standard"))
+
+        matches = np.ones(values.shape, dtype=bool)
+        if lower is not None:
+            matches &= values >= lower
+        if upper is not None:
+            matches &= values <= upper
+        indexes = np.flatnonzero(np.ma.filled(matches, False))
+        if indexes.size == 0:
+            selection[dimname] = slice(0, 0)
         else:
-            dst.createDimension(dimname, len(dim))
+            selection[dimname] = slice(int(indexes[0]), int(indexes[-1]) + 1)
 
-    # Variables
-    for varname, ncvar in src.variables.iteritems():
+    return selection
 
-        # Skip what we need to
-        if varname in skip_variables:
-            continue
 
-        hasunlimdim = False
-        if unlimdimname and unlimdimname in ncvar.dimensions:
-            hasunlimdim = True
+def clone(src, dst_path, skip_globals, skip_dimensions, skip_variables, max_bytes=None, zlib=False, complevel=4, shuffle=True, chunking=None, chunk_bytes=None, subset=None):
+    """
+        Mostly ripped from nc3tonc4 in netCDF4-python.
+        Added ability to skip dimension and variables.
+        Removed all of the unpacking logic for shorts.
 
-        filler = None
-        if hasattr(ncvar, '_FillValue'):
-            filler = ncvar._FillValue
+        If max_bytes is set (an integer or a string like "256MB") every variable
+        is copied in hyperslabs shaped from its on-disk chunking that stay under
+        max_bytes, along all dimensions.  Otherwise only variables along the
+        unlimited dimension are copied in pieces.
 
-        var = dst.createVariable(varname, ncvar.dtype, ncvar.dimensions, fill_value=filler)
+        zlib, complevel and shuffle set the compression of the destination
+        variables.  chunking is None (keep the library's default layout),
+        "timeseries" or "spatial"; see chunking.chunk_shape.  chunk_bytes is the
+        target size of each chunk.
 
-        # Attributes
-        for attname in ncvar.ncattrs():
-            if attname == '_FillValue':
+        subset is a dictionary of {dimension name: selector} (see resolve_subset).
+        Only the selected hyperslab is read from src and written to dst_path.
+
+        src and the new file are closed when clone returns or raises.
+    """
+
+    dst = None
+    try:
+        max_bytes   = parse_bytes(max_bytes)
+        chunk_bytes = parse_bytes(chunk_bytes)
+        selection   = resolve_subset(src, subset)
+
+        if os.path.exists(dst_path):
+            os.unlink(dst_path)
+        dst = netCDF4.Dataset(dst_path, 'w')
+
+        # Global attributes
+        for attname in src.ncattrs():
+            if attname not in skip_globals:
+                setattr(dst, attname, getattr(src, attname))
+
+        # Dimensions
+        unlimdimname = False
+        for dimname, dim in src.dimensions.iteritems():
+
+            # Skip what we need to
+            if dimname in skip_dimensions:
                 continue
+
+            if dim.isunlimited():
+                unlimdimname = dimname
+                dst.createDimension(dimname, None)
+            elif dimname in selection:
+                dst.createDimension(dimname, selection[dimname].stop - selection[dimname].start)
             else:
-                setattr(var, attname, getattr(ncvar, attname))
-
-        # Data
-        nchunk = 1000
-        if hasunlimdim:
-            if nchunk:
-                start = 0
-                stop = len(unlimdim)
-                step = nchunk
-                if step < 1:
-                    step = 1
-                for n in range(start, stop, step):
-                    nmax = n + nchunk
-                    if nmax > len(unlimdim):
-                        nmax = len(unlimdim)
-                    idata = ncvar[n:nmax]
-                    var[n:nmax] = idata
-            else:
-                idata = ncvar[:]
-                var[0:len(unlimdim)] = idata
+                dst.createDimension(dimname, len(dim))
+
+        # Variables
+        for varname, ncvar in src.variables.iteritems():
+
+            # Skip what we need to
+            if varname in skip_variables:
+                continue
+
+            hasunlimdim = False
+            if unlimdimname and unlimdimname in ncvar.dimensions:
+                hasunlimdim = True
+
+            # The part of ncvar we are copying
+            window = tuple(selection.get(d, slice(0, s)) for d, s in zip(ncvar.dimensions, ncvar.shape))
+            shape  = tuple(w.stop - w.start for w in window)
+
+            filler = None
+            if hasattr(ncvar, '_FillValue'):
+                filler = ncvar._FillValue
+
+            layout = {}
+            # Variable length types can't be compressed or chunked by us
+            if ncvar.ndim > 0 and isinstance(ncvar.dtype, np.dtype):
+                if zlib:
+                    layout['zlib']      = True
+                    layout['complevel'] = complevel
+                    layout['shuffle']   = shuffle
+                if chunking is not None:
+                    layout['chunksizes'] = chunk_shape(shape,
+                                                       ncvar.dimensions,
+                                                       ncvar.dtype.itemsize,
+                                                       chunking,
+                                                       time_dimension="time" if "time" in ncvar.dimensions else unlimdimname,
+                                                       unlimited=[unlimdimname] if unlimdimname else None,
+                                                       target_bytes=chunk_bytes)
+
+            var = dst.createVariable(varname, ncvar.dtype, ncvar.dimensions, fill_value=filler, **layout)
+
+            # Attributes
+            for attname in ncvar.ncattrs():
+                if attname == '_FillValue':
+                    continue
+                else:
+                    setattr(var, attname, getattr(ncvar, attname))
+
+            # Data
+            nchunk = 1000
+            with metrics.stage("clone.variable", file=dst_path, variable=varname) as stage:
+                if ncvar.ndim == 0:
+                    var[:] = ncvar[:]
+                elif 0 not in shape:
+                    if max_bytes is not None:
+                        slab = slab_shape(ncvar, max_bytes)
+                    elif hasunlimdim:
+                        # Pieces of nchunk records along the unlimited dimension
+                        slab = list(shape)
+                        slab[ncvar.dimensions.index(unlimdimname)] = nchunk
+                    else:
+                        slab = shape
+                    for slices in iter_slabs(shape, slab):
+                        data = ncvar[tuple(slice(s.start + w.start, s.stop + w.start) for s, w in zip(slices, window))]
+                        var[slices] = data
+                        stage.add(slabs=1, bytes_read=metrics.nbytes(data))
+
+                dst.sync()
+    finally:
+        # Close both files whether the copy worked or not
+        src.close()
+        if dst is not None:
+            dst.close()
+
+
+def _clone_path(args):
+    """
+        Worker for clone_many.  Opens src_path and clones it, never raising so a
+        single bad file can't take down the pool.
+    """
+    src_path, dst_path, skip_globals, skip_dimensions, skip_variables, options = args
+
+    result = { 'src'     : src_path,
+               'dst'     : dst_path,
+               'bytes'   : 0,
+               'seconds' : 0.,
+               'error'   : None }
+    started = time.time()
+    try:
+        result['bytes'] = os.path.getsize(src_path)
+        dst_directory = os.path.dirname(dst_path)
+        if dst_directory and not os.path.exists(dst_directory):
+            try:
+                os.makedirs(dst_directory)
+            except OSError:
+                # Another worker beat us to it
+                if not os.path.isdir(dst_directory):
+                    raise
+        with metrics.stage("clone", read=src_path, written=dst_path, file=src_path):
+            clone(netCDF4.Dataset(src_path), dst_path, skip_globals, skip_dimensions, skip_variables, **options)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - started
+    return result
+
+
+def glob_pairs(patterns, output_directory):
+    """
+        Expand one or more glob patterns into (src, dst) pairs, placing each
+        destination file in output_directory under the source file's name.
+        Raises ValueError if two different sources have the same name.
+    """
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    pairs   = []
+    sources = {}
+    for pattern in patterns:
+        for src_path in sorted(glob.glob(pattern)):
+            dst_path = os.path.join(output_directory, os.path.basename(src_path))
+            if dst_path in sources:
+                if os.path.realpath(sources[dst_path]) == os.path.realpath(src_path):
+                    # Matched by more than one pattern
+                    continue
+                raise ValueError("'%s' and '%s' would both be cloned to '%s'" % (sources[dst_path], src_path, dst_path))
+            sources[dst_path] = src_path
+            pairs.append((src_path, dst_path))
+    return pairs
+
+
+def clone_many(pairs, skip_globals=None, skip_dimensions=None, skip_variables=None, processes=None, timeout=None, **options):
+    """
+        Clone many (src_path, dst_path) pairs, each in its own worker process.
+        Any other keyword arguments (max_bytes, zlib, chunking, ...) are passed to clone.
+
+        A failing file, a worker that dies and a clone that runs for more than
+        timeout seconds are logged and reported but do not stop the batch.  A
+        pair given more than once is cloned once.  Raises ValueError if two
+        different sources have the same destination.  Returns a list of result
+        dictionaries (src, dst, bytes, seconds, error), in the same order as pairs.
+    """
+    skip_globals    = skip_globals or []
+    skip_dimensions = skip_dimensions or []
+    skip_variables  = skip_variables or []
+
+    # Workers writing the same destination would overwrite each other
+    destinations = {}
+    jobs = []
+    for src_path, dst_path in pairs:
+        key = os.path.abspath(dst_path)
+        if key in destinations:
+            if os.path.abspath(destinations[key]) != os.path.abspath(src_path):
+                raise ValueError("'%s' and '%s' would both be cloned to '%s'" % (destinations[key], src_path, dst_path))
+            continue
+        destinations[key] = src_path
+        jobs.append((key, (src_path, dst_path, skip_globals, skip_dimensions, skip_variables, options), 1))
+
+    results = {}
+    for key, result, error in run_jobs(_clone_path, jobs, processes=processes, timeout=timeout):
+        if result is None:
+            # The worker died or was killed before it could report
+            result = { 'src'     : destinations[key],
+                       'dst'     : key,
+                       'bytes'   : 0,
+                       'seconds' : 0.,
+                       'error'   : error }
+        results[key] = result
+        if result['error'] is not None:
+            logger.error("Failed to clone '%s' to '%s':\n%s" % (result['src'], result['dst'], result['error']))
         else:
-            idata = ncvar[:]
-            var[:] = idata
+            rate = result['bytes'] / (1024. * 1024.) / max(result['seconds'], 1e-6)
+            logger.info("Cloned '%s' to '%s' in %.2fs (%.1f MB/s)" % (result['src'], result['dst'], result['seconds'], rate))
+
+    return [dict(results[os.path.abspath(dst_path)], src=src_path, dst=dst_path) for src_path, dst_path in pairs]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Clone NetCDF files in parallel, optionally skipping globals, dimensions and variables.")
+    parser.add_argument("sources",              nargs="+", help="Source files or glob patterns")
+    parser.add_argument("-o", "--output",       required=True, help="Directory to write the cloned files into")
+    parser.add_argument("-g", "--skip-global",  action="append", default=[], help="Global attribute to skip (repeatable)")
+    parser.add_argument("-d", "--skip-dimension", action="append", default=[], help="Dimension to skip (repeatable)")
+    parser.add_argument("-v", "--skip-variable", action="append", default=[], help="Variable to skip (repeatable)")
+    parser.add_argument("-m", "--max-bytes",    default=None, help="Memory budget per variable read, e.g. 256MB")
+    parser.add_argument("-z", "--zlib",         action="store_true", help="Compress the destination variables")
+    parser.add_argument("--complevel",          type=int, default=4, help="zlib compression level (1-9)")
+    parser.add_argument("--no-shuffle",         action="store_true", help="Disable the HDF5 shuffle filter when compressing")
+    parser.add_argument("-c", "--chunking",     choices=POLICIES, default=None, help="Chunk layout to optimize for")
+    parser.add_argument("--chunk-bytes",        default=None, help="Target chunk size, e.g. 1MB")
+    parser.add_argument("-s", "--subset",       action="append", default=[], help="Index range to keep along a dimension, e.g. time=-720: (repeatable)")
+    parser.add_argument("-p", "--processes",    type=int, default=None, help="Number of worker processes (defaults to the CPU count)")
+    parser.add_argument("-t", "--timeout",      type=float, default=None, help="Seconds before a clone is killed and reported as failed")
+    parser.add_argument("--verbose",            action="store_true", help="Log every file")
+    parser.add_argument("--metrics",            default=None, help="Append stage timing records (JSON lines) to this file")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    if args.metrics is not None:
+        metrics.enable(args.metrics)
+
+    subset = {}
+    for selector in args.subset:
+        dimname, _, indexes = selector.partition("=")
+        start, _, stop = indexes.partition(":")
+        subset[dimname] = slice(int(start) if start else None, int(stop) if stop else None)
+
+    try:
+        pairs = glob_pairs(args.sources, args.output)
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    if not pairs:
+        logger.error("No files matched %s" % args.sources)
+        return 1
+
+    started = time.time()
+    results = clone_many(pairs, skip_globals=args.skip_global, skip_dimensions=args.skip_dimension, skip_variables=args.skip_variable, processes=args.processes, timeout=args.timeout, max_bytes=args.max_bytes, zlib=args.zlib, complevel=args.complevel, shuffle=not args.no_shuffle, chunking=args.chunking, chunk_bytes=args.chunk_bytes, subset=subset)
+    elapsed = time.time() - started
+
+    failed = [r for r in results if r['error'] is not None]
+    total  = sum(r['bytes'] for r in results if r['error'] is None)
+    sys.stdout.write("Cloned %d of %d files (%.1f MB) in %.2fs, %.1f MB/s\n" % (len(results) - len(failed), len(results), total / (1024. * 1024.), elapsed, total / (1024. * 1024.) / max(elapsed, 1e-6)))
+    for r in failed:
+        sys.stdout.write("FAILED: %s\n" % r['src'])
+
+    return 1 if failed else 0
 
-        dst.sync()
 
-    src.close()
-    dst.close()
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!python
+# coding=utf-8
+"""
+    Run jobs in child processes, one process per job, and notice when one dies
+    or hangs.
+
+    multiprocessing.Pool loses a task whose worker dies (a segfault in HDF5 on a
+    corrupt file, the OOM killer) and waits for it forever, and it can't stop a
+    single task that hangs.  Here every job gets its own forked process, so the
+    parent knows which job a dead process was running, a timeout is counted from
+    when the job really started and a job that runs over it is killed.
+"""
+
+import time
+import traceback
+import multiprocessing
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+# Seconds between checks on the running jobs when none of them finished
+POLL_SECONDS = 0.05
+
+
+def _child(conn, func, args):
+    try:
+        outcome = (func(args), None)
+    except Exception:
+        outcome = (None, traceback.format_exc())
+    conn.send(outcome)
+    conn.close()
+
+
+def run_jobs(func, jobs, processes=None, timeout=None, capacity=None):
+    """
+        Run func(args) for every (key, args, weight) in jobs, at most processes
+        at a time (the CPU count by default), and yield (key, result, error) as
+        they finish.  result is what func returned, or None if error is set: the
+        traceback of an exception, or a message if the process died or ran for
+        more than timeout seconds and was killed.
+
+        Jobs start in the order given.  If capacity is set, a job only starts
+        while the weights of the running jobs plus its own stay under it, and
+        later jobs that fit may start first; a job too big to fit at all runs
+        alone.  Closing the generator early kills the running jobs.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    pending = list(jobs)
+    # key -> (process, connection, start time, weight)
+    running = {}
+    used    = 0
+
+    try:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= processes:
+                    break
+                key, args, weight = job
+                if running and capacity is not None and used + weight > capacity:
+                    continue
+                pending.remove(job)
+                receive, send = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=_child, args=(send, func, args))
+                process.daemon = True
+                process.start()
+                send.close()
+                running[key] = (process, receive, time.time(), weight)
+                used += weight
+
+            finished = []
+            for key, (process, receive, start, weight) in running.items():
+                # A process may send and exit between the two checks, so look
+                # at the pipe again once it is gone
+                if receive.poll() or not process.is_alive():
+                    try:
+                        result, error = receive.recv()
+                    except EOFError:
+                        # Closed without sending, the process died
+                        process.join()
+                        result, error = None, "Worker process %d died with exit code %s" % (process.pid, process.exitcode)
+                    process.join()
+                elif timeout is not None and time.time() - start > timeout:
+                    process.terminate()
+                    process.join()
+                    result, error = None, "Killed after running for more than %ss" % timeout
+                else:
+                    continue
+                receive.close()
+                del running[key]
+                used -= weight
+                finished.append((key, result, error))
+
+            if not finished:
+                time.sleep(POLL_SECONDS)
+            for outcome in finished:
+                yield outcome
+    finally:
+        for process, receive, start, weight in running.itervalues():
+            process.terminate()
+            process.join()
+            receive.close()
@@ -0,0 +1,268 @@
+#!python
+# coding=utf-8
+"""
+    Stage timing and memory records for the netcdf tools.
+
+    Disabled by default.  Once enabled, with enable(path) or by setting the
+    PYTOOLS_METRICS environment variable to a path before pytools is imported,
+    every stage wrapped in
+
+        with metrics.stage("merge.read", sensor=sensor_urn, read=filepath) as s:
+            ...
+            s.add(samples=values.size)
+
+    appends one JSON line to the file when it ends:
+
+        stage, parent, start, seconds, pid, peak_rss, rss_growth, error,
+        read_file_size / written_file_size (sizes on disk of the files the
+        stage reads and writes, not how much of them it touched), and any
+        fields and counts given to the stage.
+
+    Stages that read arrays count their in memory size with
+    s.add(bytes_read=nbytes(...)), which is what was actually read.
+
+    On Linux peak_rss is the peak resident memory of the process during the
+    stage and rss_growth how far that peak rose above the resident memory at
+    its start, both in bytes.  Each stage resets the kernel's high water mark
+    (VmHWM) by writing 5 to /proc/self/clear_refs, after folding the mark so
+    far into the stages that are still open, so nested stages keep theirs.
+    Where that can't be done the fields are process_peak_rss and
+    process_rss_growth instead: the peak of the whole process so far, from
+    ru_maxrss, and how much it rose during the stage.
+
+    parent is the innermost stage open in the same thread, or the one given
+    to stage() for work a thread does on behalf of another.  Worker processes
+    forked after enable() write to the same file.  While disabled, stage()
+    returns a shared object whose methods do nothing.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+_lock  = threading.Lock()
+_local = threading.local()
+_sink  = None
+# Stages open in any thread, whose peaks a reset of the high water mark must keep
+_open  = []
+
+CLEAR_REFS = "/proc/self/clear_refs"
+STATUS     = "/proc/self/status"
+
+# ru_maxrss is in bytes on OS X and kilobytes elsewhere
+RSS_UNITS = 1 if sys.platform == "darwin" else 1024
+
+
+def enable(path):
+    """
+        Start appending stage records to path.
+    """
+    global _sink
+    disable()
+    _sink = open(path, "a")
+
+
+def disable():
+    global _sink
+    if _sink is not None:
+        _sink.close()
+        _sink = None
+
+
+def enabled():
+    return _sink is not None
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNITS
+
+
+def _status():
+    """
+        (VmRSS, VmHWM) of this process in bytes, or None if /proc can't be read.
+    """
+    values = {}
+    try:
+        with open(STATUS) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        return None
+    if len(values) != 2:
+        return None
+    return values['VmRSS'], values['VmHWM']
+
+
+def _reset_peak():
+    """
+        Reset VmHWM to the current resident memory.  Returns False if it can't be.
+    """
+    try:
+        with open(CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def nbytes(*arrays):
+    """
+        Total size in memory of arrays, for the bytes_read of a stage.
+    """
+    return sum(getattr(a, "nbytes", 0) for a in arrays)
+
+
+def record(name, **fields):
+    """
+        Write one record straight away, for values that aren't tied to a stage.
+    """
+    if _sink is None:
+        return
+    fields['stage'] = name
+    fields.setdefault('pid', os.getpid())
+    fields.setdefault('start', time.time())
+    line = json.dumps(fields, sort_keys=True, default=str) + "\n"
+    with _lock:
+        # One write and a flush per record, so forked workers never inherit
+        # a half filled buffer and lines from several processes don't mix
+        _sink.write(line)
+        _sink.flush()
+
+
+class _Stage(object):
+
+    def __init__(self, name, read, written, parent, fields):
+        self.name    = name
+        self.read    = read
+        self.written = written
+        self.parent  = parent
+        self.fields  = fields
+        self.counts  = {}
+
+    def add(self, **counts):
+        """
+            Add to the stage's counts (samples, records, ...).
+        """
+        for key, value in counts.iteritems():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def set(self, read=None, written=None, **fields):
+        """
+            Set fields of the record, and the read or written file if they were
+            only known once the stage started.
+        """
+        if read is not None:
+            self.read = read
+        if written is not None:
+            self.written = written
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        if self.parent is None and stack:
+            self.parent = stack[-1]
+        stack.append(self)
+        with _lock:
+            status = _status()
+            if status is not None:
+                # Keep the open stages' peaks before resetting the mark
+                for other in _open:
+                    other.peak = max(other.peak, status[1])
+                if not _reset_peak():
+                    status = None
+            if status is None:
+                self.rss  = peak_rss()
+                self.peak = None
+            else:
+                self.rss  = self.peak = status[0]
+                _open.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.time() - self.start
+        _local.stack.pop()
+        fields = dict(self.fields)
+        fields.update(self.counts)
+        with _lock:
+            status = _status() if self.peak is not None else None
+            if status is None:
+                rss = peak_rss()
+                fields.update(process_peak_rss=rss, process_rss_growth=rss - self.rss)
+            else:
+                peak = max(self.peak, status[1])
+                fields.update(peak_rss=peak, rss_growth=peak - self.rss)
+            if self in _open:
+                _open.remove(self)
+        fields.update(parent=getattr(self.parent, "name", None), start=self.start, seconds=seconds,
+                      error=None if exc_type is None else exc_type.__name__)
+        if self.read is not None:
+            fields['read_file_size'] = _size(self.read)
+        if self.written is not None:
+            fields['written_file_size'] = _size(self.written)
+        record(self.name, **fields)
+        return False
+
+
+class _NullStage(object):
+
+    def add(self, **counts):
+        pass
+
+    def set(self, read=None, written=None, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def stage(name, read=None, written=None, parent=None, **fields):
+    """
+        Context manager timing a stage.  read and written are paths of files the
+        stage reads and writes; their sizes on disk are recorded when it ends.  fields
+        are recorded as they are, and add() sums counts into the record.
+
+        parent is the stage (from current()) this one belongs to when it runs
+        in another thread than its parent; by default it is the innermost stage
+        open in this thread.
+    """
+    if _sink is None:
+        return _null_stage
+    if parent is _null_stage:
+        parent = None
+    return _Stage(name, read, written, parent, fields)
+
+
+def current():
+    """
+        The innermost stage running in this thread, so a function can add to the
+        record of the stage its caller opened.
+    """
+    stack = getattr(_local, "stack", None)
+    if _sink is None or not stack:
+        return _null_stage
+    return stack[-1]
+
+
+if os.environ.get("PYTOOLS_METRICS"):
+    enable(os.environ["PYTOOLS_METRICS"])
@@ -0,0 +1,223 @@
+#!python
+# coding=utf-8
+
+import numpy as np
+
+from ..chunking import storage_options
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+STATISTICS = ["mean", "min", "max", "count"]
+
+# Data variable attribute listing the aggregate steps (seconds) a file has
+STEPS_ATTRIBUTE = "aggregate_steps"
+
+
+def step_seconds(step):
+    """
+        Seconds in a step given as a number of seconds or a timedelta.
+    """
+    if hasattr(step, "total_seconds"):
+        return float(step.total_seconds())
+    return float(step)
+
+
+def step_label(step):
+    """
+        ISO8601 duration of a step in seconds, used to name its variables (PT1H, P1D, ...).
+    """
+    step = int(round(step))
+    if step % 86400 == 0:
+        return "P%dD" % (step // 86400)
+    if step % 3600 == 0:
+        return "PT%dH" % (step // 3600)
+    if step % 60 == 0:
+        return "PT%dM" % (step // 60)
+    return "PT%dS" % step
+
+
+def reduce_bins(times, values, step):
+    """
+        Sum, count, min and max of the valid values in each step long bin of the
+        sorted times.  Bins start at multiples of step since the epoch, so daily
+        bins start at midnight UTC.  values has the times along its first axis and
+        may be masked.  Returns (bin starts, total, count, low, high) with one row
+        per bin that has at least one time; low and high are +inf and -inf in
+        bins without a valid value.
+    """
+    bins   = np.floor(times / step) * step
+    starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+    valid  = ~np.ma.getmaskarray(values)
+    data   = np.ma.getdata(values).astype(np.float64)
+    count  = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    total  = np.add.reduceat(np.where(valid, data, 0.), starts, axis=0)
+    low    = np.minimum.reduceat(np.where(valid, data, np.inf), starts, axis=0)
+    high   = np.maximum.reduceat(np.where(valid, data, -np.inf), starts, axis=0)
+    return bins[starts], total, count, low, high
+
+
+class Pyramid(object):
+    """
+        Downsampled mean, min, max and count of a data variable at coarser time
+        steps, stored next to it so coarse views can be read without the raw
+        samples.
+
+        For each step, e.g. 3600, the file gets a "time_PT1H" dimension and
+        coordinate (the bin starts, with "time_PT1H_bounds"), and variables
+        "<variable>_mean_PT1H", "<variable>_min_PT1H", "<variable>_max_PT1H" and
+        "<variable>_count_PT1H" on it (and on z for profiles).
+
+        Samples are added in time order with add(), in as many blocks as needed.
+        The last bin of each step is held back until close(), or until a block
+        moves past it, so a bin split over blocks comes out the same.  Without
+        steps the pyramid already in the file is reopened and its last bins are
+        picked up again, so appended samples update it in place.
+
+        span, the (first, last) time that will be added, sizes the chunks.
+    """
+
+    def __init__(self, nc, variable_name, steps=None, fillvalue=-9999.9, storage=None, span=None):
+        self.nc        = nc
+        self.var       = nc.variables[variable_name]
+        self.fillvalue = fillvalue
+        self.levels    = []
+
+        if steps is None:
+            if STEPS_ATTRIBUTE in self.var.ncattrs():
+                for step in np.atleast_1d(self.var.getncattr(STEPS_ATTRIBUTE)):
+                    self.levels.append(self._open(variable_name, float(step)))
+            return
+
+        steps = sorted(set(step_seconds(s) for s in steps))
+        if not steps:
+            return
+        if "nv" not in nc.dimensions:
+            nc.createDimension("nv", 2)
+        for step in steps:
+            self.levels.append(self._create(variable_name, step, storage, span))
+        self.var.setncattr(STEPS_ATTRIBUTE, np.asarray(steps, dtype=np.float64))
+
+    def _names(self, variable_name, step):
+        label = step_label(step)
+        return "time_%s" % label, dict((s, "%s_%s_%s" % (variable_name, s, label)) for s in STATISTICS)
+
+    def _create(self, variable_name, step, storage, span):
+        time_name, names = self._names(variable_name, step)
+        tail = self.var.dimensions[1:]
+        tail_shape = self.var.shape[1:]
+        # Number of bins over the (first, last) time span, for sizing chunks
+        nbins = 0
+        if span is not None:
+            nbins = int(span[1] // step - span[0] // step) + 1
+
+        self.nc.createDimension(time_name)
+        time = self.nc.createVariable(time_name, "f8", (time_name,), **storage_options(storage, (nbins,), (time_name,), 8))
+        time.units          = "seconds since 1970-01-01T00:00:00Z"
+        time.standard_name  = "time"
+        time.long_name      = "start of the %s aggregation period" % step_label(step)
+        time.calendar       = "gregorian"
+        time.bounds         = "%s_bounds" % time_name
+        bounds = self.nc.createVariable("%s_bounds" % time_name, "f8", (time_name, "nv"), **storage_options(storage, (nbins, 2), (time_name, "nv"), 8))
+
+        dimensions  = (time_name,) + tail
+        shape       = (nbins,) + tail_shape
+        coordinates = " ".join([time_name] + self.var.coordinates.split()[1:]) if "coordinates" in self.var.ncattrs() else time_name
+        variables = {}
+        for statistic, name in names.iteritems():
+            if statistic == "count":
+                v = self.nc.createVariable(name, "i4", dimensions, **storage_options(storage, shape, dimensions, 4))
+                v.long_name = "number of valid samples of %s" % self.var.name
+            else:
+                v = self.nc.createVariable(name, "f4", dimensions, fill_value=self.fillvalue, **storage_options(storage, shape, dimensions, 4))
+                v.long_name    = "%s of %s" % (statistic, self.var.name)
+                v.cell_methods = "%s: %s (interval: %d seconds)" % (time_name, "minimum" if statistic == "min" else "maximum" if statistic == "max" else statistic, step)
+                if "units" in self.var.ncattrs():
+                    v.units = self.var.units
+            v.coordinates = coordinates
+            variables[statistic] = v
+
+        return { 'step'      : step,
+                 'time'      : time,
+                 'bounds'    : bounds,
+                 'variables' : variables,
+                 'position'  : 0,
+                 'pending'   : None }
+
+    def _open(self, variable_name, step):
+        time_name, names = self._names(variable_name, step)
+        level = { 'step'      : step,
+                  'time'      : self.nc.variables[time_name],
+                  'bounds'    : self.nc.variables["%s_bounds" % time_name],
+                  'variables' : dict((s, self.nc.variables[n]) for s, n in names.iteritems()),
+                  'position'  : 0,
+                  'pending'   : None }
+
+        n = level['time'].size
+        if n > 0:
+            # Take the last bin back, it may still get more samples
+            v = level['variables']
+            count = np.asarray(v['count'][n - 1:n], dtype=np.int64)
+            level['pending'] = (np.asarray(level['time'][n - 1:n], dtype=np.float64),
+                                np.ma.filled(v['mean'][n - 1:n], 0.).astype(np.float64) * count,
+                                count,
+                                np.ma.filled(v['min'][n - 1:n], np.inf).astype(np.float64),
+                                np.ma.filled(v['max'][n - 1:n], -np.inf).astype(np.float64))
+            level['position'] = n - 1
+        return level
+
+    def add(self, times, values):
+        """
+            Add samples: sorted times after every time added before, and their values
+            laid out like the data variable (times along the first axis).
+        """
+        if not self.levels or np.size(times) == 0:
+            return
+        times  = np.ma.getdata(times).astype(np.float64)
+        values = np.ma.masked_values(np.ma.reshape(values, (times.size,) + self.var.shape[1:]), self.fillvalue)
+
+        for level in self.levels:
+            reduced = reduce_bins(times, values, level['step'])
+            pending = level['pending']
+            if pending is not None:
+                if reduced[0][0] < pending[0][0]:
+                    raise ValueError("Samples must be added in time order")
+                if reduced[0][0] == pending[0][0]:
+                    # Same bin, fold the held back one into the first
+                    b, total, count, low, high = [np.array(r) for r in reduced]
+                    total[0] += pending[1][0]
+                    count[0] += pending[2][0]
+                    low[0]    = np.minimum(low[0], pending[3][0])
+                    high[0]   = np.maximum(high[0], pending[4][0])
+                    reduced   = (b, total, count, low, high)
+                else:
+                    reduced = tuple(np.concatenate([p, r]) for p, r in zip(pending, reduced))
+
+            self._write(level, tuple(r[:-1] for r in reduced))
+            level['pending'] = tuple(r[-1:] for r in reduced)
+
+    def close(self):
+        """
+            Write the bins still held back.
+        """
+        for level in self.levels:
+            if level['pending'] is not None:
+                self._write(level, level['pending'])
+                level['pending'] = None
+
+    def _write(self, level, reduced):
+        bins, total, count, low, high = reduced
+        n = bins.size
+        if n == 0:
+            return
+        empty = count == 0
+        i = level['position']
+        v = level['variables']
+        level['time'][i:i + n]   = bins
+        level['bounds'][i:i + n] = np.column_stack([bins, bins + level['step']])
+        v['mean'][i:i + n]  = np.ma.masked_where(empty, total / np.maximum(count, 1))
+        v['min'][i:i + n]   = np.ma.masked_where(empty, low)
+        v['max'][i:i + n]   = np.ma.masked_where(empty, high)
+        v['count'][i:i + n] = count
+        level['position'] = i + n
@@ -0,0 +1,198 @@
+#!python
+# coding=utf-8
+
+import os
+import json
+import struct
+
+import netCDF4
+import numpy as np
+
+from .. import metrics
+from .query import _seconds
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+# Column files are "<file>.columns" next to the NetCDF file they mirror
+SUFFIX    = ".columns"
+MAGIC     = "PYTCOLS1"
+ALIGNMENT = 64
+
+
+def column_path(filepath):
+    return filepath + SUFFIX
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _layout(header, shapes, dtypes):
+    """
+        Place the columns in header after it, each on an ALIGNMENT boundary.
+        The header's length depends on the offsets written into it, so this
+        repeats until it fits in front of the first column.  Returns (header
+        text, total file size).
+    """
+    start = 0
+    while True:
+        offset = start
+        for name in ("time", "height", "values"):
+            header['columns'][name] = { 'dtype'  : dtypes[name],
+                                        'shape'  : list(shapes[name]),
+                                        'offset' : offset }
+            offset = _aligned(offset + int(np.prod(shapes[name])) * np.dtype(dtypes[name]).itemsize)
+        text = json.dumps(header)
+        needed = _aligned(len(MAGIC) + 8 + len(text))
+        if needed <= start:
+            return text, offset
+        start = needed
+
+
+def _write_columns(nc, filepath, variable_name, path, rows):
+    time   = nc.variables["time"]
+    height = nc.variables["height"]
+    var    = nc.variables[variable_name]
+    packed = "scale_factor" in var.ncattrs()
+
+    shapes = { 'time'   : (time.size,),
+               'height' : (height.size,),
+               'values' : var.shape }
+    dtypes = { 'time'   : "<f8",
+               'height' : "<f8",
+               'values' : "<f4" if var.dtype == np.float32 and not packed else "<f8" }
+
+    st = os.stat(filepath)
+    header = { 'variable' : variable_name,
+               'units'    : getattr(var, "units", None),
+               'source'   : { 'size' : st.st_size, 'mtime' : st.st_mtime },
+               'columns'  : {} }
+    text, size = _layout(header, shapes, dtypes)
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(text)))
+        f.write(text)
+        f.truncate(size)
+
+    # The mapping is released when the arrays go out of scope
+    mapped  = np.memmap(path, dtype=np.uint8, mode="r+")
+    columns = dict((name, np.ndarray(shapes[name], dtype=dtypes[name], buffer=mapped, offset=header['columns'][name]['offset'])) for name in shapes)
+    columns['height'][:] = np.ma.filled(np.ma.atleast_1d(height[:]).astype(np.float64), np.nan)
+    for i in xrange(0, time.size, rows):
+        columns['time'][i:i + rows]   = time[i:i + rows]
+        columns['values'][i:i + rows] = np.ma.filled(np.ma.asarray(var[i:i + rows]).astype(dtypes['values']), np.nan)
+    mapped.flush()
+    return time.size
+
+
+def write_columns(filepath, variable_name=None, rows=100000):
+    """
+        Write the time, height and values of a sensor file (see
+        create_timeseries_file) into a memory-mappable column file next to it,
+        see ColumnCache.  Missing values and heights are NaN.  The values are
+        f4 when the file stores f4 and f8 when it stores packed values.
+
+        The file is read rows time records at a time and the column file is
+        written through a temporary file and renamed into place.  The size and
+        mtime of filepath are recorded, so a column file that no longer matches
+        it is ignored.  Returns the column file's path.
+    """
+    path = column_path(filepath)
+    tmp  = "%s.%d.tmp" % (path, os.getpid())
+    with metrics.stage("columns.write", read=filepath, written=path, file=filepath) as stage:
+        nc = netCDF4.Dataset(filepath)
+        try:
+            if variable_name is None:
+                variable_name = nc.variables["instrument"].long_name.split(":")[-1]
+            stage.add(records=_write_columns(nc, filepath, variable_name, tmp, rows))
+            os.rename(tmp, path)
+        finally:
+            nc.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    return path
+
+
+class ColumnCache(object):
+    """
+        Read-only view of a column file written by write_columns.
+
+        The file is a MAGIC string, the length of a JSON header as a little
+        endian uint64, the header, and then the time, height and values columns
+        as raw little endian arrays on ALIGNMENT byte boundaries.  The header
+        has the variable name, its units, the size and mtime of the NetCDF file
+        the columns came from, and the dtype, shape and offset of each column.
+
+        The whole file is memory mapped once, so time, height and values are
+        NumPy arrays backed by the mapping and window() returns slices of them
+        without copying.  Only the pages a window touches are read from disk,
+        and HDF5 isn't involved at all.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("'%s' is not a column file" % path)
+            length = struct.unpack("<Q", f.read(8))[0]
+            self.header = json.loads(f.read(length))
+
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        columns = {}
+        for name, column in self.header['columns'].iteritems():
+            columns[name] = np.ndarray(tuple(column['shape']), dtype=str(column['dtype']), buffer=self._map, offset=column['offset'])
+        self.time     = columns['time']
+        self.height   = columns['height']
+        self.values   = columns['values']
+        self.variable = self.header['variable']
+        self.units    = self.header['units']
+
+    @classmethod
+    def open(cls, filepath, check=True):
+        """
+            The ColumnCache of a NetCDF file, or None if it has none.  If check is
+            True a column file that doesn't match the size and mtime of filepath
+            is treated as missing, and so is one that can't be read (truncated,
+            corrupt or not a column file).
+        """
+        path = column_path(filepath)
+        if not os.path.exists(path):
+            return None
+        try:
+            cache = cls(path)
+        except (IOError, OSError, ValueError, TypeError, KeyError, struct.error) as e:
+            logger.warn("Ignoring unreadable column file '%s': %s" % (path, e))
+            return None
+        if check:
+            st = os.stat(filepath)
+            if cache.header['source'] != { 'size' : st.st_size, 'mtime' : st.st_mtime }:
+                logger.debug("'%s' is out of date" % path)
+                return None
+        return cache
+
+    def __len__(self):
+        return self.time.size
+
+    def rows(self, start=None, end=None):
+        """
+            (first, last + 1) rows with start <= time <= end, by binary search.
+            Either end may be None, a datetime, a crawl time string or seconds.
+        """
+        lo = 0
+        hi = self.time.size
+        if start is not None:
+            lo = int(np.searchsorted(self.time, _seconds(start), side="left"))
+        if end is not None:
+            hi = int(np.searchsorted(self.time, _seconds(end), side="right"))
+        return lo, max(lo, hi)
+
+    def window(self, start=None, end=None):
+        """
+            (times, heights, values) for start <= time <= end, as views of the
+            mapped file.  Missing values are NaN.
+        """
+        lo, hi = self.rows(start, end)
+        return self.time[lo:hi], self.height, self.values[lo:hi]
@@ -3,75 +3,266 @@
 
 import os
 import json
-import shutil
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 import netCDF4
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from .. import metrics
+from .header_cache import HeaderCache
+from .transfer import copy_file, COPY
+
 import logging
 logger = logging.getLogger("pytools")
 logger.addHandler(logging.NullHandler())
 
 
-def crawl_and_copy(crawl_paths, authority_map, station_map, write_output=None, perform_copy=None, output_path=None):
+def read_header(filepath):
+    """
+        Read the sensor URN, location and first and last time from a sensor file.
+    """
+    with metrics.stage("crawl.header", read=filepath, file=filepath):
+        nc = netCDF4.Dataset(filepath)
+        try:
+            return dataset_header(nc)
+        finally:
+            nc.close()
+
+
+def dataset_header(nc):
+    """
+        read_header for an open Dataset.
+    """
+    return { 'sensor_urn' : nc.variables["instrument"].long_name,
+             'lat'        : float(nc.variables["latitude"][:]),
+             'lon'        : float(nc.variables["longitude"][:]),
+             'start'      : datetime.utcfromtimestamp(nc.variables["time"][0]).strftime("%Y-%m-%d %H:%M:%S"),
+             'end'        : datetime.utcfromtimestamp(nc.variables["time"][-1]).strftime("%Y-%m-%d %H:%M:%S") }
+
+
+def copy_component(src, dst, strategy=COPY, skip_unchanged=False, checksum=False):
+    """
+        transfer.copy_file, recorded as a "crawl.copy" stage.
+    """
+    with metrics.stage("crawl.copy", read=src, written=dst, file=src) as stage:
+        action = copy_file(src, dst, strategy=strategy, skip_unchanged=skip_unchanged, checksum=checksum)
+        stage.set(action=action)
+        return action
+
+
+def map_header(filepath, header, authority_map, station_map):
+    """
+        Build the crawl metadata for a file from its header, applying the authority and station maps.
+    """
+    sensor_urn   = header['sensor_urn']
+    split_urn    = sensor_urn.split(":")
+    authority    = authority_map.get(split_urn[3], None) or split_urn[3]
+    varname      = split_urn[-1]
+
+    auth_station = "%s:%s" % (authority, split_urn[4])
+    new_auth     = station_map.get(auth_station, None) or auth_station
+
+    uid          = new_auth.split(":")[-1]
+    authority    = new_auth.split(":")[0]
+
+    # Now get the final sensor_urn, and make it lowercase
+    mapped_sensor_urn      = ":".join(split_urn[0:3] + [authority] + [uid] + [varname]).lower()
+    mapped_station_urn     = ":".join(split_urn[0:2] + ["station"] + [authority] + [uid]).lower()
+
+    return {  'file'          : filepath,
+              'start'         : header['start'],
+              'end'           : header['end'],
+              'lat'           : header['lat'],
+              'lon'           : header['lon'],
+              'mapped_station': mapped_station_urn,
+              'sensor_urn'    : sensor_urn,
+              'mapped_sensor' : mapped_sensor_urn }
 
-    out = {}
 
-    for p in crawl_paths:
-        for root, dirs, files in os.walk(p):
-            for f in files:
+def iter_nc_files(crawl_path):
+    """
+        Yield the path of every NetCDF file under crawl_path, in sorted order.
+        Uses scandir when it is available so no extra stat calls are made to tell
+        files from directories.  Like os.walk, symlinks to directories are not
+        followed.
+    """
+    if scandir is None:
+        for root, dirs, files in os.walk(crawl_path):
+            dirs.sort()
+            for f in sorted(files):
                 if os.path.splitext(f)[-1][0:3] == ".nc":
-                    filepath = os.path.join(root, f)
-                    nc = netCDF4.Dataset(filepath)
+                    yield os.path.join(root, f)
+        return
+
+    stack = [crawl_path]
+    while stack:
+        directory = stack.pop()
+        subdirs = []
+        for entry in sorted(scandir(directory), key=lambda e: e.name):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_dir():
+                # A symlink to a directory, os.walk doesn't follow those either
+                continue
+            elif os.path.splitext(entry.name)[-1][0:3] == ".nc":
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def crawl(crawl_paths, authority_map, station_map, perform_copy=None, output_path=None, index_path=None, processes=None, copy_strategy=COPY, skip_unchanged=False, checksum=False, copy_threads=None):
+    """
+        Yield the metadata of each NetCDF file under crawl_paths as soon as it is
+        known, copying it into output_path first if perform_copy is True.
+        See crawl_and_copy for the options.
+
+        With copy_threads the copies run in the background, so a file's record
+        can be yielded before its copy has finished.  Every copy is done, and
+        the first copy error raised, once the generator is exhausted.
+
+        If the generator is closed before then, the worker pools are shut down,
+        the header cache is closed without pruning (files that weren't reached
+        yet were not seen) and copy errors are not reported.
+    """
+
+    cache = None
+    if index_path is not None:
+        cache = HeaderCache(index_path)
+
+    def found(filepath, header):
+        meta = map_header(filepath, header, authority_map, station_map)
+
+        if perform_copy is True and output_path is not None:
+            # Make destination if it doesn't exist
+            sensor_path = os.path.join(output_path, meta['mapped_sensor'])
+            dest_path   = os.path.join(sensor_path, os.path.basename(filepath))
+            if not os.path.exists(sensor_path):
+                os.makedirs(sensor_path)
+
+            logger.debug("Copying '%s' to '%s'." % (filepath, dest_path))
+            args = (filepath, dest_path, copy_strategy, skip_unchanged, checksum)
+            if copier is None:
+                copy_component(*args)
+            else:
+                copies.append(copier.apply_async(copy_component, args))
+
+        return meta
+
+    def collect(filepath, stat, result):
+        header = result.get()
+        if cache is not None:
+            cache.put(filepath, stat, header)
+        return found(filepath, header)
+
+    pool    = None
+    pending = deque()
+    if processes is not None:
+        pool = multiprocessing.Pool(processes=processes)
 
-                    sensor_urn   = nc.variables["instrument"].long_name
-                    split_urn    = sensor_urn.split(":")
-                    authority    = authority_map.get(split_urn[3], None) or split_urn[3]
-                    varname      = split_urn[-1]
+    copier  = None
+    copies  = []
+    if perform_copy is True and copy_threads is not None:
+        copier = ThreadPool(copy_threads)
 
-                    auth_station = "%s:%s" % (authority, split_urn[4])
-                    new_auth     = station_map.get(auth_station, None) or auth_station
+    complete = False
+    try:
+        for p in crawl_paths:
+            for filepath in iter_nc_files(p):
+                header = None
+                stat   = None
+                if cache is not None:
+                    stat   = os.stat(filepath)
+                    header = cache.get(filepath, stat)
 
-                    uid          = new_auth.split(":")[-1]
-                    authority    = new_auth.split(":")[0]
+                if header is not None:
+                    yield found(filepath, header)
+                elif pool is not None:
+                    pending.append((filepath, stat, pool.apply_async(read_header, (filepath,))))
+                else:
+                    header = read_header(filepath)
+                    if cache is not None:
+                        cache.put(filepath, stat, header)
+                    yield found(filepath, header)
 
-                    # Now get the final sensor_urn, and make it lowercase
-                    mapped_sensor_urn      = ":".join(split_urn[0:3] + [authority] + [uid] + [varname]).lower()
-                    mapped_station_urn     = ":".join(split_urn[0:2] + ["station"] + [authority] + [uid]).lower()
+                # Handle whatever the workers have finished while we keep scanning
+                while pending and pending[0][2].ready():
+                    yield collect(*pending.popleft())
 
-                    latitude  = float(nc.variables["latitude"][:])
-                    longitude = float(nc.variables["longitude"][:])
-                    starting  = datetime.utcfromtimestamp(nc.variables["time"][0]).strftime("%Y-%m-%d %H:%M:%S")
-                    ending    = datetime.utcfromtimestamp(nc.variables["time"][-1]).strftime("%Y-%m-%d %H:%M:%S")
-                    nc.close()
+        while pending:
+            yield collect(*pending.popleft())
 
-                    if out.get(mapped_station_urn, None) is None:
-                        out[mapped_station_urn] = {}
+        if copies:
+            actions = {}
+            for result in copies:
+                # Raises the first copy error, if there was one
+                action = result.get()
+                actions[action] = actions.get(action, 0) + 1
+            logger.info("Copies: %s" % ", ".join("%s %d" % a for a in sorted(actions.items())))
 
-                    if out[mapped_station_urn].get(varname, None) is None:
-                        out[mapped_station_urn][varname] = []
+        if cache is not None:
+            cache.prune(crawl_paths)
+        complete = True
+    finally:
+        if pool is not None:
+            if complete:
+                pool.close()
+            else:
+                # Don't wait for headers nobody will ask for
+                pool.terminate()
+            pool.join()
+        if copier is not None:
+            # Copies that were queued are left to finish
+            copier.close()
+            copier.join()
+        if cache is not None:
+            cache.close()
 
-                    meta  = {  'file'          : filepath,
-                               'start'         : starting,
-                               'end'           : ending,
-                               'lat'           : latitude,
-                               'lon'           : longitude,
-                               'mapped_station': mapped_station_urn,
-                               'sensor_urn'    : sensor_urn,
-                               'mapped_sensor' : mapped_sensor_urn }
 
-                    out[mapped_station_urn][varname].append(meta)
+def crawl_and_copy(crawl_paths, authority_map, station_map, write_output=None, perform_copy=None, output_path=None, index_path=None, processes=None, copy_strategy=COPY, skip_unchanged=False, checksum=False, copy_threads=None):
+    """
+        If index_path is set, file headers are cached in a SQLite database there
+        and a file is only reopened when its size or mtime changed.
 
-                    if perform_copy is True and output_path is not None:
-                        # Make destination if it doesn't exist
-                        sensor_path = os.path.join(output_path, mapped_sensor_urn)
-                        dest_path   = os.path.join(sensor_path, f)
-                        if not os.path.exists(sensor_path):
-                            os.makedirs(sensor_path)
+        If processes is set, headers are read by a pool of that many worker
+        processes while the directory scan carries on in this one.
 
-                        logger.debug("Copying '%s' to '%s'." % (filepath, dest_path))
-                        shutil.copy2(filepath, dest_path)
+        Each list of files in the output is sorted by path, so the result is the
+        same with or without processes and whichever headers came from the cache.
+
+        copy_strategy, skip_unchanged and checksum choose how files are copied when
+        perform_copy is True (see transfer.copy_file).  If copy_threads is set the
+        copies run in a thread pool of that size.
+
+        Use crawl() and write_jsonl() instead to stream the results without
+        holding them all in memory.
+    """
+
+    out = {}
+
+    for meta in crawl(crawl_paths, authority_map, station_map, perform_copy=perform_copy, output_path=output_path, index_path=index_path, processes=processes, copy_strategy=copy_strategy, skip_unchanged=skip_unchanged, checksum=checksum, copy_threads=copy_threads):
+        mapped_station_urn = meta['mapped_station']
+        varname            = meta['sensor_urn'].split(":")[-1]
+
+        if out.get(mapped_station_urn, None) is None:
+            out[mapped_station_urn] = {}
+
+        if out[mapped_station_urn].get(varname, None) is None:
+            out[mapped_station_urn][varname] = []
+
+        out[mapped_station_urn][varname].append(meta)
+
+    for station in out.itervalues():
+        for metas in station.itervalues():
+            metas.sort(key=lambda m: m['file'])
 
     # Sort by station
     out = OrderedDict(sorted(out.items(), key=lambda x: x[0]))
@@ -82,3 +273,79 @@ def crawl_and_copy(crawl_paths, authority_map, station_map, write_output=None, p
             f.write(json.dumps(out, sort_keys=False, indent=4, separators=(',', ' : ')))
 
     return out
+
+
+def write_jsonl(records, path):
+    """
+        Write each crawl record to path as one line of JSON, as they arrive.
+        Returns the number of records written.
+    """
+    count = 0
+    with open(path, "w") as f:
+        for meta in records:
+            f.write(json.dumps(meta, sort_keys=True))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def read_jsonl(path):
+    """
+        Yield the crawl records from a JSON lines file written by write_jsonl.
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class GroupedCrawl(object):
+    """
+        Read-only station -> variable -> [records] view of a JSON lines crawl file,
+        like the structure crawl_and_copy returns.
+
+        Only the byte offset of each record is kept in memory.  A station's records
+        are read from disk when it is accessed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._offsets = None
+
+    def _index(self):
+        if self._offsets is None:
+            offsets = {}
+            with open(self.path, "rb") as f:
+                offset = f.tell()
+                for line in iter(f.readline, b""):
+                    if line.strip():
+                        station = json.loads(line)['mapped_station']
+                        offsets.setdefault(station, []).append(offset)
+                    offset = f.tell()
+            self._offsets = offsets
+        return self._offsets
+
+    def keys(self):
+        return sorted(self._index().keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._index())
+
+    def __contains__(self, station):
+        return station in self._index()
+
+    def __getitem__(self, station):
+        grouped = {}
+        with open(self.path, "rb") as f:
+            for offset in self._index()[station]:
+                f.seek(offset)
+                meta = json.loads(f.readline())
+                grouped.setdefault(meta['sensor_urn'].split(":")[-1], []).append(meta)
+        return grouped
+
+    def iteritems(self):
+        for station in self.keys():
+            yield station, self[station]
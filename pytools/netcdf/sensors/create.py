@@ -2,18 +2,151 @@
 # coding=utf-8
 
 import os
-import bisect
 from datetime import datetime
 
 import netCDF4
 import numpy as np
 
+from .. import metrics
+from ..chunking import storage_options, pack_parameters, PACKED_FILL, TIMESERIES
+from .aggregate import Pyramid, STEPS_ATTRIBUTE
+from .columns import write_columns
+
 import logging
 logger = logging.getLogger("pytools")
 logger.addHandler(logging.NullHandler())
 
+# These are set by this script, we don't someone to be able to set them manually
+GLOBAL_SKIPS = ["time_coverage_start", "time_coverage_end", "time_coverage_duration", "time_coverage_resolution",
+                "featureType", "geospatial_vertical_positive", "geospatial_vertical_min", "geospatial_vertical_max",
+                "geospatial_vertical_resolution", "Conventions", "date_created"]
+
+# Data variable attributes describing how values are stored and aggregated, which are set here and not copied over
+STORAGE_SKIPS = ["_FillValue", "scale_factor", "add_offset", STEPS_ATTRIBUTE]
+
+
+class SampleBuffer(object):
+    """
+        Growable float64 column buffers for (time, vertical, value) samples.
+        Memory is one compact copy of the samples (plus growth headroom) no matter
+        how they are fed in.
+    """
 
-def create_timeseries_file(output_directory, latitude, longitude, full_station_urn, full_sensor_urn, global_attributes, attributes, data=None, times=None, verticals=None, values=None, fillvalue=-9999.9, output_filename=None):
+    def __init__(self, capacity=65536, fillvalue=-9999.9):
+        self.size      = 0
+        self.fillvalue = fillvalue
+        self.columns   = [np.empty(capacity, dtype=np.float64) for _ in range(3)]
+
+    def _reserve(self, n):
+        capacity = self.columns[0].size
+        if self.size + n <= capacity:
+            return
+        while capacity < self.size + n:
+            capacity *= 2
+        for i, column in enumerate(self.columns):
+            grown = np.empty(capacity, dtype=np.float64)
+            grown[:self.size] = column[:self.size]
+            self.columns[i] = grown
+
+    def extend(self, rows):
+        """
+            Add a batch of samples given as rows: an (n, 3) array or a sequence
+            of (time, vertical, value) tuples.
+        """
+        rows = np.ma.asarray(rows, dtype=np.float64)
+        if rows.size == 0:
+            return
+        if rows.ndim != 2 or rows.shape[1] != 3:
+            raise ValueError("Expected (time, vertical, value) rows, got an array of shape %s" % (rows.shape,))
+        self.extend_columns(rows[:, 0], rows[:, 1], rows[:, 2])
+
+    def extend_columns(self, times, verticals, values):
+        """
+            Add a batch of samples given as three equally long arrays.
+        """
+        n = np.size(times)
+        if not np.size(verticals) == np.size(values) == n:
+            raise ValueError("Columns of different lengths: %d times, %d verticals and %d values" % (n, np.size(verticals), np.size(values)))
+        self._reserve(n)
+        for column, array in zip(self.columns, (times, verticals, values)):
+            column[self.size:self.size + n] = np.ma.filled(np.ma.ravel(np.ma.asarray(array, dtype=np.float64)), self.fillvalue)
+        self.size += n
+
+    def arrays(self):
+        return tuple(column[:self.size] for column in self.columns)
+
+
+def write_rows(var, data, rows=10000):
+    """
+        Write data into var along its first dimension, rows at a time, so the
+        library's type conversion buffers stay small.
+    """
+    n = data.shape[0]
+    for i in xrange(0, n, rows):
+        var[i:min(i + rows, n)] = data[i:min(i + rows, n)]
+
+
+def unique_samples(times, verticals, values):
+    """
+        Sort samples on (time, vertical) and drop repeated (time, vertical) pairs,
+        keeping the first occurrence of each.  Masked verticals are all the same
+        missing height and sort after the others, like the masked value
+        np.ma.unique puts last.
+    """
+    # A stable sort keeps duplicates in their original order, so the first of
+    # each run of equal (time, vertical) pairs is the first occurrence.
+    time_data     = np.ma.getdata(times)
+    vertical_data = np.ma.filled(np.ma.asarray(verticals).astype(np.float64), np.inf)
+    indices = np.lexsort((vertical_data, time_data))
+    sorted_times     = time_data[indices]
+    sorted_verticals = vertical_data[indices]
+    keep = np.ones(indices.size, dtype=bool)
+    keep[1:] = (sorted_times[1:] != sorted_times[:-1]) | (sorted_verticals[1:] != sorted_verticals[:-1])
+    indices = indices[keep]
+    return times[indices], verticals[indices], values[indices]
+
+
+def vertical_columns(unique_verticals, verticals, fillvalue):
+    """
+        Column of each of verticals in unique_verticals, and whether it is really
+        there.  Missing heights (masked or fillvalue) belong to the missing
+        height in unique_verticals, wherever it is.
+    """
+    heights = np.ma.filled(unique_verticals, fillvalue).astype(np.float64)
+    zs      = np.ma.filled(verticals, fillvalue).astype(np.float64)
+    order   = np.argsort(heights, kind="mergesort")
+    columns = order[np.searchsorted(heights, zs, sorter=order).clip(0, heights.size - 1)]
+    return columns, heights[columns] == zs
+
+
+def scatter_values(times, verticals, values, unique_times, unique_verticals, fillvalue):
+    """
+        Place each sample at its (time, vertical) position in a 2D array of
+        unique_times by unique_verticals.  Positions without a sample get fillvalue.
+    """
+    tzi = np.searchsorted(np.ma.getdata(unique_times), np.ma.getdata(times))
+    zzi, _ = vertical_columns(unique_verticals, verticals, fillvalue)
+    used_values = np.ndarray((unique_times.size, unique_verticals.size), dtype=float)
+    used_values.fill(float(fillvalue))
+    used_values[tzi, zzi] = np.ma.filled(values, fillvalue)
+    return used_values
+
+
+def collect_samples(full_sensor_urn, data=None, times=None, verticals=None, values=None, batches=None, column_batches=None, fillvalue=-9999.9):
+    """
+        (times, verticals, values) arrays from samples passed in any of the ways
+        create_timeseries_file accepts, or None if there aren't any.
+    """
+    if batches is not None or column_batches is not None:
+        buffered = SampleBuffer(fillvalue=fillvalue)
+        for rows in batches or []:
+            buffered.extend(rows)
+        for columns in column_batches or []:
+            buffered.extend_columns(*columns)
+        if buffered.size == 0:
+            logger.warn("No data passed in for '%s'.  Skipping file creation" % full_sensor_urn)
+            return None
+        times, verticals, values = buffered.arrays()
 
     if data is not None:
         try:
@@ -25,29 +158,24 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
             values    = np.ma.asarray(zipped[2]).astype(np.float)
         except (AssertionError, IndexError):
             logger.warn("No data passed in for '%s'.  Skipping file creation" % full_sensor_urn)
-            return
+            return None
+
+    return times, verticals, values
 
+
+def grid_values(times, verticals, values, fillvalue=-9999.9):
+    """
+        Deduplicate samples and lay the values out on their unique times and
+        verticals.  Returns (unique_times, unique_verticals, used_values,
+        value_range), where used_values is 1D for at most one vertical and 2D
+        otherwise, and value_range is the (min, max) of the valid values or None.
+    """
     verticals = np.ma.masked_values(verticals, fillvalue)
     values    = np.ma.masked_values(values, fillvalue)
 
     logger.debug("Getting unique time/vertical combinations")
-    # Get all unique time/vertical combinations.
-    times_verticals  = np.ma.dstack((times, verticals))
-    outer            = times_verticals.reshape(times.size, 2)
-    # Get unique time/vertical rows
-    # http://stackoverflow.com/questions/16970982/find-unique-rows-in-numpy-array
-    void_to_unique = np.ascontiguousarray(outer).view(np.dtype((np.void, outer.dtype.itemsize * outer.shape[1])))
-    _, indices  = np.unique(void_to_unique, return_index=True)
-    # Subset by the unique indices
-    times       = times[indices]
-    verticals   = verticals[indices]
-    values      = values[indices]
-
-    # Now sort them
-    indices     = np.lexsort((verticals, times))
-    times       = times[indices]
-    verticals   = verticals[indices]
-    values      = values[indices]
+    # Get all unique time/vertical combinations, sorted
+    times, verticals, values = unique_samples(times, verticals, values)
 
     assert times.size == verticals.size == values.size
 
@@ -71,15 +199,48 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
             except ValueError:
                 # Hmmm, we have two actual height values for this station.
                 # Not cool man, not cool.
-                # Reindex the entire values array.  This is slow.
-                indexed = ((bisect.bisect_left(unique_times, times[i]), bisect.bisect_left(unique_verticals, verticals[i]), values[i]) for i in xrange(values.size))
-                used_values = np.ndarray((unique_times.size, unique_verticals.size), dtype=float)
-                used_values.fill(float(fillvalue))
-                for (tzi, zzi, vz) in indexed:
-                    used_values[tzi, zzi] = vz
+                # Reindex the entire values array.
+                used_values = scatter_values(times, verticals, values, unique_times, unique_verticals, fillvalue)
         else:
             raise
 
+    value_range = None
+    if values.count() > 0:
+        value_range = (float(values.min()), float(values.max()))
+
+    return unique_times, unique_verticals, used_values, value_range
+
+
+def create_timeseries_file(output_directory, latitude, longitude, full_station_urn, full_sensor_urn, global_attributes, attributes, data=None, times=None, verticals=None, values=None, fillvalue=-9999.9, output_filename=None, batches=None, storage=None, aggregates=None, columns=False, column_batches=None):
+    """
+        Samples are passed in as one of
+
+            * data, a list of (time, vertical, value) tuples
+            * times, verticals and values arrays
+            * batches, an iterator of row batches accepted by SampleBuffer.extend,
+              so a parser can stream samples in without building one list of tuples
+            * column_batches, an iterator of (times, verticals, values) arrays
+              accepted by SampleBuffer.extend_columns
+
+        storage sets the chunking, compression and packing of the new file (see
+        storage_options).  By default the original uncompressed layout is used.
+
+        aggregates is a list of time steps (seconds or timedeltas), e.g. [3600, 86400].
+        The mean, min, max and count of the values over each step are written
+        next to them (see aggregate.Pyramid).
+
+        If columns is True a memory-mappable copy of the time, height and values
+        is written next to the file (see columns.write_columns).
+    """
+
+    with metrics.stage("create.collect", sensor=full_sensor_urn):
+        samples = collect_samples(full_sensor_urn, data=data, times=times, verticals=verticals, values=values, batches=batches, column_batches=column_batches, fillvalue=fillvalue)
+    if samples is None:
+        return
+    with metrics.stage("create.grid", sensor=full_sensor_urn) as stage:
+        unique_times, unique_verticals, used_values, value_range = grid_values(*samples, fillvalue=fillvalue)
+        stage.add(samples=samples[0].size, records=unique_times.size)
+
     # Ain't got no data!
     if unique_times.size < 2:
         logger.error("Skipping: %s, no time!" % full_sensor_urn)
@@ -100,18 +261,53 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
 
     variable_name = full_sensor_urn.split(":")[-1]
 
-    nc = netCDF4.Dataset(filepath, "w")
-    logger.debug("Opened file for writing: %s" % filepath)
+    with metrics.stage("create.write", written=filepath, sensor=full_sensor_urn, file=filepath) as stage:
+        stage.add(records=unique_times.size, samples=np.size(used_values))
+
+        nc = netCDF4.Dataset(filepath, "w")
+        logger.debug("Opened file for writing: %s" % filepath)
 
+        write_globals(nc, full_station_urn, global_attributes)
+
+        logger.debug("Setting up time...")
+        set_time_coverage(nc, unique_times)
+        time = create_time(nc, storage=storage, nrecords=unique_times.size)
+        logger.debug("Setting data array...")
+        write_rows(time, unique_times)
+
+        write_metadata_variables(nc, latitude, longitude, full_station_urn, full_sensor_urn, global_attributes)
+
+        var = create_vertical_and_values(nc, variable_name, unique_verticals, attributes, fillvalue, storage=storage, nrecords=unique_times.size, value_range=value_range)
+
+        # Set data
+        logger.debug("Setting data array...")
+        if "scale_factor" in var.ncattrs():
+            # Packed values have their own fill value, so make sure the empty cells are masked
+            used_values = np.ma.masked_values(used_values, fillvalue)
+        write_rows(var, used_values)
+
+        if aggregates:
+            logger.debug("Setting aggregates...")
+            with metrics.stage("create.aggregate", sensor=full_sensor_urn):
+                pyramid = Pyramid(nc, variable_name, aggregates, fillvalue=fillvalue, storage=storage, span=(unique_times[0], unique_times[-1]))
+                pyramid.add(unique_times, used_values)
+                pyramid.close()
+
+        nc.close()
+
+    if columns is True:
+        write_columns(filepath, variable_name)
+
+
+def write_globals(nc, full_station_urn, global_attributes):
+    """
+        Global attributes and the station name of a new timeseries file.
+    """
     # Globals
-    # These are set by this script, we don't someone to be able to set them manually
-    global_skips = ["time_coverage_start", "time_coverage_end", "time_coverage_duration", "time_coverage_resolution",
-                    "featureType", "geospatial_vertical_positive", "geospatial_vertical_min", "geospatial_vertical_max",
-                    "geospatial_vertical_resolution", "Conventions", "date_created"]
     for k, v in global_attributes.iteritems():
         if v is None:
             v = "None"
-        if k not in global_skips:
+        if k not in GLOBAL_SKIPS:
             nc.setncattr(k, v)
 
     nc.setncattr("Conventions", "CF-1.6")
@@ -124,7 +320,16 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
     name.long_name = "Identifier for each feature type instance"
     name[:] = list(full_station_urn)
 
-    logger.debug("Setting up time...")
+
+def set_time_coverage(nc, unique_times, diff_counts=None):
+    """
+        time_coverage_* globals from the sorted unique times.  The resolution is
+        the most common difference between adjacent times, which can be passed in
+        as a {difference: count} dictionary when the times are not all in memory.
+    """
+    starting = datetime.utcfromtimestamp(unique_times[0])
+    ending   = datetime.utcfromtimestamp(unique_times[-1])
+
     # Time extents
     nc.setncattr("time_coverage_start",    starting.isoformat())
     nc.setncattr("time_coverage_end",      ending.isoformat())
@@ -132,21 +337,42 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
     nc.setncattr("time_coverage_duration", "P%sS" % unicode(int(round((ending - starting).total_seconds()))))
     # resolution (ISO8601 format)
     # subtract adjacent times to produce an array of differences, then get the most common occurance
-    diffs = unique_times[1:] - unique_times[:-1]
-    uniqs, inverse = np.unique(diffs, return_inverse=True)
-    time_diffs = diffs[np.bincount(inverse).argmax()]
+    if diff_counts is None:
+        diffs = unique_times[1:] - unique_times[:-1]
+        uniqs, inverse = np.unique(diffs, return_inverse=True)
+        time_diffs = uniqs[np.bincount(inverse).argmax()]
+    else:
+        # Most common difference, the smallest one on a tie
+        time_diffs = min(diff_counts.iteritems(), key=lambda x: (-x[1], x[0]))[0]
     nc.setncattr("time_coverage_resolution", "P%sS" % unicode(int(round(time_diffs))))
 
+
+def create_time(nc, storage=None, nrecords=0, name="time"):
     # Time - 32-bit unsigned integer
-    nc.createDimension("time")
-    time = nc.createVariable("time",    "f8", ("time",), chunksizes=(1000,))
+    nc.createDimension(name)
+    time = nc.createVariable(name,    "f8", (name,), **storage_options(storage, (nrecords,), (name,), 8, access=TIMESERIES))
     time.units          = "seconds since 1970-01-01T00:00:00Z"
     time.standard_name  = "time"
     time.long_name      = "time of measurement"
     time.calendar       = "gregorian"
-    logger.debug("Setting data array...")
-    time[:] = unique_times
+    return time
+
+
+def write_metadata_variables(nc, latitude, longitude, full_station_urn, full_sensor_urn, global_attributes):
+    """
+        Location, crs, platform and instrument variables of a new timeseries file.
+    """
+    write_station_variables(nc, latitude, longitude, full_station_urn, global_attributes)
+    create_instrument(nc, "instrument", full_sensor_urn)
+
+    # Sync file structure
+    nc.sync()
+
 
+def write_station_variables(nc, latitude, longitude, full_station_urn, global_attributes):
+    """
+        Location, crs and platform variables of a new timeseries file.
+    """
     # Location
     lat = nc.createVariable("latitude", "f4")
     lat.units           = "degrees_north"
@@ -173,13 +399,66 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
     platform.short_name     = global_attributes.get("title", full_station_urn)
     platform.long_name      = global_attributes.get("description", full_station_urn)
 
-    instrument = nc.createVariable("instrument", "i4")
+
+def create_instrument(nc, name, full_sensor_urn):
+    instrument = nc.createVariable(name, "i4")
     instrument.definition   = "http://mmisw.org/ont/ioos/definition/sensorID"
     instrument.long_name    = full_sensor_urn
-
-    # Sync file structure
-    nc.sync()
-
+    return instrument
+
+
+def create_height(nc, name, dimensions, fillvalue):
+    z = nc.createVariable(name,     "f4", dimensions, fill_value=fillvalue)
+    z.long_name       = "height of the sensor relative to sea surface"
+    z.standard_name   = "height"
+    z.positive        = "down"
+    z.units           = "m"
+    z.axis            = "Z"
+    return z
+
+
+def create_values(nc, variable_name, dimensions, shape, attributes, fillvalue, storage=None, value_range=None):
+    """
+        Create the sensor variable with the attributes passed in.
+
+        If storage has a precision and value_range (min, max) fits into int16 at
+        that precision, the values are packed into int16 with scale_factor and
+        add_offset.  Otherwise they are stored as f4.
+    """
+    packing = None
+    precision = (storage or {}).get('precision')
+    if precision is not None:
+        if value_range is None:
+            logger.info("%s : Range of the values is unknown, storing them as f4" % variable_name)
+        else:
+            packing = pack_parameters(value_range[0], value_range[1], precision)
+            if packing is None:
+                logger.warn("%s : Values between %s and %s don't fit into int16 at a precision of %s, storing them as f4" % (variable_name, value_range[0], value_range[1], precision))
+
+    # Profiles are the only data variables with more than time to chunk over
+    access = None if len(dimensions) > 1 else TIMESERIES
+    if packing is None:
+        var = nc.createVariable(variable_name, "f4", dimensions, fill_value=fillvalue, **storage_options(storage, shape, dimensions, 4, access=access))
+    else:
+        var = nc.createVariable(variable_name, "i2", dimensions, fill_value=PACKED_FILL, **storage_options(storage, shape, dimensions, 2, access=access))
+        var.scale_factor = packing[0]
+        var.add_offset   = packing[1]
+
+    # Set the variable attributes as passed in
+    for k, v in attributes.iteritems():
+        if k not in STORAGE_SKIPS:
+            setattr(var, k, v)
+    return var
+
+
+def create_vertical_and_values(nc, variable_name, unique_verticals, attributes, fillvalue, storage=None, nrecords=0, value_range=None):
+    """
+        Create the height and sensor variables, as a timeSeries if there is at most
+        one vertical and a timeSeriesProfile otherwise.  Returns the sensor variable.
+
+        storage, nrecords (the expected number of time records) and value_range
+        decide how the sensor variable is stored (see create_values).
+    """
     # The coordinates attribute.  This may get appended to below before being written to the sensor variable.
     coordinates = ["time", "height", "latitude", "longitude"]
 
@@ -190,16 +469,11 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
 
         # Always create the height variable
         logger.debug("Setting up height...")
-        z = nc.createVariable("height",     "f4", fill_value=fillvalue)
-        z.long_name       = "height of the sensor relative to sea surface"
-        z.standard_name   = "height"
-        z.positive        = "down"
-        z.units           = "m"
-        z.axis            = "Z"
+        z = create_height(nc, "height", (), fillvalue)
         logger.debug("Setting data array...")
 
         # Fill in variable if we have an actual height. Else, the fillvalue remains.
-        if unique_verticals.size == 1:
+        if unique_verticals.size == 1 and not np.ma.is_masked(unique_verticals):
             # Vertical extents
             nc.setncattr("geospatial_vertical_positive", "down")
             nc.setncattr("geospatial_vertical_min",      unique_verticals[0])
@@ -208,19 +482,11 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
 
         # Sensor
         logger.debug("Setting values...")
-        var = nc.createVariable(variable_name,    "f4", ("time",), fill_value=fillvalue, chunksizes=(1000,))
-        # Set the variable attributes as passed in
-        for k, v in attributes.iteritems():
-            if k != '_FillValue':
-                setattr(var, k, v)
+        var = create_values(nc, variable_name, ("time",), (nrecords,), attributes, fillvalue, storage=storage, value_range=value_range)
         # Set 'coordinates' attribute
         setattr(var, "coordinates", " ".join(coordinates))
         setattr(var, "standard_name", variable_name)
 
-        # Set data
-        logger.debug("Setting data array...")
-        var[:] = used_values
-
     elif unique_verticals.size > 1:
         # TIMESERIES PROFILE
         # Vertical extents
@@ -236,28 +502,15 @@ def create_timeseries_file(output_directory, latitude, longitude, full_station_u
         # There is more than one vertical value for this variable, we need to create a vertical dimension
         logger.debug("Setting up height...")
         nc.createDimension("z", unique_verticals.size)
-        z = nc.createVariable("height",     "f4", ("z", ), fill_value=fillvalue)
-        z.long_name       = "height of the sensor relative to sea surface"
-        z.standard_name   = "height"
-        z.positive        = "down"
-        z.units           = "m"
-        z.axis            = "Z"
+        z = create_height(nc, "height", ("z", ), fillvalue)
         logger.debug("Setting data array...")
         z[:] = unique_verticals
 
         # Sensor
         logger.debug("Setting up values...")
-        var = nc.createVariable(variable_name,    "f4", ("time", "z",), fill_value=fillvalue, chunksizes=(1000, unique_verticals.size,))
-        # Set the variable attributes as passed in
-        for k, v in attributes.iteritems():
-            if k != '_FillValue':
-                setattr(var, k, v)
+        var = create_values(nc, variable_name, ("time", "z",), (nrecords, unique_verticals.size,), attributes, fillvalue, storage=storage, value_range=value_range)
         # Set 'coordinates' attribute
         setattr(var, "coordinates", " ".join(coordinates))
         setattr(var, "standard_name", variable_name)
 
-        # Set data
-        logger.debug("Setting data array...")
-        var[:] = used_values
-
-    nc.close()
+    return var
@@ -0,0 +1,103 @@
+#!python
+# coding=utf-8
+
+import os
+import sqlite3
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+
+class HeaderCache(object):
+    """
+        Persistent SQLite index of the header values crawl_and_copy reads from each file.
+
+        Rows are keyed by path and are only trusted while the file's size and
+        mtime are unchanged.  A file that shows up under a new path with the
+        same inode, size and mtime as a vanished one is treated as a rename.
+        Call prune() after a crawl to drop files that were not seen.
+
+        Rows are committed every commit_every puts and on close(), so an
+        interrupted crawl keeps most of what it read.  Close the cache in a
+        finally block.
+    """
+
+    def __init__(self, path, commit_every=1000):
+        self.path = path
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS headers (
+                                path       TEXT PRIMARY KEY,
+                                size       INTEGER,
+                                mtime      REAL,
+                                inode      INTEGER,
+                                sensor_urn TEXT,
+                                lat        REAL,
+                                lon        REAL,
+                                start      TEXT,
+                                end        TEXT)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS headers_identity ON headers (inode, size, mtime)")
+        self.conn.commit()
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filepath, stat):
+        """
+            Return the cached header for filepath, or None if it has to be read again.
+        """
+        self.seen.add(filepath)
+        row = self.conn.execute("SELECT size, mtime, sensor_urn, lat, lon, start, end FROM headers WHERE path = ?", (filepath,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            self.hits += 1
+            return self._header(row[2:])
+
+        # Maybe the file was moved here
+        for row in self.conn.execute("SELECT path, sensor_urn, lat, lon, start, end FROM headers WHERE inode = ? AND size = ? AND mtime = ?", (stat.st_ino, stat.st_size, stat.st_mtime)).fetchall():
+            if row[0] != filepath and row[0] not in self.seen and not os.path.exists(row[0]):
+                logger.debug("'%s' was renamed to '%s'" % (row[0], filepath))
+                self.conn.execute("DELETE FROM headers WHERE path = ?", (filepath,))
+                self.conn.execute("UPDATE headers SET path = ? WHERE path = ?", (filepath, row[0]))
+                self.hits += 1
+                return self._header(row[1:])
+
+        self.misses += 1
+        return None
+
+    def put(self, filepath, stat, header):
+        self.seen.add(filepath)
+        self.conn.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (filepath, stat.st_size, stat.st_mtime, stat.st_ino, header['sensor_urn'], header['lat'], header['lon'], header['start'], header['end']))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def prune(self, roots):
+        """
+            Remove every file under roots that was not seen since this cache was opened.
+        """
+        prefixes = tuple(os.path.join(os.path.abspath(r), "") for r in roots)
+        gone = [row[0] for row in self.conn.execute("SELECT path FROM headers") if row[0] not in self.seen and os.path.abspath(row[0]).startswith(prefixes)]
+        self.conn.executemany("DELETE FROM headers WHERE path = ?", [(p,) for p in gone])
+        self.commit()
+        logger.info("Header cache: %d hits, %d misses, %d removed" % (self.hits, self.misses, len(gone)))
+        return gone
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    @staticmethod
+    def _header(row):
+        sensor_urn, lat, lon, start, end = row
+        return { 'sensor_urn' : sensor_urn,
+                 'lat'        : lat,
+                 'lon'        : lon,
+                 'start'      : start,
+                 'end'        : end }
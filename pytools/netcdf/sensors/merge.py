@@ -2,125 +2,867 @@
 # coding=utf-8
 
 import os
+import re
+import sys
+import json
+import time
+import shutil
+import Queue
+import threading
+import traceback
+from collections import deque
 
 import netCDF4
 import numpy as np
 
-from .create import create_timeseries_file
+from .. import metrics
+from ..jobs import run_jobs
+from ..chunking import packed_range
+from .aggregate import Pyramid, STEPS_ATTRIBUTE, step_seconds
+from .columns import SUFFIX as COLUMN_SUFFIX, column_path, write_columns, ColumnCache
+from .create import GLOBAL_SKIPS, STORAGE_SKIPS, create_timeseries_file, write_globals, set_time_coverage, create_time, write_metadata_variables, create_vertical_and_values, vertical_columns
 
 import logging
 logger = logging.getLogger("pytools")
 logger.addHandler(logging.NullHandler())
 
 
-def merge_timeseries(crawl_path, output_filename=None):
-
-    if output_filename is None:
-        output_filename = "merged.nc"
-        logger.info("Setting output file to %s" % output_filename)
-
+def sensor_directories(crawl_path, output_filename):
+    """
+        Yield (directory, NetCDF filenames) for every sensor directory under crawl_path
+        that has at least one component file.  The filenames are sorted, so which
+        file wins a repeated time doesn't depend on the order the directory lists
+        them in.
+    """
     for root, dirs, files in os.walk(crawl_path):
         try:
             # Make sure we are in a sensor directory
             assert os.path.basename(root).split(":")[2] == "sensor"
-            ncfiles = [ncfile for ncfile in files if os.path.splitext(ncfile)[-1][0:3] == ".nc" and os.path.splitext(ncfile)[-1] != ".ncml" and ncfile != output_filename]
+            ncfiles = [ncfile for ncfile in sorted(files) if os.path.splitext(ncfile)[-1][0:3] == ".nc" and os.path.splitext(ncfile)[-1] != ".ncml" and ncfile != output_filename]
             # Make sure we have at least one NetCDF file in the directory
             assert len(ncfiles) > 0
-            logger.warn("Merging %s" % root)
         except (IndexError, AssertionError):
             continue
+        yield root, ncfiles
 
-        sensor_urn  = os.path.basename(root)
-        station_urn = ":".join(sensor_urn.replace("sensor", "station").split(":")[0:-1])
-        varname     = sensor_urn.split(":")[-1]
-        fillvalue   = -9999.9
-
-        times   = np.ma.asarray([])
-        values  = np.ma.asarray([])
-        verticals = np.ma.asarray([])
-        lats    = []
-        lons    = []
-        # Track attributes from every file
-        global_attributes   = {}
-        variable_attributes = {}
-
-        dims_of_values = None
-        continue_on = False
-        f = None
-        for f in ncfiles:
-            nc = netCDF4.Dataset(os.path.join(root, f))
 
-            if dims_of_values is not None and dims_of_values != nc.variables[varname].ndim:
-                logger.warn("Error with sensor: %s.  Different dimensions on the data variable between files" % sensor_urn)
-                continue_on = True
-                nc.close()
-                break
-            dims_of_values = nc.variables[varname].ndim
+def merge_timeseries(crawl_path, output_filename=None, buffer_size=None, incremental=False, prefetch_depth=0, storage=None, aggregates=None, columns=False):
+    """
+        Merge the component files of every sensor directory under crawl_path into output_filename.
+
+        By default each sensor is merged in memory.  If buffer_size is set, the
+        streaming merge (stream_merge_sensor) is used instead, reading at most
+        buffer_size time records from each file at a time.
 
-            # Update running global_attributes, overwriting any already existing key.
-            global_attributes.update(nc.__dict__)
-            # update running variable_attributes, overwriting any already existing key.
-            variable_attributes.update(nc.variables[varname].__dict__)
+        If incremental is True, only component files that are not already in
+        output_filename are read and added to it (see append_sensor).
 
-            # This is generalized to work with both timeseries and timeseries profile.
-            vardata = np.ma.ravel(nc.variables[varname][:])
-            values  = np.ma.concatenate([values, vardata])
-            ts      = nc.variables["time"][:]
-            zs      = nc.variables["height"][:]
+        prefetch_depth is the number of component files the in-memory merges read
+        ahead in the background (see read_components).
 
-            # Location of the station
-            lats.append(nc.variables["latitude"][:][0])
-            lons.append(nc.variables["longitude"][:][0])
+        storage sets the chunking, compression and packing of the merged files
+        (see chunking.storage_options).  aggregates adds downsampled mean, min,
+        max and count variables at those time steps (see aggregate.Pyramid).
+        If columns is True a memory-mappable copy of each merged file's data is
+        written next to it (see columns.ColumnCache).
+    """
+
+    if output_filename is None:
+        output_filename = "merged.nc"
+        logger.info("Setting output file to %s" % output_filename)
+
+    for root, ncfiles in sensor_directories(crawl_path, output_filename):
+        logger.warn("Merging %s" % root)
+        merge_directory(root, ncfiles, output_filename, buffer_size=buffer_size, incremental=incremental, prefetch_depth=prefetch_depth, storage=storage, aggregates=aggregates, columns=columns)
 
-            # Repeat each time value by the number of verticals
-            # This turns [1,2,3] into [1,1,1,2,2,2,3,3,3] if zs.size was three.
-            # if zs.size is one, it just returns the ts array.
-            times   = np.ma.concatenate([times, np.ma.repeat(ts, zs.size)])
 
-            # Get actual verticals, repeat if necessary
-            verticals = np.ma.concatenate([verticals, np.ma.ravel(np.ma.repeat([zs], ts.size, axis=0))])
+def merge_directory(root, ncfiles, output_filename, buffer_size=None, incremental=False, prefetch_depth=0, storage=None, aggregates=None, columns=False):
+    """
+        Merge one sensor directory with append_sensor, stream_merge_sensor or
+        merge_sensor, as merge_timeseries chooses them.  The output is written
+        to a temporary file and renamed into place (see build_output).
+    """
+    with metrics.stage("merge.sensor", written=os.path.join(root, output_filename), sensor=os.path.basename(root), files=len(ncfiles)):
+        if incremental is True:
+            append_sensor(root, ncfiles, output_filename, buffer_size=buffer_size, prefetch_depth=prefetch_depth, storage=storage, aggregates=aggregates, columns=columns)
+        elif buffer_size is not None:
+            build_output(root, output_filename, lambda building: stream_merge_sensor(root, ncfiles, building, buffer_size, storage=storage, aggregates=aggregates, columns=columns))
+        else:
+            build_output(root, output_filename, lambda building: merge_sensor(root, ncfiles, building, prefetch_depth=prefetch_depth, storage=storage, aggregates=aggregates, columns=columns))
 
-            # Be sure we are on the right track...
-            assert times.size == verticals.size == values.size
 
+def read_component(path, varname, parent=None):
+    """
+        Read the data variable, time, height, location and attributes of one component file.
+        parent is the metrics stage the read belongs to if it runs in another thread.
+    """
+    with metrics.stage("merge.read", read=path, file=path, parent=parent) as stage:
+        nc = netCDF4.Dataset(path)
+        try:
+            component = dataset_component(nc, varname)
+            stage.add(samples=component['values'].size, bytes_read=metrics.nbytes(component['values'], component['times'], component['verticals']))
+            return component
+        finally:
             nc.close()
 
-        if continue_on:
+
+def dataset_component(nc, varname):
+    """
+        read_component for an open Dataset.
+    """
+    return { 'ndim'       : nc.variables[varname].ndim,
+             'globals'    : nc.__dict__,
+             'attributes' : nc.variables[varname].__dict__,
+             # This is generalized to work with both timeseries and timeseries profile.
+             'values'     : np.ma.ravel(nc.variables[varname][:]),
+             'times'      : nc.variables["time"][:],
+             'verticals'  : nc.variables["height"][:],
+             'lat'        : np.ma.ravel(nc.variables["latitude"][:])[0],
+             'lon'        : np.ma.ravel(nc.variables["longitude"][:])[0] }
+
+
+def prefetch(items, reader, depth):
+    """
+        Yield reader(item) for each item, in order, with a background thread
+        reading up to depth items ahead.  The queue between them is bounded, so
+        at most depth + 2 results are held in memory: depth in the queue, the
+        one the thread is waiting to queue and the one being used.  A single
+        thread does the reading because the netCDF/HDF5 libraries are not
+        thread safe.
+
+        When the generator finishes, fails or is closed, the thread is stopped
+        and waited for, after any read it is in the middle of.
+    """
+    results = Queue.Queue(maxsize=depth)
+    stop    = threading.Event()
+
+    def produce():
+        for item in items:
+            if stop.is_set():
+                return
+            try:
+                result = (True, reader(item))
+            except Exception:
+                result = (False, sys.exc_info())
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if stop.is_set() or not result[0]:
+                return
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        for _ in items:
+            ok, result = results.get()
+            if not ok:
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        stop.set()
+        thread.join()
+        # Drop what was read ahead and never used
+        while True:
+            try:
+                results.get_nowait()
+            except Queue.Empty:
+                break
+
+
+def read_components(root, ncfiles, varname, prefetch_depth=0, gaps=()):
+    """
+        Read and concatenate the flattened times, verticals and values of the
+        component files, along with their locations and merged attributes.
+        Returns None if the files don't agree on the data variable's dimensions.
+
+        If prefetch_depth is more than zero, that many files are read ahead in
+        the background while the current one is processed (see prefetch).
+        Missing values of the files named in gaps are left out (see merge_sensor).
+    """
+    # The prefetch thread has no stages of its own to nest the reads in
+    parent = metrics.current()
+
+    def read(f):
+        component = read_component(os.path.join(root, f), varname, parent=parent)
+        component['gaps'] = f in gaps
+        return component
+
+    if prefetch_depth > 0:
+        components = prefetch(ncfiles, read, prefetch_depth)
+    else:
+        components = (read(f) for f in ncfiles)
+    return combine_components(os.path.basename(root), components)
+
+
+def combine_components(sensor_urn, components):
+    """
+        Concatenate the component dictionaries (see read_component) of a sensor,
+        in order.  Returns what read_components does.
+    """
+    # Collect each file's arrays and concatenate once at the end, so the merge
+    # is linear in the total number of samples rather than in files * samples.
+    times   = []
+    values  = []
+    verticals = []
+    lats    = []
+    lons    = []
+    # Track attributes from every file
+    global_attributes   = {}
+    variable_attributes = {}
+
+    dims_of_values = None
+    continue_on = False
+    for component in components:
+
+        if dims_of_values is not None and dims_of_values != component['ndim']:
+            logger.warn("Error with sensor: %s.  Different dimensions on the data variable between files" % sensor_urn)
+            continue_on = True
+            break
+        dims_of_values = component['ndim']
+
+        # Update running global_attributes, overwriting any already existing key.
+        global_attributes.update(component['globals'])
+        # update running variable_attributes, overwriting any already existing key.
+        variable_attributes.update(component['attributes'])
+
+        vardata = component['values']
+        ts      = component['times']
+        zs      = component['verticals']
+
+        # Location of the station
+        lats.append(component['lat'])
+        lons.append(component['lon'])
+
+        # Repeat each time value by the number of verticals
+        # This turns [1,2,3] into [1,1,1,2,2,2,3,3,3] if zs.size was three.
+        # if zs.size is one, it just returns the ts array.
+        file_times = np.ma.repeat(ts, zs.size)
+
+        # Get actual verticals, repeat if necessary
+        file_verticals = np.ma.ravel(np.ma.repeat([zs], ts.size, axis=0))
+
+        # Be sure we are on the right track...
+        assert file_times.size == file_verticals.size == vardata.size
+
+        if component.get('gaps'):
+            present = ~np.ma.getmaskarray(vardata)
+            file_times, file_verticals, vardata = file_times[present], file_verticals[present], vardata[present]
+
+        times.append(file_times)
+        verticals.append(file_verticals)
+        values.append(vardata)
+
+    if continue_on:
+        return None
+
+    times     = np.ma.concatenate(times).astype(np.float64)
+    verticals = np.ma.concatenate(verticals).astype(np.float64)
+    values    = np.ma.concatenate(values).astype(np.float64)
+
+    return times, verticals, values, lats, lons, global_attributes, variable_attributes
+
+
+def merge_sensor(root, ncfiles, output_filename, prefetch_depth=0, storage=None, aggregates=None, columns=False, gaps=()):
+    """
+        Merge the component files in ncfiles into output_filename.  Where files
+        share a (time, vertical) the sample from the earliest file in ncfiles
+        is kept.  Missing values in the files named in gaps are treated as
+        having no sample, so later files fill them; append_sensor uses this
+        for the padding of an existing merged output.
+    """
+    sensor_urn  = os.path.basename(root)
+    station_urn = ":".join(sensor_urn.replace("sensor", "station").split(":")[0:-1])
+    varname     = sensor_urn.split(":")[-1]
+    fillvalue   = -9999.9
+
+    components = read_components(root, ncfiles, varname, prefetch_depth=prefetch_depth, gaps=gaps)
+    if components is None:
+        return
+    times, verticals, values, lats, lons, global_attributes, variable_attributes = components
+
+    if len(list(set(lats))) > 1:
+        logger.warn("%s : Some component files contained differing latitudes: %s.  Using the first." % (sensor_urn, lats))
+    if len(list(set(lons))) > 1:
+        logger.warn("%s : Some component files contained differing longitudes: %s.  Using the first." % (sensor_urn, lons))
+
+    create_timeseries_file(root, lats[0], lons[0], station_urn, sensor_urn, global_attributes, variable_attributes, data=None, times=times, values=values, verticals=verticals, fillvalue=fillvalue, output_filename=output_filename, storage=storage, aggregates=aggregates, columns=columns)
+
+    """
+    if dims_of_values == 1:
+        # Get all unique times (unique sorts them as well).  If there are duplicate times, this is
+        # selecting just one of them.  No priority here, just whatever numpy choses (first occurance most likely)
+        times, indices = np.unique(times, return_index=True)
+        values = values[indices]
+        verticals = verticals[indices]
+    elif dims_of_values == 2:
+        logger.debug("Getting unique time/vertical combinations")
+        # Get all unique time/vertical combinations and select those.
+        times_verticals  = np.ma.dstack((times, verticals))
+        outer            = times_verticals.reshape(times.size, 2)
+
+        # Unique rows in a numpy array
+        # http://stackoverflow.com/questions/16970982/find-unique-rows-in-numpy-array
+        void_to_unique = np.ascontiguousarray(outer).view(np.dtype((np.void, outer.dtype.itemsize * outer.shape[1])))
+        _, indices  = np.unique(void_to_unique, return_index=True)
+        times       = times[indices]
+        verticals   = verticals[indices]
+        values      = values[indices]
+
+        # Now sort them
+        indices     = np.lexsort((verticals,times))
+        times       = times[indices]
+        verticals   = verticals[indices]
+        values      = values[indices]
+
+    create_timeseries_file(root, lats[0], lons[0], station_urn, sensor_urn, global_attributes, variable_attributes, data=None, times=times, values=values, verticals=verticals, fillvalue=fillvalue, output_filename=output_filename)
+    """
+
+
+def _read_run_header(path, varname, fillvalue):
+    """
+        Everything the streaming merge needs to know about a component file before reading its data.
+    """
+    nc = netCDF4.Dataset(path)
+    try:
+        ts = nc.variables["time"][:]
+        zs = np.ma.masked_values(np.ma.atleast_1d(nc.variables["height"][:]).astype(np.float64), fillvalue)
+        return { 'path'       : path,
+                 'ndim'       : nc.variables[varname].ndim,
+                 'globals'    : nc.__dict__,
+                 'attributes' : nc.variables[varname].__dict__,
+                 'lat'        : np.ma.ravel(nc.variables["latitude"][:])[0],
+                 'lon'        : np.ma.ravel(nc.variables["longitude"][:])[0],
+                 'verticals'  : zs,
+                 'size'       : ts.size,
+                 'start'      : np.min(ts) if ts.size else None,
+                 'end'        : np.max(ts) if ts.size else None,
+                 'sorted'     : bool(np.all(ts[1:] >= ts[:-1])) }
+    finally:
+        nc.close()
+
+
+def _iter_run(header, varname, fillvalue, buffer_size):
+    """
+        Yield (times, verticals, values) blocks of at most buffer_size time records
+        from a component file, in time order.  A file that isn't sorted by time is
+        read whole and sorted.  Missing values are left out if header['gaps'].
+    """
+    nc = netCDF4.Dataset(header['path'])
+    try:
+        time = nc.variables["time"]
+        var  = nc.variables[varname]
+        zs   = np.ma.filled(header['verticals'], fillvalue)
+
+        if not header['sorted']:
+            # Read once and sorted in memory, the blocks below are slices of it
+            logger.warn("%s is not sorted by time, reading it whole" % header['path'])
+            order = np.argsort(time[:], kind="mergesort")
+            time  = time[:][order]
+            var   = var[:][order]
+
+        for i in xrange(0, header['size'], buffer_size):
+            ts = time[i:i + buffer_size]
+            vs = var[i:i + buffer_size]
+            ts = np.ma.filled(ts, np.nan).astype(np.float64)
+            ts, vzs, vs = np.repeat(ts, zs.size), np.tile(zs, ts.size), np.ma.ravel(vs)
+            if header['gaps']:
+                present = ~np.ma.getmaskarray(vs)
+                ts, vzs, vs = ts[present], vzs[present], vs[present]
+                if ts.size == 0:
+                    continue
+            yield ts, vzs, np.ma.filled(vs, fillvalue).astype(np.float64)
+    finally:
+        nc.close()
+
+
+def grid_samples(times, verticals, values, unique_verticals, fillvalue):
+    """
+        Sort samples on (time, vertical), keep the first of any duplicates and grid
+        them onto (unique times, unique_verticals), or onto unique times alone if
+        there is at most one vertical.  Samples with a missing height go in the
+        masked column of unique_verticals, if it has one.  Returns the unique times, the gridded
+        values and the number of samples dropped for not being on a vertical.
+    """
+    ts = np.ma.getdata(times)
+    zs = np.ma.filled(verticals, fillvalue)
+    vs = np.ma.filled(values, fillvalue)
+
+    # Sort on (time, vertical), keeping the first of any duplicates
+    indices = np.lexsort((zs, ts))
+    ts, zs, vs = ts[indices], zs[indices], vs[indices]
+    keep = np.ones(ts.size, dtype=bool)
+    keep[1:] = (ts[1:] != ts[:-1]) | (zs[1:] != zs[:-1])
+    ts, zs, vs = ts[keep], zs[keep], vs[keep]
+
+    dropped = 0
+    # Grid onto (time, vertical)
+    chunk_times, rows = np.unique(ts, return_inverse=True)
+    if unique_verticals.size <= 1:
+        grid = np.empty(chunk_times.size, dtype=np.float64)
+        grid.fill(fillvalue)
+        grid[rows] = vs
+    else:
+        columns, valid = vertical_columns(unique_verticals, zs, fillvalue)
+        dropped = int(np.count_nonzero(~valid))
+        grid = np.empty((chunk_times.size, unique_verticals.size), dtype=np.float64)
+        grid.fill(fillvalue)
+        grid[rows[valid], columns[valid]] = vs[valid]
+
+    return chunk_times, np.ma.masked_values(grid, fillvalue), dropped
+
+
+def stream_merge_sensor(root, ncfiles, output_filename, buffer_size=100000, storage=None, aggregates=None, columns=False, gaps=()):
+    """
+        Out-of-core version of merge_sensor.
+
+        Each component file is treated as a run sorted by time.  The runs are
+        k-way merged on (time, vertical) and duplicates are resolved on the fly,
+        keeping the sample from the earliest file in ncfiles like merge_sensor
+        does, and leaving out missing values of the files named in gaps.  The
+        output is appended to the unlimited time dimension in chunks.
+
+        A file is only opened once the merge reaches its first time, so for the
+        usual archive of consecutive files only a few are open at once.  Peak
+        memory is about (overlapping files + 1) * buffer_size time records.
+
+        Chunks are sized for the total number of records in the component files.
+        The range of the values isn't known up front, so they aren't packed.
+        Aggregates are built from the merged chunks as they are written.
+    """
+    sensor_urn  = os.path.basename(root)
+    station_urn = ":".join(sensor_urn.replace("sensor", "station").split(":")[0:-1])
+    varname     = sensor_urn.split(":")[-1]
+    fillvalue   = -9999.9
+
+    headers = []
+    with metrics.stage("merge.headers", sensor=sensor_urn, files=len(ncfiles)):
+        for f in ncfiles:
+            header = _read_run_header(os.path.join(root, f), varname, fillvalue)
+            if headers and headers[0]['ndim'] != header['ndim']:
+                logger.warn("Error with sensor: %s.  Different dimensions on the data variable between files" % sensor_urn)
+                return
+            header['order'] = len(headers)
+            header['gaps']  = f in gaps
+            headers.append(header)
+
+    global_attributes   = {}
+    variable_attributes = {}
+    for header in headers:
+        # Update running attributes, overwriting any already existing key.
+        global_attributes.update(header['globals'])
+        variable_attributes.update(header['attributes'])
+
+    lats = [h['lat'] for h in headers]
+    lons = [h['lon'] for h in headers]
+    if len(list(set(lats))) > 1:
+        logger.warn("%s : Some component files contained differing latitudes: %s.  Using the first." % (sensor_urn, lats))
+    if len(list(set(lons))) > 1:
+        logger.warn("%s : Some component files contained differing longitudes: %s.  Using the first." % (sensor_urn, lons))
+
+    # Sorted like merge_sensor's, with any missing height as a last, masked column
+    unique_verticals = np.ma.unique(np.ma.concatenate([h['verticals'] for h in headers]))
+
+    filepath = os.path.join(root, output_filename)
+    if os.path.exists(filepath):
+        os.unlink(filepath)
+
+    nc = netCDF4.Dataset(filepath, "w")
+    logger.debug("Opened file for writing: %s" % filepath)
+    write_globals(nc, station_urn, global_attributes)
+    nrecords = sum(h['size'] for h in headers)
+    time = create_time(nc, storage=storage, nrecords=nrecords)
+    write_metadata_variables(nc, lats[0], lons[0], station_urn, sensor_urn, global_attributes)
+    var = create_vertical_and_values(nc, varname, unique_verticals, variable_attributes, fillvalue, storage=storage, nrecords=nrecords)
+    sized = [h for h in headers if h['size'] > 0]
+    span = (min(h['start'] for h in sized), max(h['end'] for h in sized)) if sized else None
+    pyramid = Pyramid(nc, varname, aggregates or [], fillvalue=fillvalue, storage=storage, span=span)
+
+    # Runs in the order the merge reaches them
+    waiting = deque(sorted((h for h in headers if h['size'] > 0), key=lambda h: (h['start'], h['order'])))
+    # order -> [block iterator, buffered (times, verticals, values), exhausted]
+    active  = {}
+
+    written     = 0
+    first_time  = None
+    last_time   = None
+    diff_counts = {}
+    dropped     = 0
+
+    def fill(run):
+        # Read another block onto the end of the run's buffer
+        try:
+            block = next(run[0])
+        except StopIteration:
+            run[2] = True
+            return
+        run[1] = tuple(np.concatenate([b, n]) for b, n in zip(run[1], block))
+
+    while waiting or active:
+        # Everything before the frontier has been read from every run that can contain it
+        while True:
+            for order, run in active.items():
+                if run[1][0].size == 0 and not run[2]:
+                    fill(run)
+                if run[1][0].size == 0 and run[2]:
+                    del active[order]
+            ends = [run[1][0][-1] for run in active.itervalues() if not run[2]]
+            frontier = min(ends) if ends else np.inf
+            if waiting and waiting[0]['start'] <= frontier:
+                header = waiting.popleft()
+                empty  = np.empty(0, dtype=np.float64)
+                active[header['order']] = [_iter_run(header, varname, fillvalue, buffer_size), (empty, empty, empty), False]
+                continue
+            if waiting:
+                frontier = min(frontier, waiting[0]['start'])
+            break
+
+        # Take every buffered sample before the frontier, in file order
+        pieces = []
+        for order in sorted(active.keys()):
+            run = active[order]
+            n = np.searchsorted(run[1][0], frontier, side="left")
+            if n > 0:
+                pieces.append(tuple(b[:n] for b in run[1]))
+                run[1] = tuple(b[n:] for b in run[1])
+
+        if not pieces:
+            # Every buffer starts at the frontier, so read further in those runs
+            for run in active.itervalues():
+                if not run[2] and run[1][0][-1] == frontier:
+                    fill(run)
             continue
 
-        if len(list(set(lats))) > 1:
-            logger.warn("%s : Some component files contained differing latitudes: %s.  Using the first." % (sensor_urn, lats))
-        if len(list(set(lons))) > 1:
-            logger.warn("%s : Some component files contained differing longitudes: %s.  Using the first." % (sensor_urn, lons))
-
-        create_timeseries_file(root, lats[0], lons[0], station_urn, sensor_urn, global_attributes, variable_attributes, data=None, times=times, values=values, verticals=verticals, fillvalue=fillvalue, output_filename=output_filename)
-
-        """
-        if dims_of_values == 1:
-            # Get all unique times (unique sorts them as well).  If there are duplicate times, this is
-            # selecting just one of them.  No priority here, just whatever numpy choses (first occurance most likely)
-            times, indices = np.unique(times, return_index=True)
-            values = values[indices]
-            verticals = verticals[indices]
-        elif dims_of_values == 2:
-            logger.debug("Getting unique time/vertical combinations")
-            # Get all unique time/vertical combinations and select those.
-            times_verticals  = np.ma.dstack((times, verticals))
-            outer            = times_verticals.reshape(times.size, 2)
-
-            # Unique rows in a numpy array
-            # http://stackoverflow.com/questions/16970982/find-unique-rows-in-numpy-array
-            void_to_unique = np.ascontiguousarray(outer).view(np.dtype((np.void, outer.dtype.itemsize * outer.shape[1])))
-            _, indices  = np.unique(void_to_unique, return_index=True)
-            times       = times[indices]
-            verticals   = verticals[indices]
-            values      = values[indices]
-
-            # Now sort them
-            indices     = np.lexsort((verticals,times))
-            times       = times[indices]
-            verticals   = verticals[indices]
-            values      = values[indices]
-
-        create_timeseries_file(root, lats[0], lons[0], station_urn, sensor_urn, global_attributes, variable_attributes, data=None, times=times, values=values, verticals=verticals, fillvalue=fillvalue, output_filename=output_filename)
-        """
+        ts, zs, vs = [np.concatenate(p) for p in zip(*pieces)]
+
+        with metrics.stage("merge.chunk", sensor=sensor_urn, file=filepath) as stage:
+            chunk_times, grid, n = grid_samples(ts, zs, vs, unique_verticals, fillvalue)
+            dropped += n
+
+            time[written:written + chunk_times.size] = chunk_times
+            var[written:written + chunk_times.size]  = grid
+            written += chunk_times.size
+            pyramid.add(chunk_times, grid)
+            stage.add(samples=ts.size, records=chunk_times.size)
+
+        # Adjacent time differences, for time_coverage_resolution
+        if last_time is not None:
+            diffs = np.diff(np.concatenate([[last_time], chunk_times]))
+        else:
+            diffs = np.diff(chunk_times)
+            first_time = chunk_times[0]
+        last_time = chunk_times[-1]
+        uniqs, inverse = np.unique(diffs, return_inverse=True)
+        for d, c in zip(uniqs, np.bincount(inverse)):
+            diff_counts[d] = diff_counts.get(d, 0) + c
+
+    if dropped:
+        logger.warn("%s : Dropped %d samples without a valid height" % (sensor_urn, dropped))
+
+    # Ain't got no data!
+    if written < 2:
+        nc.close()
+        os.unlink(filepath)
+        logger.error("Skipping: %s, no time!" % sensor_urn)
+        return
+
+    set_time_coverage(nc, np.asarray([first_time, last_time]), diff_counts=diff_counts)
+    pyramid.close()
+    nc.close()
+
+    if columns is True:
+        write_columns(filepath, varname)
+
+
+def _file_stats(root, ncfiles):
+    stats = {}
+    for f in ncfiles:
+        st = os.stat(os.path.join(root, f))
+        stats[f] = [st.st_size, st.st_mtime]
+    return stats
+
+
+def _count_diffs(times, diff_counts):
+    uniqs, inverse = np.unique(np.diff(times), return_inverse=True)
+    for d, c in zip(uniqs, np.bincount(inverse)):
+        diff_counts[float(d)] = diff_counts.get(float(d), 0) + int(c)
+    return diff_counts
+
+
+def _write_manifest(manifest_path, inputs, diff_counts):
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({ 'inputs'      : inputs,
+                    'diff_counts' : sorted(diff_counts.items()) }, f)
+    os.rename(tmp, manifest_path)
+
+
+def build_output(root, output_filename, build):
+    """
+        Call build with a temporary filename next to output_filename in root,
+        and rename the file it writes (and its column file) over output_filename
+        once it returns.  A build that fails or is killed leaves the existing
+        output as it was.  Returns False if build didn't write anything.
+    """
+    building      = "%s.%d.tmp" % (output_filename, os.getpid())
+    building_path = os.path.join(root, building)
+    filepath      = os.path.join(root, output_filename)
+    try:
+        build(building)
+        if not os.path.exists(building_path):
+            return False
+        os.rename(building_path, filepath)
+        if os.path.exists(column_path(building_path)):
+            os.rename(column_path(building_path), column_path(filepath))
+        return True
+    finally:
+        for leftover in (building_path, column_path(building_path)):
+            if os.path.exists(leftover):
+                os.unlink(leftover)
+
+
+def append_sensor(root, ncfiles, output_filename, buffer_size=None, prefetch_depth=0, storage=None, aggregates=None, columns=False):
+    """
+        Bring output_filename up to date with the component files in ncfiles,
+        reading only the ones it doesn't already contain.
+
+        The component files merged into output_filename, with their size and mtime,
+        are recorded next to it in "<output_filename>.inputs.json".  New files whose
+        samples all come after the last merged time, on heights the output already
+        has, are appended to a copy of the output and the globals are updated.
+        Otherwise the existing output and the new files are merged into a new
+        output, as they are when new values fall outside what a packed output
+        can hold.  If a recorded file changed or disappeared the output is
+        rebuilt from every file.  storage is used for outputs that are written
+        from scratch.
+
+        Every new output is written next to the existing one and renamed over
+        it when it is complete, and the manifest is only updated after that,
+        so an append that fails or is killed leaves both as they were.
+
+        The aggregates of an appended output are updated from the new samples
+        only.  It is rebuilt if it doesn't have the aggregates asked for.  With
+        columns the column file is rewritten whenever the output changes, or
+        written if it is missing or out of date.
+    """
+    sensor_urn    = os.path.basename(root)
+    varname       = sensor_urn.split(":")[-1]
+    fillvalue     = -9999.9
+    filepath      = os.path.join(root, output_filename)
+    manifest_path = filepath + ".inputs.json"
+    stats         = _file_stats(root, ncfiles)
+    def rebuild(files, output=output_filename, gaps=()):
+        if buffer_size is not None:
+            stream_merge_sensor(root, files, output, buffer_size, storage=storage, aggregates=aggregates, columns=columns, gaps=gaps)
+        else:
+            merge_sensor(root, files, output, prefetch_depth=prefetch_depth, storage=storage, aggregates=aggregates, columns=columns, gaps=gaps)
+
+    def finish():
+        if not os.path.exists(filepath):
+            return
+        nc = netCDF4.Dataset(filepath)
+        diff_counts = _count_diffs(nc.variables["time"][:], {})
+        nc.close()
+        _write_manifest(manifest_path, stats, diff_counts)
+
+    def rebuild_all():
+        logger.info("%s : Rebuilding %s from all component files" % (sensor_urn, output_filename))
+        build_output(root, output_filename, lambda building: rebuild(ncfiles, output=building))
+        finish()
+
+    manifest = None
+    if os.path.exists(manifest_path) and os.path.exists(filepath):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        nc = netCDF4.Dataset(filepath)
+        var = nc.variables[varname]
+        steps = sorted(np.atleast_1d(var.getncattr(STEPS_ATTRIBUTE)).tolist()) if STEPS_ATTRIBUTE in var.ncattrs() else []
+        nc.close()
+        if steps != sorted(set(step_seconds(s) for s in aggregates or [])):
+            logger.info("%s : Aggregates of %s changed" % (sensor_urn, output_filename))
+            manifest = None
+
+    if manifest is None or any(stats.get(f) != v for f, v in manifest['inputs'].iteritems()):
+        rebuild_all()
+        return
+
+    new = sorted(f for f in ncfiles if f not in manifest['inputs'])
+    if not new:
+        logger.info("%s : %s is up to date" % (sensor_urn, output_filename))
+        if columns is True and ColumnCache.open(filepath) is None:
+            write_columns(filepath, varname)
+        return
+
+    components = read_components(root, new, varname, prefetch_depth=prefetch_depth)
+    if components is None:
+        return
+    times, verticals, values, lats, lons, global_attributes, variable_attributes = components
+
+    nc  = netCDF4.Dataset(filepath)
+    time = nc.variables["time"]
+    var  = nc.variables[varname]
+    # Missing heights stay in, a profile can have a column for them
+    existing_verticals = np.ma.masked_values(np.ma.atleast_1d(nc.variables["height"][:]).astype(np.float64), fillvalue)
+    new_verticals      = np.ma.unique(np.ma.masked_values(verticals, fillvalue))
+
+    if var.ndim == 1:
+        # A timeSeries ignores the heights of its samples if it has none itself
+        heights = existing_verticals.compressed()
+        fits = new_verticals.count() == 0 or (heights.size == 1 and np.all(new_verticals.compressed() == heights[0]))
+    else:
+        fits = np.all(np.in1d(np.ma.filled(new_verticals, fillvalue), np.ma.filled(existing_verticals, fillvalue)))
+
+    if fits and "scale_factor" in var.ncattrs():
+        lowest, highest = packed_range(var.scale_factor, getattr(var, "add_offset", 0.))
+        new_values = np.ma.masked_values(values, fillvalue).compressed()
+        fits = new_values.size == 0 or (new_values.min() >= lowest and new_values.max() <= highest)
+
+    overlaps = time.size == 0 or np.min(times) <= time[-1]
+    nc.close()
+
+    if not fits or overlaps:
+        logger.info("%s : New data overlaps, adds heights or is out of the packed range, merging it with %s" % (sensor_urn, output_filename))
+        # The existing output's samples win over the new files' like the files
+        # it came from would, except where it only has padding.
+        if not build_output(root, output_filename, lambda building: rebuild([output_filename] + new, output=building, gaps=[output_filename])):
+            # The output's dimensions don't match the new files'
+            rebuild_all()
+        else:
+            finish()
+        return
+
+    logger.info("%s : Appending %d files to %s" % (sensor_urn, len(new), output_filename))
+    metrics.current().add(appended_files=len(new), samples=values.size)
+    chunk_times, grid, dropped = grid_samples(times, verticals, values, existing_verticals if var.ndim > 1 else np.zeros(0), fillvalue)
+    if dropped:
+        logger.warn("%s : Dropped %d samples without a valid height" % (sensor_urn, dropped))
+
+    diff_counts = dict(manifest['diff_counts'])
+
+    def append(building):
+        # Appends to a copy, a partly written append couldn't be taken back
+        building_path = os.path.join(root, building)
+        shutil.copyfile(filepath, building_path)
+        nc = netCDF4.Dataset(building_path, "a")
+        try:
+            time = nc.variables["time"]
+            var  = nc.variables[varname]
+            n = time.size
+            _count_diffs(np.concatenate([[time[-1]], chunk_times]), diff_counts)
+
+            time[n:n + chunk_times.size] = chunk_times
+            var[n:n + chunk_times.size]  = grid
+            pyramid = Pyramid(nc, varname, fillvalue=fillvalue)
+            pyramid.add(chunk_times, grid)
+            pyramid.close()
+
+            # Update the globals and data variable attributes from the new files
+            for k, v in global_attributes.iteritems():
+                if k not in GLOBAL_SKIPS:
+                    nc.setncattr(k, "None" if v is None else v)
+            for k, v in variable_attributes.iteritems():
+                if k not in STORAGE_SKIPS + ['coordinates', 'standard_name']:
+                    var.setncattr(k, v)
+            set_time_coverage(nc, np.asarray([time[0], chunk_times[-1]]), diff_counts=diff_counts)
+        finally:
+            nc.close()
+
+        if columns is True:
+            write_columns(building_path, varname)
+
+    build_output(root, output_filename, append)
+    manifest['inputs'].update((f, stats[f]) for f in new)
+    _write_manifest(manifest_path, manifest['inputs'], diff_counts)
+
+
+# Rough ratio of a merge's peak memory to the size of its component files on disk
+MEMORY_FACTOR = 4
+
+
+def _job_summary(root, ncfiles, error=None):
+    return { 'sensor'    : os.path.basename(root),
+             'directory' : root,
+             'files'     : len(ncfiles),
+             'records'   : 0,
+             'seconds'   : 0.,
+             'error'     : error }
+
+
+def _merge_job(args):
+    """
+        Worker for merge_timeseries_parallel.  Merges one sensor directory and
+        reports how it went instead of raising.
+    """
+    root, ncfiles, output_filename, buffer_size, incremental, prefetch_depth, storage, aggregates, columns = args
+    result = _job_summary(root, ncfiles)
+    started = time.time()
+    try:
+        merge_directory(root, ncfiles, output_filename, buffer_size=buffer_size, incremental=incremental, prefetch_depth=prefetch_depth, storage=storage, aggregates=aggregates, columns=columns)
+        filepath = os.path.join(root, output_filename)
+        if os.path.exists(filepath):
+            nc = netCDF4.Dataset(filepath)
+            result['records'] = len(nc.dimensions["time"])
+            nc.close()
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - started
+    return result
+
+
+def merge_timeseries_parallel(crawl_path, output_filename=None, processes=None, max_memory=None, buffer_size=None, incremental=False, prefetch_depth=0, storage=None, aggregates=None, columns=False, timeout=None):
+    """
+        merge_timeseries with sensors merged concurrently, each in its own
+        worker process (see jobs.run_jobs).
+
+        Sensors are started largest first (by the size of their component files)
+        so a big one doesn't end up running alone at the end.  If max_memory (bytes)
+        is set, a sensor is only started while the estimated memory of the running
+        merges stays under it; one that can't fit on its own runs alone.  The
+        estimate is MEMORY_FACTOR times the component file sizes, or buffer_size
+        records per file with the streaming merge.
+
+        A failing sensor is logged and doesn't stop the others.  Neither does a
+        sensor whose worker process dies (killed, out of memory, crashed in the
+        netCDF library) or one still running timeout seconds after its merge
+        started, if timeout is set, which is killed.  Those are reported as
+        errors.  Outputs are renamed into place when they are complete, so a
+        killed merge leaves the previous output.  Returns a summary
+        dictionary (sensor, directory, files, bytes, records, seconds, error) per sensor,
+        largest first.
+    """
+    if output_filename is None:
+        output_filename = "merged.nc"
+        logger.info("Setting output file to %s" % output_filename)
+    jobs  = []
+    sizes = {}
+    files = {}
+    for root, ncfiles in sensor_directories(crawl_path, output_filename):
+        sizes[root] = sum(os.path.getsize(os.path.join(root, f)) for f in ncfiles)
+        files[root] = ncfiles
+        estimate = sizes[root] * MEMORY_FACTOR
+        if buffer_size is not None:
+            estimate = min(estimate, buffer_size * len(ncfiles) * 8 * 3 * MEMORY_FACTOR)
+        jobs.append((root, (root, ncfiles, output_filename, buffer_size, incremental, prefetch_depth, storage, aggregates, columns), estimate))
+    jobs.sort(key=lambda job: sizes[job[0]], reverse=True)
+
+    results = {}
+    for directory, result, error in run_jobs(_merge_job, jobs, processes=processes, timeout=timeout, capacity=max_memory):
+        if result is None:
+            # The worker died or was killed before it could report, and may
+            # have left a half written output behind
+            result = _job_summary(directory, files[directory], error=error)
+            temporary = re.compile(r"^%s\.\d+\.tmp(%s)?$" % (re.escape(output_filename), re.escape(COLUMN_SUFFIX)))
+            for name in os.listdir(directory):
+                if temporary.match(name):
+                    os.unlink(os.path.join(directory, name))
+        result['bytes'] = sizes[directory]
+        results[directory] = result
+        if result['error'] is not None:
+            logger.error("Failed to merge %s:\n%s" % (result['sensor'], result['error']))
+        else:
+            logger.info("Merged %s: %d files, %d records in %.2fs" % (result['sensor'], result['files'], result['records'], result['seconds']))
+
+    return [results[job[0]] for job in jobs]
@@ -3,19 +3,202 @@
 
 import os
 import json
+import multiprocessing
 from datetime import datetime
 
 import netCDF4
 from lxml import etree
 
+from .. import metrics
+
 import logging
 logger = logging.getLogger()
 logger.addHandler(logging.NullHandler())
 
+NCML_NAMESPACE = "http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2"
+
+# Per sensor directory cache of the time coordinates of its files
+CACHE_FILENAME = ".ncml_cache.json"
+
+# Files with more time values than this only get ncoords in the aggregation, not coordValue
+MAX_COORD_VALUES = 10000
+
+
+def read_time_coordinates(filepath, max_values=MAX_COORD_VALUES):
+    """
+        Number, first and last value and units of the time coordinate of a file,
+        and the values themselves if there are at most max_values of them.
+    """
+    with metrics.stage("ncml.read", read=filepath, file=filepath) as stage:
+        nc = netCDF4.Dataset(filepath)
+        try:
+            entry = dataset_time_coordinates(nc, max_values=max_values)
+            stage.add(bytes_read=entry['ncoords'] * nc.variables["time"].dtype.itemsize)
+            return entry
+        finally:
+            nc.close()
+
+
+def dataset_time_coordinates(nc, max_values=MAX_COORD_VALUES):
+    """
+        read_time_coordinates for an open Dataset.
+    """
+    time = nc.variables["time"]
+    return coordinates_entry(time[:], getattr(time, "units", None), max_values=max_values)
+
+
+def coordinates_entry(values, units, max_values=MAX_COORD_VALUES):
+    """
+        Time coordinate cache entry from the time values of a file, see read_time_coordinates.
+    """
+    entry = { 'ncoords' : int(values.size),
+              'start'   : float(values[0]) if values.size else None,
+              'end'     : float(values[-1]) if values.size else None,
+              'units'   : units }
+    if values.size <= max_values:
+        entry['values'] = [float(v) for v in values]
+    return entry
+
+
+def atomic_write(path, text):
+    """
+        Write text to path through a temporary file in the same directory and a
+        rename, so readers see either the old or the new file, never part of one.
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def load_time_cache(root):
+    """
+        Cache of a sensor directory: {'files' : {filename: entry}, 'fingerprint' : ...}.
+        See read_time_coordinates for the entries and fingerprint for the fingerprint.
+    """
+    try:
+        with open(os.path.join(root, CACHE_FILENAME)) as f:
+            cache = json.load(f)
+        assert isinstance(cache.get('files'), dict)
+        return cache
+    except (IOError, ValueError, AssertionError):
+        return { 'files' : {}, 'fingerprint' : None }
+
+
+def save_time_cache(root, cache):
+    atomic_write(os.path.join(root, CACHE_FILENAME), json.dumps(cache))
+
+
+def fingerprint(root, files, *options):
+    """
+        Sorted [name, size, mtime] of files in root, followed by options, as a
+        JSON-comparable list.
+    """
+    stats = []
+    for f in sorted(files):
+        st = os.stat(os.path.join(root, f))
+        stats.append([f, st.st_size, st.st_mtime])
+    return [stats, list(options)]
 
-def create_ncml(output_path, output_filename=None, target_file=None):
+
+def time_coordinates(root, files, cache=None, max_values=MAX_COORD_VALUES):
+    """
+        {filename: entry} for files in root, see read_time_coordinates.  A file is
+        only opened if it isn't in cache with the same size and mtime.
+    """
+    cache = cache or {}
+    found = {}
+    for f in files:
+        st = os.stat(os.path.join(root, f))
+        entry = cache.get(f)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            entry = read_time_coordinates(os.path.join(root, f), max_values=max_values)
+            entry['size']  = st.st_size
+            entry['mtime'] = st.st_mtime
+        found[f] = entry
+    return found
+
+
+def sensor_ncml(root, files, output_filename=None, target_file=None, max_coord_values=MAX_COORD_VALUES, force=False):
+    """
+        Write the NcML file of one sensor directory, see create_ncml.  Returns
+        (NcML path or None if there is none, True if it was written).
+    """
+    sensor_urn = os.path.basename(root)
+    outfile = output_filename
+    if outfile is None:
+        outfile = "%s.ncml" % sensor_urn
+    outpath = os.path.join(root, outfile)
+
+    cache = load_time_cache(root)
+    current = fingerprint(root, files, outfile, target_file, max_coord_values)
+    # JSON round trip, so it compares equal to the stored one
+    current = json.loads(json.dumps(current))
+    if not force and cache['fingerprint'] == current and os.path.exists(outpath):
+        logger.debug("%s is up to date" % outpath)
+        return outpath, False
+
+    # Now we need to figure out the entire time duration for all NetCDF files so we can
+    # update the new global attributes to the NcML file.
+    # Use the "target_file" if it is available
+    coordinates = time_coordinates(root, [target_file] if target_file is not None else files, cache['files'], max_values=max_coord_values)
+    cached = dict((f, c) for f, c in cache['files'].iteritems() if f in files)
+    cached.update(coordinates)
+
+    starting   = [c['start'] for c in coordinates.itervalues() if c['start'] is not None]
+    ending     = [c['end'] for c in coordinates.itervalues() if c['end'] is not None]
+    if not starting:
+        logger.warn("No times in the files of %s, skipping!" % root)
+        save_time_cache(root, { 'files' : cached, 'fingerprint' : None })
+        return None, False
+    starting   = datetime.utcfromtimestamp(min(starting))
+    ending     = datetime.utcfromtimestamp(max(ending))
+
+    atomic_write(outpath, get_ncml_text(root, sensor_urn, starting, ending, target_file, coordinates=coordinates))
+    # Only record the fingerprint once the NcML matching it is in place
+    save_time_cache(root, { 'files' : cached, 'fingerprint' : current })
+    logger.info("Finished writing: %s" % outpath)
+    return outpath, True
+
+
+def _ncml_job(args):
+    root, files, output_filename, target_file, max_coord_values, force = args
+    with metrics.stage("ncml.sensor", sensor=os.path.basename(root), files=len(files)) as stage:
+        path, written = sensor_ncml(root, files, output_filename=output_filename, target_file=target_file, max_coord_values=max_coord_values, force=force)
+        stage.set(written=path, changed=written)
+        return path, written
+
+
+def create_ncml(output_path, output_filename=None, target_file=None, max_coord_values=MAX_COORD_VALUES, processes=None, force=False, merged_filename="merged.nc", list_path="ncml_files.json"):
+    """
+        Write an NcML file into every sensor directory under output_path.
+
+        With target_file the NcML points at that file.  Otherwise it is a
+        joinExisting aggregation on time of every NetCDF file in the directory,
+        with each file's ncoords and, for files with at most max_coord_values
+        times, its coordValue list, so THREDDS doesn't have to open the files to
+        build the time coordinate.  merged_filename, the output of
+        merge_timeseries, holds the same times as the files it was merged from,
+        so it is left out of the aggregation.
+
+        The time coordinates of the files are cached in a .ncml_cache.json file
+        in each sensor directory and a file is only reopened when its size or
+        mtime changed.  The cache also holds a fingerprint of the directory (the
+        names, sizes and mtimes of its files and the options), and a directory
+        whose fingerprint is unchanged is skipped unless force is True.
+
+        If processes is set, the directories are handled by a pool of that many
+        worker processes.  Every file is written to a temporary file and renamed
+        into place, so THREDDS never reads a partly written one.  The list of NcML
+        files is written to list_path, ncml_files.json in the working directory
+        by default.  It is sorted and only rewritten when it changes.
+    """
     # Crawl output_path for sensor directories and create an NcML file in them
-    ncml_files = []
+    jobs = []
     for root, dirs, files in os.walk(output_path):
         try:
             # Make sure we are in a sensor directory
@@ -23,51 +206,60 @@ def create_ncml(output_path, output_filename=None, target_file=None):
             # Make sure we have at least one NetCDF file in the directory
             files = [ncfile for ncfile in files if os.path.splitext(ncfile)[-1][0:3] == ".nc" and os.path.splitext(ncfile)[-1][0:5] != ".ncml"]
             if target_file is not None and target_file not in files:
-                logger.warn("No target file (%s) found in %s, skipping!", (target_file, root))
+                logger.warn("No target file (%s) found in %s, skipping!" % (target_file, root))
                 continue
+            if target_file is None:
+                files = [ncfile for ncfile in files if ncfile != merged_filename]
             assert len(files) > 0
         except (IndexError, AssertionError):
             # Not a sensor directory, or no NetCDF files in folder.  Keep moving!
             continue
+        jobs.append((root, files, output_filename, target_file, max_coord_values, force))
 
-        # Now we need to figure out the entire time duration for all NetCDF files so we can
-        # update the new global attributes to the NcML file.
-        starting = []
-        ending   = []
-        # Use the "target_file" if it is available
-        if target_file is not None:
-            nc = netCDF4.Dataset(os.path.join(root, target_file))
-            starting.append(nc.variables["time"][0])
-            ending.append(nc.variables["time"][-1])
-            nc.close()
-        else:
-            for f in files:
-                nc = netCDF4.Dataset(os.path.join(root, f))
-                starting.append(nc.variables["time"][0])
-                ending.append(nc.variables["time"][-1])
-                nc.close()
-
-        sensor_urn = os.path.basename(root)
-        starting   = datetime.utcfromtimestamp(min(starting))
-        ending     = datetime.utcfromtimestamp(max(ending))
-
-        outfile = output_filename
-        if outfile is None:
-            outfile = "%s.ncml" % sensor_urn
-
-        with open(os.path.join(root, outfile), "w") as ncml:
-            ncml.write(get_ncml_text(root, sensor_urn, starting, ending, target_file))
-            ncml_files.append(os.path.join(root, outfile))
-            logger.info("Finished writing: %s" % os.path.join(root, outfile))
+    if processes is None:
+        results = [_ncml_job(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(_ncml_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    ncml_files = sorted(path for path, written in results if path is not None)
+    logger.info("NcML files: %d written, %d unchanged" % (sum(1 for path, written in results if written), sum(1 for path, written in results if path is not None and not written)))
 
     # Write out a list of NCML files
-    with open("ncml_files.json", "w") as ncmlout:
-        ncmlout.write(json.dumps(ncml_files))
+    text = json.dumps(ncml_files)
+    try:
+        with open(list_path) as ncmlin:
+            unchanged = ncmlin.read() == text
+    except IOError:
+        unchanged = False
+    if not unchanged:
+        atomic_write(list_path, text)
+
 
+def get_ncml_text(path, sensor_urn, starting, ending, target_file, coordinates=None):
+    """
+        NcML pointing at target_file, or if it is None a joinExisting aggregation
+        of the files in coordinates ({filename: entry}, see time_coordinates)
+        ordered by their first time.  coordValue is written for the files whose
+        values are known, as long as every file has the same time units.
+    """
+    netcdf = etree.Element("{%s}netcdf" % NCML_NAMESPACE, nsmap={ None : NCML_NAMESPACE })
+    for name, value in (("time_coverage_start", starting), ("time_coverage_end", ending)):
+        etree.SubElement(netcdf, "{%s}attribute" % NCML_NAMESPACE, name=name, value=value.strftime("%Y-%m-%dT%H:%M:%SZ"))
 
-def get_ncml_text(path, sensor_urn, starting, ending, target_file):
+    if target_file is not None:
+        netcdf.set("location", target_file)
+    else:
+        entries = sorted(((f, c) for f, c in coordinates.iteritems() if c['ncoords'] > 0), key=lambda x: (x[1]['start'], x[0]))
+        same_units  = len(set(c['units'] for f, c in entries)) == 1
+        aggregation = etree.SubElement(netcdf, "{%s}aggregation" % NCML_NAMESPACE, dimName="time", type="joinExisting")
+        for f, c in entries:
+            nested = etree.SubElement(aggregation, "{%s}netcdf" % NCML_NAMESPACE, location=f, ncoords=str(c['ncoords']))
+            if same_units and 'values' in c:
+                nested.set("coordValue", " ".join(repr(v) for v in c['values']))
 
-    fillvars = { 'target_file' : target_file }
-    text = """<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" location="%(target_file)s"></netcdf>""" % fillvars
-    # Normalize XML by passing through lxml
-    return etree.tostring(etree.XML(unicode(text)), pretty_print=True, xml_declaration=True, encoding='UTF-8')
+    return etree.tostring(netcdf, pretty_print=True, xml_declaration=True, encoding='UTF-8')
@@ -0,0 +1,174 @@
+#!python
+# coding=utf-8
+
+import os
+import multiprocessing
+
+import netCDF4
+import numpy as np
+
+from .. import metrics
+from .crawl import crawl, dataset_header, map_header, write_jsonl, copy_component
+from .transfer import COPY
+from .merge import dataset_component, combine_components
+from .create import create_timeseries_file
+from .ncml import dataset_time_coordinates, coordinates_entry, load_time_cache, save_time_cache, sensor_ncml, MAX_COORD_VALUES
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+# Units of the time variable create_timeseries_file writes
+TIME_UNITS = "seconds since 1970-01-01T00:00:00Z"
+
+
+def read_source(filepath, max_coord_values=MAX_COORD_VALUES):
+    """
+        Everything the pipeline needs from a source file, read with one open:
+        (filepath, header, component, time coordinates).  See crawl.read_header,
+        merge.read_component and ncml.read_time_coordinates.
+    """
+    with metrics.stage("pipeline.read", read=filepath, file=filepath) as stage:
+        nc = netCDF4.Dataset(filepath)
+        try:
+            header    = dataset_header(nc)
+            component = dataset_component(nc, header['sensor_urn'].split(":")[-1])
+            stage.add(samples=component['values'].size, bytes_read=metrics.nbytes(component['values'], component['times'], component['verticals']))
+            return (filepath,
+                    header,
+                    component,
+                    dataset_time_coordinates(nc, max_values=max_coord_values))
+        finally:
+            nc.close()
+
+
+def _read_source_job(args):
+    return read_source(*args)
+
+
+def _ncml_files(root):
+    return [f for f in os.listdir(root) if os.path.splitext(f)[-1][0:3] == ".nc" and os.path.splitext(f)[-1][0:5] != ".ncml"]
+
+
+def run_pipeline(crawl_paths, authority_map, station_map, output_path, output_filename="merged.nc", perform_copy=False, copy_strategy=COPY, skip_unchanged=False, checksum=False,
+                 processes=None, records_path=None, storage=None, aggregates=None, columns=False, ncml=True, ncml_filename=None, max_coord_values=MAX_COORD_VALUES, index_path=None):
+    """
+        crawl_and_copy, merge_timeseries and create_ncml in one pass over the
+        source files under crawl_paths.
+
+        The headers are crawled first (see crawl.crawl, with index_path as its
+        header cache) to group the files by sensor.  Then one sensor at a time,
+        each file's data and time coordinate are read together (by a pool of
+        processes workers if processes is set) and the file is copied into
+        output_path/<mapped sensor URN>/ if perform_copy is True (see crawl.crawl
+        for the copy options).  The sensor's data is merged into output_filename
+        in its directory, like merge_sensor does, but from the arrays already in
+        memory, and released before the next sensor is read.  Files are merged
+        in path order.
+
+        If ncml is True an NcML file pointing at the merged file is written next
+        to it (see ncml.sensor_ncml).  The NcML time cache of the directory is
+        filled from the arrays already read, both for the merged file and for the
+        copies, so neither this nor a later create_ncml run reopens them.
+
+        storage, aggregates and columns are passed on to create_timeseries_file.
+
+        If records_path is set, the crawl records are written there as JSON lines
+        (see crawl.write_jsonl) instead of passing through sensor_files.json.
+
+        Only one sensor's data is held in memory at a time.  Returns a summary
+        dictionary (sensor, directory, files, records, ncml) per sensor.
+    """
+    records = list(crawl(crawl_paths, authority_map, station_map, index_path=index_path, processes=processes))
+    if records_path is not None:
+        write_jsonl(records, records_path)
+
+    sensors = {}
+    for meta in records:
+        sensors.setdefault(meta['mapped_sensor'], []).append(meta['file'])
+
+    pool = None
+    if processes is not None:
+        pool = multiprocessing.Pool(processes=processes)
+    try:
+        summary = []
+        for sensor_urn in sorted(sensors.keys()):
+            paths = sorted(sensors.pop(sensor_urn))
+            if pool is None:
+                sources = (read_source(p, max_coord_values) for p in paths)
+            else:
+                sources = pool.imap(_read_source_job, [(p, max_coord_values) for p in paths])
+            summary.append(_merge_sources(sources, authority_map, station_map, output_path, output_filename, perform_copy, copy_strategy, skip_unchanged, checksum,
+                                          storage, aggregates, columns, ncml, ncml_filename, max_coord_values))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return summary
+
+
+def _merge_sources(sources, authority_map, station_map, output_path, output_filename, perform_copy, copy_strategy, skip_unchanged, checksum,
+                   storage, aggregates, columns, ncml, ncml_filename, max_coord_values):
+    """
+        Copy, merge and write the NcML of the read_source results of one sensor
+        for run_pipeline.  Returns the sensor's summary dictionary.
+    """
+    items = []
+    for filepath, header, component, coordinates in sources:
+        meta = map_header(filepath, header, authority_map, station_map)
+
+        sensor_path = os.path.join(output_path, meta['mapped_sensor'])
+        if not os.path.exists(sensor_path):
+            os.makedirs(sensor_path)
+
+        copied = None
+        if perform_copy is True:
+            copied = os.path.join(sensor_path, os.path.basename(filepath))
+            logger.debug("Copying '%s' to '%s'." % (filepath, copied))
+            copy_component(filepath, copied, strategy=copy_strategy, skip_unchanged=skip_unchanged, checksum=checksum)
+
+        items.append((meta, component, coordinates, copied))
+
+    sensor_urn  = items[0][0]['mapped_sensor']
+    sensor_path = os.path.join(output_path, sensor_urn)
+    station_urn = items[0][0]['mapped_station']
+    result = { 'sensor'    : sensor_urn,
+               'directory' : sensor_path,
+               'files'     : len(items),
+               'records'   : 0,
+               'ncml'      : None }
+
+    logger.warn("Merging %s" % sensor_urn)
+    combined = combine_components(sensor_urn, (component for meta, component, coordinates, copied in items))
+    if combined is None:
+        return result
+    times, verticals, values, lats, lons, global_attributes, variable_attributes = combined
+    if len(list(set(lats))) > 1:
+        logger.warn("%s : Some component files contained differing latitudes: %s.  Using the first." % (sensor_urn, lats))
+    if len(list(set(lons))) > 1:
+        logger.warn("%s : Some component files contained differing longitudes: %s.  Using the first." % (sensor_urn, lons))
+
+    filepath = os.path.join(sensor_path, output_filename)
+    create_timeseries_file(sensor_path, lats[0], lons[0], station_urn, sensor_urn, global_attributes, variable_attributes, times=times, verticals=verticals, values=values, output_filename=output_filename, storage=storage, aggregates=aggregates, columns=columns)
+    if not os.path.exists(filepath):
+        return result
+
+    # The merged time coordinate is the sorted unique times
+    merged_times = np.unique(np.ma.compressed(times))
+    result['records'] = merged_times.size
+
+    # Fill the NcML cache from what is already in memory
+    cache = load_time_cache(sensor_path)
+    entries = [(filepath, coordinates_entry(merged_times, TIME_UNITS, max_values=max_coord_values))]
+    entries.extend((copied, coordinates) for meta, component, coordinates, copied in items if copied is not None)
+    for path, entry in entries:
+        st = os.stat(path)
+        entry = dict(entry, size=st.st_size, mtime=st.st_mtime)
+        cache['files'][os.path.basename(path)] = entry
+    save_time_cache(sensor_path, cache)
+
+    if ncml is True:
+        result['ncml'] = sensor_ncml(sensor_path, _ncml_files(sensor_path), output_filename=ncml_filename, target_file=output_filename, max_coord_values=max_coord_values)[0]
+
+    return result
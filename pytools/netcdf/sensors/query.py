@@ -0,0 +1,128 @@
+#!python
+# coding=utf-8
+
+import json
+import math
+import calendar
+from datetime import datetime
+
+import numpy as np
+
+from .crawl import read_jsonl
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _seconds(t):
+    """
+        Seconds since the epoch from a datetime, a crawl time string or a number.
+    """
+    if isinstance(t, datetime):
+        return calendar.timegm(t.utctimetuple())
+    if isinstance(t, basestring):
+        return calendar.timegm(datetime.strptime(t, TIME_FORMAT).utctimetuple())
+    return float(t)
+
+
+class SensorFileIndex(object):
+    """
+        In-memory index over crawl records (see crawl.crawl) answering
+
+            * which files of a sensor overlap a time range -- files() --
+              by binary search over start times sorted per sensor
+            * which stations are inside a bounding box -- stations() --
+              from a grid of cell_size degree buckets
+
+        Build it from a list of records, the structure crawl_and_copy returns
+        (from_crawl), a sensor_files.json (from_json) or a JSON lines crawl file
+        (from_jsonl).
+    """
+
+    def __init__(self, records, cell_size=1.0):
+        self.cell_size = float(cell_size)
+
+        by_sensor = {}
+        self._stations = {}
+        for meta in records:
+            by_sensor.setdefault(meta['mapped_sensor'], []).append(meta)
+            if meta['mapped_station'] not in self._stations:
+                self._stations[meta['mapped_station']] = (meta['lat'], meta['lon'])
+
+        # Per sensor: records sorted by start, their start and end times, and the
+        # running maximum of the end times so the first possible overlap can be
+        # found by binary search too.
+        self._sensors = {}
+        for sensor, metas in by_sensor.iteritems():
+            starts = np.asarray([_seconds(m['start']) for m in metas])
+            ends   = np.asarray([_seconds(m['end']) for m in metas])
+            order  = np.argsort(starts, kind="mergesort")
+            starts = starts[order]
+            ends   = ends[order]
+            self._sensors[sensor] = ([metas[i] for i in order], starts, ends, np.maximum.accumulate(ends))
+
+        self._grid = {}
+        for station, (lat, lon) in self._stations.iteritems():
+            self._grid.setdefault(self._cell(lat, lon), []).append(station)
+
+    @classmethod
+    def from_crawl(cls, out, **kwargs):
+        return cls((meta for variables in out.itervalues() for metas in variables.itervalues() for meta in metas), **kwargs)
+
+    @classmethod
+    def from_json(cls, path, **kwargs):
+        with open(path) as f:
+            return cls.from_crawl(json.load(f), **kwargs)
+
+    @classmethod
+    def from_jsonl(cls, path, **kwargs):
+        return cls(read_jsonl(path), **kwargs)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size)))
+
+    def sensors(self):
+        return sorted(self._sensors.keys())
+
+    def files(self, sensor, start=None, end=None):
+        """
+            Records of sensor's files whose [start, end] overlaps [start, end].
+            Either end of the range may be None.  Sorted by file start time.
+        """
+        if sensor not in self._sensors:
+            return []
+        metas, starts, ends, max_ends = self._sensors[sensor]
+
+        hi = len(metas)
+        if end is not None:
+            hi = int(np.searchsorted(starts, _seconds(end), side="right"))
+        lo = 0
+        if start is not None:
+            start = _seconds(start)
+            lo = int(np.searchsorted(max_ends, start, side="left"))
+
+        if start is None:
+            return metas[lo:hi]
+        return [metas[i] for i in xrange(lo, hi) if ends[i] >= start]
+
+    def stations(self, min_lat, min_lon, max_lat, max_lon):
+        """
+            Stations inside the bounding box, sorted.  If min_lon > max_lon the box
+            crosses the antimeridian.
+        """
+        if min_lon > max_lon:
+            return sorted(set(self.stations(min_lat, min_lon, max_lat, 180.)) | set(self.stations(min_lat, -180., max_lat, max_lon)))
+
+        lo_lat, lo_lon = self._cell(min_lat, min_lon)
+        hi_lat, hi_lon = self._cell(max_lat, max_lon)
+        found = []
+        for i in xrange(lo_lat, hi_lat + 1):
+            for j in xrange(lo_lon, hi_lon + 1):
+                for station in self._grid.get((i, j), []):
+                    lat, lon = self._stations[station]
+                    if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                        found.append(station)
+        return sorted(found)
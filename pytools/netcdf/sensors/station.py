@@ -0,0 +1,212 @@
+#!python
+# coding=utf-8
+
+import os
+from datetime import datetime
+from collections import OrderedDict
+
+import netCDF4
+import numpy as np
+
+from .create import collect_samples, grid_values, write_globals, set_time_coverage, create_time, write_rows, write_station_variables, create_instrument, create_height, create_values
+from .merge import sensor_directories, read_components
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+
+def _numbered(name, i):
+    # time, time_2, time_3, ...
+    return name if i == 0 else "%s_%d" % (name, i + 1)
+
+
+def align_values(unique_times, used_values, times, fillvalue):
+    """
+        used_values (laid out on unique_times) placed on the sorted times, which
+        contain every one of unique_times.  Times without a value get fillvalue.
+    """
+    rows = np.searchsorted(times, unique_times)
+    aligned = np.ma.masked_all((times.size,) + used_values.shape[1:], dtype=np.float64)
+    aligned.set_fill_value(fillvalue)
+    aligned[rows] = np.ma.masked_values(used_values, fillvalue)
+    return aligned
+
+
+def create_station_file(output_directory, latitude, longitude, full_station_urn, global_attributes, sensors, fillvalue=-9999.9, output_filename=None, storage=None, align=False):
+    """
+        Write every sensor of a station into a single file, instead of the file per
+        sensor create_timeseries_file writes.
+
+        sensors is a list of dictionaries, one per sensor, with
+
+            sensor_urn -- the full sensor URN, whose last part names the variable
+            attributes -- attributes of the data variable
+            and the samples, passed in any way create_timeseries_file accepts them
+            (data, times/verticals/values, batches or column_batches)
+
+        Sensors sampled at exactly the same times share a time dimension.  The
+        first group is "time" and the others "time_2", "time_3", ...  If align is
+        True every sensor is put on one "time" dimension holding the union of all
+        the times instead, with fill values where a sensor has no sample.
+
+        Sensors with the same heights share a height variable in the same way
+        ("height", "height_2", ... with "z", "z_2", ... for profiles).  Each data
+        variable names its time and height variables in its coordinates attribute
+        and its instrument variable in its instrument attribute.  featureType is
+        timeSeriesProfile if any sensor is a profile, timeSeries otherwise.
+
+        storage is applied to every data variable (see create.storage_options).
+    """
+    gridded = []
+    for sensor in sensors:
+        samples = collect_samples(sensor['sensor_urn'], data=sensor.get('data'), times=sensor.get('times'), verticals=sensor.get('verticals'), values=sensor.get('values'), batches=sensor.get('batches'), column_batches=sensor.get('column_batches'), fillvalue=fillvalue)
+        if samples is None:
+            continue
+        unique_times, unique_verticals, used_values, value_range = grid_values(*samples, fillvalue=fillvalue)
+        if unique_times.size < 2:
+            logger.error("Skipping: %s, no time!" % sensor['sensor_urn'])
+            continue
+        if unique_verticals.size <= 1:
+            # A timeSeries, with a scalar height if it has one
+            unique_verticals = np.ma.compressed(unique_verticals)
+            used_values      = np.ma.ravel(used_values)
+        gridded.append((sensor, unique_times, unique_verticals, used_values, value_range))
+
+    if not gridded:
+        logger.warn("No sensors with data for '%s'.  Skipping file creation" % full_station_urn)
+        return
+
+    variable_names = [s['sensor_urn'].split(":")[-1] for s, _, _, _, _ in gridded]
+    if len(set(variable_names)) != len(variable_names):
+        raise ValueError("Sensors of '%s' map to the same variable names: %s" % (full_station_urn, variable_names))
+
+    all_times = np.unique(np.concatenate([t for _, t, _, _, _ in gridded]))
+
+    # Group the sensors on identical times and identical heights
+    time_groups   = OrderedDict()
+    height_groups = OrderedDict()
+    for i, (sensor, unique_times, unique_verticals, used_values, value_range) in enumerate(gridded):
+        time_key = None if align is True else unique_times.tobytes()
+        time_groups.setdefault(time_key, (all_times if align is True else unique_times, []))[1].append(i)
+        height_groups.setdefault((used_values.ndim, np.ma.getdata(unique_verticals).tobytes()), (unique_verticals, []))[1].append(i)
+
+    starting = datetime.utcfromtimestamp(all_times[0])
+    ending   = datetime.utcfromtimestamp(all_times[-1])
+
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    if output_filename is None:
+        output_filename = "%s_TO_%s.nc" % (starting.strftime("%Y-%m-%dT%H:%MZ"), ending.strftime("%Y-%m-%dT%H:%MZ"))
+
+    filepath = os.path.join(output_directory, output_filename)
+    if os.path.exists(filepath):
+        os.unlink(filepath)
+
+    nc = netCDF4.Dataset(filepath, "w")
+    logger.debug("Opened file for writing: %s" % filepath)
+    try:
+        write_globals(nc, full_station_urn, global_attributes)
+        set_time_coverage(nc, all_times)
+
+        time_names = {}
+        for g, (times, members) in enumerate(time_groups.itervalues()):
+            name = _numbered("time", g)
+            time = create_time(nc, storage=storage, nrecords=times.size, name=name)
+            write_rows(time, times)
+            for i in members:
+                time_names[i] = name
+
+        write_station_variables(nc, latitude, longitude, full_station_urn, global_attributes)
+
+        height_names = {}
+        profiles = 0
+        for g, ((ndim, _), (verticals, members)) in enumerate(height_groups.iteritems()):
+            name = _numbered("height", g)
+            if ndim > 1:
+                z = _numbered("z", profiles)
+                profiles += 1
+                nc.createDimension(z, verticals.size)
+                create_height(nc, name, (z,), fillvalue)[:] = verticals
+            else:
+                z = None
+                height = create_height(nc, name, (), fillvalue)
+                if verticals.size == 1:
+                    height[:] = verticals
+            for i in members:
+                height_names[i] = (name, z)
+
+        nc.setncattr("featureType", "timeSeriesProfile" if profiles else "timeSeries")
+        verticals = np.ma.concatenate([v for v, _ in height_groups.itervalues()]).compressed()
+        if verticals.size:
+            nc.setncattr("geospatial_vertical_positive", "down")
+            nc.setncattr("geospatial_vertical_min",      float(np.min(verticals)))
+            nc.setncattr("geospatial_vertical_max",      float(np.max(verticals)))
+
+        for i, (sensor, unique_times, unique_verticals, used_values, value_range) in enumerate(gridded):
+            variable_name = variable_names[i]
+            height, z = height_names[i]
+            dimensions = (time_names[i],) if z is None else (time_names[i], z)
+            if align is True:
+                used_values = align_values(unique_times, used_values, all_times, fillvalue)
+
+            logger.debug("Setting up %s..." % variable_name)
+            instrument = "instrument_%s" % variable_name
+            create_instrument(nc, instrument, sensor['sensor_urn'])
+            var = create_values(nc, variable_name, dimensions, used_values.shape, sensor.get('attributes', {}), fillvalue, storage=storage, value_range=value_range)
+            var.coordinates   = " ".join([time_names[i], height, "latitude", "longitude"])
+            var.standard_name = variable_name
+            var.instrument    = instrument
+            write_rows(var, np.ma.masked_values(used_values, fillvalue))
+    finally:
+        nc.close()
+
+    return filepath
+
+
+def merge_stations(crawl_path, output_filename=None, prefetch_depth=0, storage=None, align=False):
+    """
+        Merge the component files of every sensor directory under crawl_path into
+        one station file per station (see create_station_file).  Station files
+        are written to a directory named after the station URN, next to the
+        sensor directories.
+    """
+    if output_filename is None:
+        output_filename = "station.nc"
+        logger.info("Setting output file to %s" % output_filename)
+
+    stations = OrderedDict()
+    for root, ncfiles in sensor_directories(crawl_path, output_filename):
+        sensor_urn  = os.path.basename(root)
+        station_urn = ":".join(sensor_urn.replace("sensor", "station").split(":")[0:-1])
+        stations.setdefault((os.path.dirname(root), station_urn), []).append((root, ncfiles))
+
+    for (parent, station_urn), sensor_roots in stations.iteritems():
+        logger.warn("Merging %s" % station_urn)
+        sensors = []
+        global_attributes = {}
+        lats = []
+        lons = []
+        for root, ncfiles in sorted(sensor_roots):
+            sensor_urn = os.path.basename(root)
+            components = read_components(root, ncfiles, sensor_urn.split(":")[-1], prefetch_depth=prefetch_depth)
+            if components is None:
+                continue
+            times, verticals, values, sensor_lats, sensor_lons, sensor_globals, variable_attributes = components
+            global_attributes.update(sensor_globals)
+            lats.extend(sensor_lats)
+            lons.extend(sensor_lons)
+            sensors.append({ 'sensor_urn' : sensor_urn,
+                             'attributes' : variable_attributes,
+                             'times'      : times,
+                             'verticals'  : verticals,
+                             'values'     : values })
+
+        if not sensors:
+            continue
+        if len(list(set(lats))) > 1:
+            logger.warn("%s : Some component files contained differing latitudes: %s.  Using the first." % (station_urn, lats))
+        if len(list(set(lons))) > 1:
+            logger.warn("%s : Some component files contained differing longitudes: %s.  Using the first." % (station_urn, lons))
+
+        create_station_file(os.path.join(parent, station_urn), lats[0], lons[0], station_urn, global_attributes, sensors, output_filename=output_filename, storage=storage, align=align)
@@ -0,0 +1,166 @@
+#!python
+# coding=utf-8
+
+import os
+
+import netCDF4
+import numpy as np
+
+from .create import write_globals, set_time_coverage, create_time, write_metadata_variables, create_vertical_and_values
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+FILL_VALUE = -9999.9
+
+# (variable, units, mean, standard deviation, profile heights or None)
+SENSORS = [("sea_water_temperature",          "degC",  10.,   2.,  None),
+           ("sea_water_practical_salinity",   "1e-3",  32.,   1.,  None),
+           ("air_temperature",                "degC",  8.,    5.,  None),
+           ("air_pressure",                   "hPa",   1012., 8.,  None),
+           ("wind_speed",                     "m s-1", 6.,    3.,  None),
+           ("sea_water_speed",                "m s-1", 0.4,   0.2, [1., 2., 4., 6., 8., 10., 15., 20.]),
+           ("sea_water_temperature_profile",  "degC",  9.,    2.,  [0.5, 1., 5., 10., 20., 30.])]
+
+
+def sensor_samples(rng, nsamples, start, interval, mean, std, heights=None, gap_fraction=0.05, duplicate_fraction=0.02, irregular_fraction=0.1):
+    """
+        (times, heights, values) of one synthetic file, one row per record the
+        way a logger writes them.  There are nsamples times every interval
+        seconds from start, with gap_fraction of the times dropped in a few
+        contiguous gaps, and duplicate_fraction of the rows repeated with
+        different values right after the original.
+
+        Without heights, heights is None and values has one value per row.
+        Otherwise values is a masked (rows, heights) array, and irregular_fraction
+        of the rows only have a random subset of the heights plus an extra one
+        below them, so the profiles don't fit on a regular grid.
+    """
+    times = start + np.arange(nsamples, dtype=np.float64) * interval
+
+    # Gaps, a handful of contiguous runs of missing times
+    keep = np.ones(nsamples, dtype=bool)
+    ngaps = rng.randint(1, 4)
+    for _ in range(ngaps):
+        length = int(nsamples * gap_fraction / ngaps)
+        if length > 0:
+            at = rng.randint(0, max(1, nsamples - length))
+            keep[at:at + length] = False
+    times = times[keep]
+
+    # A slow cycle plus noise, deeper readings a little lower
+    cycle = np.sin(times / 86400. * 2 * np.pi)
+    if heights is None:
+        values = np.ma.masked_array(mean + std * (cycle + 0.3 * rng.randn(times.size)))
+    else:
+        heights   = np.asarray(heights, dtype=np.float64)
+        irregular = np.flatnonzero(rng.rand(times.size) < irregular_fraction)
+        if irregular.size:
+            heights = np.append(heights, heights[-1] + 5.)
+        present = np.zeros((times.size, heights.size), dtype=bool)
+        present[:, :heights.size - (1 if irregular.size else 0)] = True
+        for row in irregular:
+            present[row] = False
+            present[row, rng.choice(heights.size - 1, max(1, (heights.size - 1) // 2), replace=False)] = True
+            present[row, -1] = True
+        values = mean + std * (cycle[:, np.newaxis] + 0.3 * rng.randn(times.size, heights.size)) - 0.05 * heights
+        values = np.ma.masked_array(values, mask=~present)
+
+    # Repeated rows with different values, each right after the one it repeats
+    nduplicates = int(times.size * duplicate_fraction)
+    if nduplicates > 0:
+        pick   = rng.randint(0, times.size, nduplicates)
+        times  = np.concatenate([times, times[pick]])
+        values = np.ma.concatenate([values, values[pick] + rng.randn(*values[pick].shape) * std])
+        order  = np.argsort(times, kind="mergesort")
+        times, values = times[order], values[order]
+
+    return times, heights, values
+
+
+def write_sensor_file(filepath, latitude, longitude, station_urn, sensor_urn, global_attributes, attributes, times, heights, values, fillvalue=-9999.9):
+    """
+        Write the rows of sensor_samples to filepath as they are, with the
+        variables and attributes create_timeseries_file writes.  Unlike
+        create_timeseries_file nothing is sorted, deduplicated or gridded, so
+        the repeated times and the missing heights of irregular profiles end up
+        in the file.  Returns the number of values written.
+    """
+    nc = netCDF4.Dataset(filepath, "w")
+    try:
+        write_globals(nc, station_urn, global_attributes)
+        set_time_coverage(nc, np.unique(times))
+        time = create_time(nc, nrecords=times.size)
+        time[:] = times
+        write_metadata_variables(nc, latitude, longitude, station_urn, sensor_urn, global_attributes)
+        var = create_vertical_and_values(nc, sensor_urn.split(":")[-1], np.zeros(1) if heights is None else heights, attributes, fillvalue, nrecords=times.size)
+        var[:] = np.ma.filled(values, fillvalue)
+    finally:
+        nc.close()
+    return int(np.ma.count(values))
+
+
+def generate_tree(directory, stations=2, sensors_per_station=3, files_per_sensor=10, samples_per_file=144, interval=600,
+                  overlap=0.1, profiles=True, gap_fraction=0.05, duplicate_fraction=0.02, irregular_fraction=0.1,
+                  fill_height_fraction=0., authority="synthetic", start=1262304000, seed=0):
+    """
+        Build a tree of synthetic IOOS sensor files in directory, laid out like
+        crawl_and_copy's output: one "urn:ioos:sensor:<authority>:<station>:<variable>"
+        directory per sensor, holding files_per_sensor files written by
+        write_sensor_file (so instrument.long_name is the sensor URN).
+
+        Each file has samples_per_file times, interval seconds apart.  Consecutive
+        files overlap by the overlap fraction of a file, so merges see duplicate
+        times across files, and every file has gaps and repeated times (see
+        sensor_samples).  If profiles is True, sensors with heights in SENSORS are
+        written as timeSeriesProfiles with irregular verticals, and
+        fill_height_fraction of their files get an extra first height of
+        FILL_VALUE, as written by instruments that lost a depth reading.
+
+        Returns a summary dictionary: directory, stations, sensors, files,
+        samples (values written) and bytes.
+    """
+    rng = np.random.RandomState(seed)
+    choices = [s for s in SENSORS if profiles or s[4] is None]
+
+    summary = { 'directory' : directory,
+                'stations'  : stations,
+                'sensors'   : 0,
+                'files'     : 0,
+                'samples'   : 0,
+                'bytes'     : 0 }
+
+    # Whole intervals, so overlapping files share times
+    offset = int(round(samples_per_file * (1. - overlap))) * interval
+    for s in range(stations):
+        station = "station%03d" % s
+        station_urn = "urn:ioos:station:%s:%s" % (authority, station)
+        latitude  = float(rng.uniform(25., 60.))
+        longitude = float(rng.uniform(-160., -65.))
+        global_attributes = { 'title'       : "Synthetic station %s" % station,
+                              'description' : "Synthetic %s station %d" % (authority, s),
+                              'institution' : authority }
+
+        for variable, units, mean, std, heights in [choices[(s + i) % len(choices)] for i in range(min(sensors_per_station, len(choices)))]:
+            sensor_urn = "urn:ioos:sensor:%s:%s:%s" % (authority, station, variable)
+            sensor_path = os.path.join(directory, sensor_urn)
+            if not os.path.exists(sensor_path):
+                os.makedirs(sensor_path)
+            summary['sensors'] += 1
+
+            for f in range(files_per_sensor):
+                file_start = start + f * offset
+                times, file_heights, values = sensor_samples(rng, samples_per_file, file_start, interval, mean, std, heights=heights,
+                                                             gap_fraction=gap_fraction, duplicate_fraction=duplicate_fraction, irregular_fraction=irregular_fraction)
+                if file_heights is not None and rng.rand() < fill_height_fraction:
+                    file_heights = np.concatenate([[FILL_VALUE], file_heights])
+                    values = np.ma.concatenate([mean + std * rng.randn(times.size, 1), values], axis=1)
+                filepath = os.path.join(sensor_path, "%s_%05d.nc" % (variable, f))
+                summary['samples'] += write_sensor_file(filepath, latitude, longitude, station_urn, sensor_urn, global_attributes, { 'units' : units },
+                                                        times, file_heights, values, fillvalue=FILL_VALUE)
+                summary['files']   += 1
+                summary['bytes']   += os.path.getsize(filepath)
+
+    logger.info("Generated %(files)d files, %(samples)d samples for %(sensors)d sensors in %(directory)s" % summary)
+    return summary
@@ -0,0 +1,140 @@
+#!python
+# coding=utf-8
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+
+import logging
+logger = logging.getLogger("pytools")
+logger.addHandler(logging.NullHandler())
+
+COPY     = "copy"
+HARDLINK = "hardlink"
+REFLINK  = "reflink"
+AUTO     = "auto"
+STRATEGIES = [COPY, HARDLINK, REFLINK, AUTO]
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def _checksum(path, blocksize=4 * 1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def is_unchanged(src, dst, checksum=False):
+    """
+        True if dst already holds the same content as src.  Files match on size
+        and mtime (copy2 preserves the mtime), or on size and MD5 if checksum is True.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    src_stat = os.stat(src)
+
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        # Already hardlinked
+        return True
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if checksum:
+        return _checksum(src) == _checksum(dst)
+    return abs(src_stat.st_mtime - dst_stat.st_mtime) < 1e-3
+
+
+def _reflink(src, dst):
+    """
+        Copy src to dst in the kernel, using copy_file_range when the
+        interpreter has it and the FICLONE ioctl otherwise.  Only FICLONE is
+        sure to share the data instead of copying it; copy_file_range may do
+        either.  Returns "copy_file_range" or "reflinked" for the one used.
+        Raises IOError or OSError if it doesn't work.
+    """
+    with open(src, "rb") as s:
+        with open(dst, "wb") as d:
+            if hasattr(os, "copy_file_range"):
+                remaining = os.fstat(s.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                action = "copy_file_range"
+            else:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                action = "reflinked"
+    shutil.copystat(src, dst)
+    return action
+
+
+def copy_file(src, dst, strategy=COPY, skip_unchanged=False, checksum=False):
+    """
+        Copy src to dst using one of the STRATEGIES.
+
+            copy     -- shutil.copy2
+            hardlink -- os.link when src and dst are on the same filesystem
+            reflink  -- copy_file_range or a FICLONE reflink where supported
+            auto     -- hardlink, else reflink, else copy
+
+        hardlink and reflink fall back to a regular copy when they can't be used.
+        If skip_unchanged is True nothing is done when dst already matches src
+        (see is_unchanged), and nothing is ever done when dst is src.  dst is
+        replaced by renaming a finished copy over it.  Returns the action taken:
+        "skipped", "hardlinked", "reflinked", "copy_file_range" or "copied".
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown copy strategy '%s', expected one of %s" % (strategy, STRATEGIES))
+
+    if skip_unchanged and is_unchanged(src, dst, checksum=checksum):
+        return "skipped"
+
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        # Recopying a file onto itself (or its hardlink) would only destroy it
+        return "skipped"
+
+    # Copy next to dst and rename over it, so dst is never missing or half
+    # written and a failed copy leaves the old one in place
+    directory, name = os.path.split(os.path.abspath(dst))
+    tmp = os.path.join(directory, ".%s.%d.tmp" % (name, os.getpid()))
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        action = _copy_to(src, tmp, strategy)
+        os.rename(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+    return action
+
+
+def _copy_to(src, dst, strategy):
+    """
+        Write src to the new file dst with strategy, for copy_file.
+    """
+    if strategy in (HARDLINK, AUTO):
+        if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+            try:
+                os.link(src, dst)
+                return "hardlinked"
+            except OSError as e:
+                logger.debug("Could not hardlink '%s' to '%s': %s" % (src, dst, e))
+
+    if strategy in (REFLINK, AUTO):
+        try:
+            return _reflink(src, dst)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF):
+                raise
+            logger.debug("Could not reflink '%s' to '%s': %s" % (src, dst, e))
+
+    shutil.copy2(src, dst)
+    return "copied"
@@ -35,6 +35,11 @@ setup(
     install_requires    = reqs,
     tests_require       = ['pytest'],
     cmdclass            = {'test': PyTest},
+    entry_points        = {
+            'console_scripts': [
+                'pytools-clone = pytools.netcdf.clone:main',
+            ],
+        },
     classifiers         = [
             'Development Status :: 3 - Alpha',
             'Intended Audience :: Developers',
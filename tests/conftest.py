@@ -0,0 +1,77 @@
+#!python
+# coding=utf-8
+
+import os
+
+import pytest
+import netCDF4
+import numpy as np
+
+from pytools.netcdf.sensors.synthetic import generate_tree
+
+
+def sensor_files(directory):
+    """
+        {variable: (sensor directory, sorted component filenames)} of a tree,
+        leaving out merged files.
+    """
+    sensors = {}
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("urn:ioos:sensor:"):
+            root = os.path.join(directory, name)
+            sensors[name.split(":")[-1]] = (root, sorted(f for f in os.listdir(root) if f.endswith(".nc") and f != "merged.nc"))
+    return sensors
+
+
+def read_merged(path, variable):
+    """
+        (times, heights, values) of a merged or component file.
+    """
+    nc = netCDF4.Dataset(path)
+    try:
+        return nc.variables["time"][:], np.atleast_1d(nc.variables["height"][:]), nc.variables[variable][:]
+    finally:
+        nc.close()
+
+
+def assert_same(a, b):
+    """
+        Assert that two sequences of (masked) arrays are equal, masks included.
+    """
+    for x, y in zip(a, b):
+        assert x.shape == y.shape
+        np.testing.assert_array_equal(np.ma.getmaskarray(x), np.ma.getmaskarray(y))
+        np.testing.assert_array_equal(np.ma.filled(x, 0), np.ma.filled(y, 0))
+
+
+@pytest.fixture
+def tree(tmpdir):
+    """
+        A synthetic station with every sensor in SENSORS, two of them profiles,
+        each in 3 overlapping files with gaps, repeated times and irregular
+        profiles.
+    """
+    directory = str(tmpdir.join("tree"))
+    generate_tree(directory, stations=1, sensors_per_station=7, files_per_sensor=3, samples_per_file=144, seed=1)
+    return directory
+
+
+@pytest.fixture
+def regular_tree(tmpdir):
+    """
+        Like tree, but the profiles always have every height.
+    """
+    directory = str(tmpdir.join("regular"))
+    generate_tree(directory, stations=1, sensors_per_station=7, files_per_sensor=3, samples_per_file=144, irregular_fraction=0., seed=2)
+    return directory
+
+
+@pytest.fixture
+def fill_tree(tmpdir):
+    """
+        Like tree, but about half of the profile files have an extra height
+        that is the fill value.
+    """
+    directory = str(tmpdir.join("fill"))
+    generate_tree(directory, stations=1, sensors_per_station=7, files_per_sensor=3, samples_per_file=144, fill_height_fraction=0.5, seed=9)
+    return directory
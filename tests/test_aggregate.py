@@ -0,0 +1,98 @@
+#!python
+# coding=utf-8
+
+import os
+import shutil
+
+import netCDF4
+import numpy as np
+import pytest
+
+from pytools.netcdf.sensors.aggregate import STATISTICS, STEPS_ATTRIBUTE, step_label
+from pytools.netcdf.sensors.merge import merge_timeseries
+from pytools.netcdf.sensors.synthetic import generate_tree
+
+from conftest import sensor_files, assert_same
+
+STEPS = [3600, 86400]
+
+
+def read_pyramid(path, variable):
+    # {step: (bin starts, bounds, {statistic: values})}
+    nc = netCDF4.Dataset(path)
+    try:
+        var = nc.variables[variable]
+        levels = {}
+        for step in np.atleast_1d(var.getncattr(STEPS_ATTRIBUTE)):
+            label = step_label(step)
+            levels[int(step)] = (nc.variables["time_%s" % label][:],
+                                 nc.variables["time_%s_bounds" % label][:],
+                                 dict((s, nc.variables["%s_%s_%s" % (variable, s, label)][:]) for s in STATISTICS))
+        return levels, nc.variables["time"][:], var[:]
+    finally:
+        nc.close()
+
+
+def test_aggregates_summarize_the_merged_values(tree):
+    merge_timeseries(tree, aggregates=STEPS)
+
+    for variable, (root, files) in sensor_files(tree).iteritems():
+        levels, times, values = read_pyramid(os.path.join(root, "merged.nc"), variable)
+        assert sorted(levels) == STEPS
+        for step, (bins, bounds, statistics) in levels.iteritems():
+            expected = np.unique(np.floor(times / step) * step)
+            np.testing.assert_array_equal(bins, expected)
+            np.testing.assert_array_equal(bounds, np.column_stack([expected, expected + step]))
+            for i, start in enumerate(bins):
+                inside = values[(times >= start) & (times < start + step)]
+                count = np.ma.count(inside, axis=0)
+                np.testing.assert_array_equal(statistics['count'][i], count)
+                if values.ndim == 1 and count == 0:
+                    assert statistics['mean'][i] is np.ma.masked
+                    continue
+                np.testing.assert_allclose(statistics['mean'][i], np.ma.mean(inside, axis=0), rtol=1e-5)
+                np.testing.assert_allclose(statistics['min'][i], np.ma.min(inside, axis=0), rtol=1e-6)
+                np.testing.assert_allclose(statistics['max'][i], np.ma.max(inside, axis=0), rtol=1e-6)
+                np.testing.assert_array_equal(np.ma.getmaskarray(statistics['mean'][i]), count == 0)
+
+
+@pytest.mark.parametrize("buffer_size", [7, 100000])
+def test_streamed_aggregates_match(tree, tmpdir, buffer_size):
+    streamed = str(tmpdir.join("streamed"))
+    shutil.copytree(tree, streamed)
+    merge_timeseries(tree, aggregates=STEPS)
+    merge_timeseries(streamed, aggregates=STEPS, buffer_size=buffer_size)
+
+    for variable, (root, files) in sensor_files(tree).iteritems():
+        expected = read_pyramid(os.path.join(root, "merged.nc"), variable)[0]
+        levels   = read_pyramid(os.path.join(streamed, os.path.basename(root), "merged.nc"), variable)[0]
+        for step in STEPS:
+            assert_same(expected[step][:2], levels[step][:2])
+            for statistic in STATISTICS:
+                assert_same([expected[step][2][statistic]], [levels[step][2][statistic]])
+
+
+def test_appended_aggregates_match(tmpdir):
+    # Files without overlap are appended in place, bins split across files
+    # are picked up again
+    tree = str(tmpdir.join("tree"))
+    generate_tree(tree, stations=1, sensors_per_station=3, files_per_sensor=3, samples_per_file=100, overlap=0., irregular_fraction=0., seed=6)
+    sensors = sensor_files(tree)
+    incremental = str(tmpdir.join("incremental"))
+    for root, files in sensors.itervalues():
+        os.makedirs(os.path.join(incremental, os.path.basename(root)))
+    for count in (1, 2, 3):
+        for root, files in sensors.itervalues():
+            shutil.copy2(os.path.join(root, files[count - 1]), os.path.join(incremental, os.path.basename(root)))
+        merge_timeseries(incremental, incremental=True, aggregates=STEPS)
+
+    merge_timeseries(tree, aggregates=STEPS)
+    for variable, (root, files) in sensors.iteritems():
+        expected = read_pyramid(os.path.join(root, "merged.nc"), variable)[0]
+        levels   = read_pyramid(os.path.join(incremental, os.path.basename(root), "merged.nc"), variable)[0]
+        for step in STEPS:
+            assert_same(expected[step][:2], levels[step][:2])
+            np.testing.assert_array_equal(expected[step][2]['count'], levels[step][2]['count'])
+            for statistic in ("min", "max"):
+                assert_same([expected[step][2][statistic]], [levels[step][2][statistic]])
+            np.testing.assert_allclose(expected[step][2]['mean'], levels[step][2]['mean'], rtol=1e-6)
@@ -0,0 +1,50 @@
+#!python
+# coding=utf-8
+
+import netCDF4
+import numpy as np
+
+from pytools.netcdf.clone import clone
+from pytools.netcdf.chunking import chunk_shape, SPATIAL, TIMESERIES
+
+
+def test_spatial_chunks_one_time_step():
+    assert chunk_shape((100, 50, 60), ("time", "lat", "lon"), 4, SPATIAL) == (1, 50, 60)
+
+
+def test_spatial_keeps_1d_variables_whole():
+    assert chunk_shape((100,), ("time",), 8, SPATIAL) == (100,)
+    assert chunk_shape((50,), ("lat",), 8, SPATIAL) == (50,)
+    assert chunk_shape((100,), ("time",), 8, SPATIAL) == chunk_shape((100,), ("time",), 8, TIMESERIES)
+
+
+def test_spatial_keeps_variables_without_time_whole():
+    assert chunk_shape((50, 60), ("lat", "lon"), 4, SPATIAL) == (50, 60)
+    # Too big for one chunk, so only the slowest dimension is cut
+    assert chunk_shape((500, 600), ("lat", "lon"), 4, SPATIAL, target_bytes=600 * 4 * 10) == (10, 600)
+
+
+def test_clone_spatial_chunking(tmpdir):
+    source = str(tmpdir.join("grid.nc"))
+    nc = netCDF4.Dataset(source, "w")
+    nc.createDimension("time", None)
+    nc.createDimension("lat", 50)
+    nc.createDimension("lon", 60)
+    nc.createVariable("time", "f8", ("time",))[:] = np.arange(10)
+    nc.createVariable("lat", "f8", ("lat",))[:] = np.arange(50)
+    nc.createVariable("lon", "f8", ("lon",))[:] = np.arange(60)
+    nc.createVariable("depth", "f4", ("lat", "lon"))[:] = np.ones((50, 60))
+    nc.createVariable("v", "f4", ("time", "lat", "lon"))[:] = np.ones((10, 50, 60))
+    nc.close()
+
+    destination = str(tmpdir.join("spatial.nc"))
+    clone(netCDF4.Dataset(source), destination, [], [], [], chunking=SPATIAL)
+
+    nc = netCDF4.Dataset(destination)
+    try:
+        assert nc.variables["time"].chunking() == [10]
+        assert nc.variables["lat"].chunking() == [50]
+        assert nc.variables["depth"].chunking() == [50, 60]
+        assert nc.variables["v"].chunking() == [1, 50, 60]
+    finally:
+        nc.close()
@@ -0,0 +1,104 @@
+#!python
+# coding=utf-8
+
+import os
+import time
+import signal
+
+import pytest
+import netCDF4
+import numpy as np
+
+import pytools.netcdf.clone as clone_module
+from pytools.netcdf.clone import clone, clone_many
+from pytools.netcdf.sensors.merge import merge_timeseries
+
+from conftest import sensor_files
+
+
+def merged_profile(tree):
+    merge_timeseries(tree)
+    root, files = sensor_files(tree)["sea_water_speed"]
+    return os.path.join(root, "merged.nc")
+
+
+def test_clone_in_slabs(tree, tmpdir):
+    source = merged_profile(tree)
+    destination = str(tmpdir.join("slabs.nc"))
+
+    # Small enough that every variable is copied in many pieces
+    clone(netCDF4.Dataset(source), destination, [], [], [], max_bytes=256)
+
+    src = netCDF4.Dataset(source)
+    dst = netCDF4.Dataset(destination)
+    try:
+        assert sorted(dst.variables) == sorted(src.variables)
+        for name, var in src.variables.iteritems():
+            copied, original = dst.variables[name][:], var[:]
+            np.testing.assert_array_equal(np.ma.getmaskarray(copied), np.ma.getmaskarray(original))
+            np.testing.assert_array_equal(np.ma.filled(copied, 0), np.ma.filled(original, 0))
+    finally:
+        src.close()
+        dst.close()
+
+
+def test_clone_time_subset(tree, tmpdir):
+    source = merged_profile(tree)
+    destination = str(tmpdir.join("subset.nc"))
+    nc = netCDF4.Dataset(source)
+    times = nc.variables["time"][:]
+    values = nc.variables["sea_water_speed"][:]
+    nc.close()
+    lower, upper = times[10], times[40]
+
+    clone(netCDF4.Dataset(source), destination, [], [], [], max_bytes=1024, subset={ 'time' : (lower, upper) })
+
+    dst = netCDF4.Dataset(destination)
+    try:
+        selected = (times >= lower) & (times <= upper)
+        np.testing.assert_array_equal(dst.variables["time"][:], times[selected])
+        np.testing.assert_array_equal(dst.variables["sea_water_speed"][:], values[selected])
+        assert len(dst.dimensions["time"]) == 31
+    finally:
+        dst.close()
+
+
+def test_clone_many_survives_a_dead_worker(tree, tmpdir, monkeypatch):
+    files = sensor_files(tree)
+    sources = [os.path.join(root, names[0]) for root, names in sorted(files.values())][:3]
+    pairs = [(src, str(tmpdir.join("%d.nc" % i))) for i, src in enumerate(sources)]
+    crashing = sources[1]
+
+    original = clone_module.clone
+    def crash_on_one(src, *args, **kwargs):
+        if src.filepath() == crashing:
+            os.kill(os.getpid(), signal.SIGKILL)
+        return original(src, *args, **kwargs)
+    monkeypatch.setattr(clone_module, "clone", crash_on_one)
+
+    results = clone_many(pairs + [pairs[0]], processes=2)
+
+    assert [(r['src'], r['dst']) for r in results] == pairs + [pairs[0]]
+    assert results[0]['error'] is None and results[2]['error'] is None
+    assert "died" in results[1]['error']
+    assert os.path.exists(pairs[0][1]) and os.path.exists(pairs[2][1])
+
+
+def test_clone_many_kills_a_hung_worker(tree, tmpdir, monkeypatch):
+    root, names = sorted(sensor_files(tree).values())[0]
+    pairs = [(os.path.join(root, names[0]), str(tmpdir.join("hung.nc")))]
+    monkeypatch.setattr(clone_module, "clone", lambda *args, **kwargs: time.sleep(60))
+
+    started = time.time()
+    results = clone_many(pairs, timeout=0.5)
+
+    assert time.time() - started < 30
+    assert "Killed" in results[0]['error']
+
+
+def test_clone_many_rejects_clashing_destinations(tree, tmpdir):
+    files = sensor_files(tree)
+    sources = [os.path.join(root, names[0]) for root, names in sorted(files.values())][:2]
+    destination = str(tmpdir.join("same.nc"))
+    with pytest.raises(ValueError):
+        clone_many([(sources[0], destination), (sources[1], destination)])
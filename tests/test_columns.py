@@ -0,0 +1,71 @@
+#!python
+# coding=utf-8
+
+import os
+
+import netCDF4
+import numpy as np
+
+from pytools.netcdf.sensors.columns import ColumnCache, column_path
+from pytools.netcdf.sensors.merge import merge_timeseries
+
+from conftest import sensor_files
+
+
+def test_round_trip(tree):
+    merge_timeseries(tree, columns=True)
+
+    for variable, (root, files) in sensor_files(tree).iteritems():
+        path = os.path.join(root, "merged.nc")
+        cache = ColumnCache.open(path)
+        assert cache.variable == variable
+
+        nc = netCDF4.Dataset(path)
+        try:
+            times   = nc.variables["time"][:]
+            heights = np.atleast_1d(nc.variables["height"][:])
+            values  = nc.variables[variable][:]
+            assert cache.units == nc.variables[variable].units
+        finally:
+            nc.close()
+
+        np.testing.assert_array_equal(cache.time, times)
+        np.testing.assert_array_equal(cache.height, np.ma.filled(heights.astype(np.float64), np.nan))
+        np.testing.assert_array_equal(cache.values, np.ma.filled(values.astype(cache.values.dtype), np.nan))
+
+        window_times, window_heights, window_values = cache.window(times[5], times[20])
+        np.testing.assert_array_equal(window_times, times[5:21])
+        np.testing.assert_array_equal(window_values, cache.values[5:21])
+        assert len(cache) == times.size
+
+
+def test_out_of_date_is_ignored(tree):
+    merge_timeseries(tree, columns=True)
+    root, files = sensor_files(tree)["air_temperature"]
+    path = os.path.join(root, "merged.nc")
+    assert os.path.exists(column_path(path))
+
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 10))
+    assert ColumnCache.open(path) is None
+    assert ColumnCache.open(path, check=False) is not None
+
+    # An incremental merge with nothing new rewrites it
+    merge_timeseries(tree, incremental=True, columns=True)
+    assert ColumnCache.open(path) is not None
+
+
+def test_unreadable_is_rewritten(tree):
+    merge_timeseries(tree, incremental=True, columns=True)
+    root, files = sensor_files(tree)["wind_speed"]
+    path = os.path.join(root, "merged.nc")
+    with open(column_path(path), "rb") as f:
+        original = f.read()
+
+    for broken in ("", "not a column file", original[:20], original[:100], original[:len(original) // 2]):
+        with open(column_path(path), "wb") as f:
+            f.write(broken)
+        assert ColumnCache.open(path) is None
+
+        merge_timeseries(tree, incremental=True, columns=True)
+        assert len(ColumnCache.open(path)) > 0
@@ -0,0 +1,50 @@
+#!python
+# coding=utf-8
+
+from pytools.netcdf.sensors.crawl import crawl, crawl_and_copy, write_jsonl, read_jsonl, GroupedCrawl
+from pytools.netcdf.sensors.synthetic import generate_tree
+
+
+def test_crawl_order_does_not_depend_on_processes(tree):
+    serial   = crawl_and_copy([tree], {}, {})
+    parallel = crawl_and_copy([tree], {}, {}, processes=2)
+
+    assert serial == parallel
+    assert list(serial) == sorted(serial)
+    for station in serial.itervalues():
+        for metas in station.itervalues():
+            files = [m['file'] for m in metas]
+            assert files == sorted(files)
+
+
+def test_crawl_yields_in_path_order(tree):
+    files = [m['file'] for m in crawl([tree], {}, {})]
+    assert files == sorted(files)
+
+
+def test_jsonl_round_trip(tmpdir):
+    tree = str(tmpdir.join("tree"))
+    generate_tree(tree, stations=2, sensors_per_station=3, files_per_sensor=2, samples_per_file=24, seed=4)
+    path = str(tmpdir.join("crawl.jsonl"))
+
+    records = list(crawl([tree], {}, {}))
+    assert write_jsonl(crawl([tree], {}, {}), path) == len(records) == 12
+    assert list(read_jsonl(path)) == records
+
+
+def test_grouped_crawl_matches_crawl_and_copy(tmpdir):
+    tree = str(tmpdir.join("tree"))
+    generate_tree(tree, stations=2, sensors_per_station=3, files_per_sensor=2, samples_per_file=24, seed=4)
+    path = str(tmpdir.join("crawl.jsonl"))
+    write_jsonl(crawl([tree], {}, {}), path)
+
+    expected = crawl_and_copy([tree], {}, {})
+    grouped  = GroupedCrawl(path)
+
+    assert len(grouped) == len(expected) == 2
+    assert grouped.keys() == list(expected) == list(grouped)
+    assert "urn:ioos:station:nowhere:station000" not in grouped
+    for station, variables in expected.iteritems():
+        assert station in grouped
+        assert grouped[station] == variables
+    assert dict(grouped.iteritems()) == expected
@@ -0,0 +1,80 @@
+#!python
+# coding=utf-8
+
+import os
+
+import pytest
+import netCDF4
+import numpy as np
+
+from pytools.netcdf.sensors.create import SampleBuffer, unique_samples, grid_values
+
+from conftest import sensor_files
+
+
+def flattened(path, variable):
+    # (times, verticals, values) of every cell of a file, in file order
+    nc = netCDF4.Dataset(path)
+    try:
+        times   = nc.variables["time"][:]
+        heights = np.atleast_1d(nc.variables["height"][:])
+        values  = nc.variables[variable][:]
+    finally:
+        nc.close()
+    return np.repeat(times, heights.size), np.tile(heights, times.size), np.ma.ravel(values)
+
+
+def test_unique_samples_keeps_first(tree):
+    for variable, (root, files) in sensor_files(tree).iteritems():
+        times, verticals, values = flattened(os.path.join(root, files[0]), variable)
+        assert np.unique(times).size < times.size
+
+        ts, zs, vs = unique_samples(times, verticals, values)
+
+        pairs = zip(ts.tolist(), zs.tolist())
+        assert pairs == sorted(set(pairs))
+        # The value kept for each pair is the first one in the file
+        first = {}
+        for t, z, v in zip(times.tolist(), verticals.tolist(), np.ma.filled(values, np.nan).tolist()):
+            first.setdefault((t, z), v)
+        np.testing.assert_array_equal(np.ma.filled(vs, np.nan), [first[p] for p in pairs])
+
+
+def test_grid_values(tree):
+    root, files = sensor_files(tree)["sea_water_speed"]
+    times, verticals, values = flattened(os.path.join(root, files[0]), "sea_water_speed")
+    ts, zs, vs = unique_samples(times, verticals, values)
+
+    unique_times, unique_verticals, grid, value_range = grid_values(ts, zs, vs, fillvalue=-9999.9)
+
+    np.testing.assert_array_equal(unique_times, np.unique(times))
+    np.testing.assert_array_equal(unique_verticals, np.unique(verticals))
+    assert grid.shape == (unique_times.size, unique_verticals.size)
+    rows    = np.searchsorted(unique_times, ts)
+    columns = np.searchsorted(unique_verticals, zs)
+    np.testing.assert_array_equal(np.ma.filled(grid[rows, columns], -9999.9), np.ma.filled(vs, -9999.9).astype(grid.dtype))
+    # Irregular profiles leave cells without a sample
+    assert np.ma.getmaskarray(grid).any()
+
+
+def test_sample_buffer_rows_and_columns():
+    buffered = SampleBuffer(capacity=2, fillvalue=-9999.9)
+    # Three rows in a tuple are rows, not three columns
+    buffered.extend(((1., 5., 0.1), (2., 5., 0.2), (3., 5., 0.3)))
+    buffered.extend(np.array([[4., 10., 0.4]]))
+    buffered.extend_columns(np.array([5., 6.]), np.array([5., 10.]), np.ma.masked_array([0.5, 0.6], mask=[False, True]))
+    buffered.extend([])
+
+    times, verticals, values = buffered.arrays()
+    np.testing.assert_array_equal(times, [1., 2., 3., 4., 5., 6.])
+    np.testing.assert_array_equal(verticals, [5., 5., 5., 10., 5., 10.])
+    np.testing.assert_array_equal(values, [0.1, 0.2, 0.3, 0.4, 0.5, -9999.9])
+
+
+def test_sample_buffer_rejects_bad_batches():
+    buffered = SampleBuffer()
+    with pytest.raises(ValueError):
+        buffered.extend(np.arange(3.))
+    with pytest.raises(ValueError):
+        buffered.extend_columns(np.arange(3.), np.arange(3.), np.arange(2.))
+    assert buffered.size == 0
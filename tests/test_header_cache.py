@@ -0,0 +1,80 @@
+#!python
+# coding=utf-8
+
+import os
+import sqlite3
+
+from pytools.netcdf.sensors.crawl import read_header, crawl_and_copy
+from pytools.netcdf.sensors.header_cache import HeaderCache
+
+from conftest import sensor_files
+
+
+def rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM headers").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_get_put_and_changes(tree, tmpdir):
+    root, files = sensor_files(tree)["air_pressure"]
+    filepath = os.path.join(root, files[0])
+    header = read_header(filepath)
+
+    cache = HeaderCache(str(tmpdir.join("headers.db")))
+    try:
+        assert cache.get(filepath, os.stat(filepath)) is None
+        cache.put(filepath, os.stat(filepath), header)
+        assert cache.get(filepath, os.stat(filepath)) == header
+
+        # A changed file is read again
+        st = os.stat(filepath)
+        os.utime(filepath, (st.st_atime, st.st_mtime + 10))
+        assert cache.get(filepath, os.stat(filepath)) is None
+
+        cache.put(filepath, os.stat(filepath), header)
+        assert (cache.hits, cache.misses) == (1, 2)
+    finally:
+        cache.close()
+
+    # A file renamed between crawls is found under its new name
+    renamed = os.path.join(root, "renamed.nc")
+    os.rename(filepath, renamed)
+    cache = HeaderCache(str(tmpdir.join("headers.db")))
+    try:
+        assert cache.get(renamed, os.stat(renamed)) == header
+        assert cache.get(filepath, st) is None
+    finally:
+        cache.close()
+
+
+def test_commits_every_n_puts(tree, tmpdir):
+    path = str(tmpdir.join("headers.db"))
+    root, files = sensor_files(tree)["air_pressure"]
+
+    cache = HeaderCache(path, commit_every=2)
+    try:
+        for i, f in enumerate(files):
+            filepath = os.path.join(root, f)
+            cache.put(filepath, os.stat(filepath), read_header(filepath))
+            # Another connection only sees committed rows
+            assert rows(path) == (i + 1) // 2 * 2
+    finally:
+        cache.close()
+    assert rows(path) == len(files)
+
+
+def test_crawl_uses_and_prunes_the_cache(tree, tmpdir):
+    path = str(tmpdir.join("headers.db"))
+    first = crawl_and_copy([tree], {}, {}, index_path=path)
+    total = sum(len(files) for root, files in sensor_files(tree).itervalues())
+    assert rows(path) == total
+
+    root, files = sensor_files(tree)["wind_speed"]
+    os.unlink(os.path.join(root, files[0]))
+    second = crawl_and_copy([tree], {}, {}, index_path=path)
+
+    assert rows(path) == total - 1
+    assert sorted(second) == sorted(first)
@@ -0,0 +1,193 @@
+#!python
+# coding=utf-8
+
+import os
+import time
+import shutil
+import signal
+
+import netCDF4
+import numpy as np
+import pytest
+
+import pytools.netcdf.sensors.merge as merge_module
+from pytools.netcdf.sensors.synthetic import generate_tree
+from pytools.netcdf.sensors.merge import merge_sensor, stream_merge_sensor, merge_timeseries, merge_timeseries_parallel
+
+from conftest import sensor_files, read_merged, assert_same
+
+
+@pytest.mark.parametrize("buffer_size", [7, 100000])
+def test_stream_merge_matches_merge(tree, buffer_size):
+    for variable, (root, files) in sensor_files(tree).iteritems():
+        merge_sensor(root, files, "memory.nc")
+        stream_merge_sensor(root, files, "stream.nc", buffer_size=buffer_size)
+
+        merged = read_merged(os.path.join(root, "memory.nc"), variable)
+        assert_same(merged, read_merged(os.path.join(root, "stream.nc"), variable))
+        # Overlapping files and repeated rows leave one record per time
+        times = np.concatenate([read_merged(os.path.join(root, f), variable)[0] for f in files])
+        np.testing.assert_array_equal(merged[0], np.unique(times))
+
+
+@pytest.mark.parametrize("buffer_size", [7, 100000])
+def test_stream_merge_keeps_missing_heights(fill_tree, buffer_size):
+    for variable, (root, files) in sensor_files(fill_tree).iteritems():
+        merge_sensor(root, files, "memory.nc")
+        stream_merge_sensor(root, files, "stream.nc", buffer_size=buffer_size)
+
+        merged = read_merged(os.path.join(root, "memory.nc"), variable)
+        assert_same(merged, read_merged(os.path.join(root, "stream.nc"), variable))
+
+        heights = [read_merged(os.path.join(root, f), variable)[1] for f in files]
+        if any(np.ma.is_masked(h) for h in heights):
+            # The samples at the missing height are kept in its own column
+            assert np.ma.getmaskarray(merged[1]).tolist() == [False] * (merged[1].size - 1) + [True]
+            assert merged[2][:, -1].count() > 0
+
+
+def test_parallel_merge_matches_merge(tree, tmpdir):
+    serial = str(tmpdir.join("serial"))
+    shutil.copytree(tree, serial)
+    merge_timeseries(serial)
+
+    results = merge_timeseries_parallel(tree, processes=2, timeout=60)
+
+    assert [r['error'] for r in results] == [None] * len(results)
+    for variable, (root, files) in sensor_files(tree).iteritems():
+        expected = read_merged(os.path.join(serial, os.path.basename(root), "merged.nc"), variable)
+        assert_same(expected, read_merged(os.path.join(root, "merged.nc"), variable))
+
+
+def test_parallel_merge_reports_dead_and_hung_workers(tree, monkeypatch):
+    merge_timeseries(tree)
+    sensors = sensor_files(tree)
+    before = dict((variable, read_merged(os.path.join(root, "merged.nc"), variable)) for variable, (root, files) in sensors.iteritems())
+
+    original = merge_module.merge_sensor
+    def misbehave(root, ncfiles, output_filename, **kwargs):
+        if root.endswith("air_pressure"):
+            os.kill(os.getpid(), signal.SIGKILL)
+        if root.endswith("wind_speed"):
+            # Half written when it is killed
+            open(os.path.join(root, output_filename), "w").close()
+            time.sleep(60)
+        return original(root, ncfiles, output_filename, **kwargs)
+    monkeypatch.setattr(merge_module, "merge_sensor", misbehave)
+
+    started = time.time()
+    results = merge_timeseries_parallel(tree, processes=2, timeout=5)
+
+    assert time.time() - started < 30
+    errors = dict((r['sensor'].split(":")[-1], r['error']) for r in results)
+    assert "died" in errors.pop("air_pressure")
+    assert "Killed" in errors.pop("wind_speed")
+    assert errors.values() == [None] * len(errors)
+    # The outputs of the failed merges are left as they were
+    for variable, (root, files) in sensors.iteritems():
+        assert_same(before[variable], read_merged(os.path.join(root, "merged.nc"), variable))
+        assert not [f for f in os.listdir(root) if f.endswith(".tmp")]
+
+
+@pytest.mark.parametrize("buffer_size", [None, 11])
+def test_append_matches_full_rebuild(regular_tree, tmpdir, buffer_size):
+    # Without irregular profiles a full rebuild never keeps a missing value
+    # over a sample of a later file, which an incremental merge would fill
+    incremental = str(tmpdir.join("incremental"))
+    sensors = sensor_files(regular_tree)
+    for root, files in sensors.itervalues():
+        os.makedirs(os.path.join(incremental, os.path.basename(root)))
+
+    for count in (1, 2, 3):
+        for root, files in sensors.itervalues():
+            shutil.copy2(os.path.join(root, files[count - 1]), os.path.join(incremental, os.path.basename(root)))
+        merge_timeseries(incremental, incremental=True, buffer_size=buffer_size)
+
+    merge_timeseries(regular_tree, buffer_size=buffer_size)
+    for variable, (root, files) in sensors.iteritems():
+        assert_same(read_merged(os.path.join(root, "merged.nc"), variable),
+                    read_merged(os.path.join(incremental, os.path.basename(root), "merged.nc"), variable))
+
+
+def test_append_fills_padding_with_new_samples(tree, tmpdir):
+    root, files = sensor_files(tree)["sea_water_speed"]
+    incremental = str(tmpdir.join(os.path.basename(root)))
+    os.makedirs(incremental)
+    shutil.copy2(os.path.join(root, files[0]), incremental)
+    merge_timeseries(str(tmpdir), incremental=True)
+    shutil.copy2(os.path.join(root, files[1]), incremental)
+    merge_timeseries(str(tmpdir), incremental=True)
+
+    times, heights, values = read_merged(os.path.join(incremental, "merged.nc"), "sea_water_speed")
+    # Every sample of the new file is in the output, unless the first file
+    # already had a value there
+    first  = read_merged(os.path.join(root, files[0]), "sea_water_speed")
+    second = read_merged(os.path.join(root, files[1]), "sea_water_speed")
+    for t, row in zip(second[0], second[2]):
+        for z, value in zip(second[1], row):
+            if value is np.ma.masked:
+                continue
+            before = first[2][first[0] == t][:, first[1] == z] if z in first[1] else np.ma.masked_all((0, 0))
+            if np.ma.count(before):
+                continue
+            assert values[times == t][0, heights == z][0] is not np.ma.masked
+    assert sorted(os.listdir(incremental)) == sorted(files[:2] + ["merged.nc", "merged.nc.inputs.json"])
+
+
+def incremental_copies(sensors, directory):
+    # Merge each sensor's files into directory one at a time, incrementally
+    for root, files in sensors.itervalues():
+        os.makedirs(os.path.join(directory, os.path.basename(root)))
+    for count in (1, 2, 3):
+        for root, files in sensors.itervalues():
+            shutil.copy2(os.path.join(root, files[count - 1]), os.path.join(directory, os.path.basename(root)))
+        merge_timeseries(directory, incremental=True)
+
+
+def test_append_with_missing_heights(tmpdir):
+    # Consecutive files without overlap are appended in place, onto and
+    # with the column of the missing height
+    tree = str(tmpdir.join("tree"))
+    generate_tree(tree, stations=1, sensors_per_station=7, files_per_sensor=3, samples_per_file=144, overlap=0., irregular_fraction=0., fill_height_fraction=0.5, seed=1)
+    sensors = sensor_files(tree)
+    incremental = str(tmpdir.join("incremental"))
+    incremental_copies(sensors, incremental)
+
+    merge_timeseries(tree)
+    for variable, (root, files) in sensors.iteritems():
+        expected = read_merged(os.path.join(root, "merged.nc"), variable)
+        assert_same(expected, read_merged(os.path.join(incremental, os.path.basename(root), "merged.nc"), variable))
+        if expected[2].ndim > 1:
+            assert np.ma.is_masked(expected[1])
+
+
+def test_failed_append_leaves_output(regular_tree, tmpdir, monkeypatch):
+    root, files = sensor_files(regular_tree)["sea_water_speed"]
+    incremental = str(tmpdir.join(os.path.basename(root)))
+    os.makedirs(incremental)
+    shutil.copy2(os.path.join(root, files[0]), incremental)
+    merge_timeseries(str(tmpdir), incremental=True)
+    output = os.path.join(incremental, "merged.nc")
+    before = read_merged(output, "sea_water_speed")
+    with open(output + ".inputs.json") as f:
+        manifest = f.read()
+
+    def fail(*args, **kwargs):
+        raise IOError("Disk full")
+    monkeypatch.setattr(merge_module.Pyramid, "add", fail)
+    # Later than the first file, so it is appended
+    nc = netCDF4.Dataset(os.path.join(root, files[2]))
+    assert nc.variables["time"][0] > before[0][-1]
+    nc.close()
+    shutil.copy2(os.path.join(root, files[2]), incremental)
+    with pytest.raises(IOError):
+        merge_timeseries(str(tmpdir), incremental=True)
+
+    assert_same(before, read_merged(output, "sea_water_speed"))
+    with open(output + ".inputs.json") as f:
+        assert f.read() == manifest
+    assert sorted(os.listdir(incremental)) == sorted([files[0], files[2], "merged.nc", "merged.nc.inputs.json"])
+
+    monkeypatch.undo()
+    merge_timeseries(str(tmpdir), incremental=True)
+    assert read_merged(output, "sea_water_speed")[0].size > before[0].size
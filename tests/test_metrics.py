@@ -0,0 +1,87 @@
+#!python
+# coding=utf-8
+
+import json
+
+import numpy as np
+import pytest
+
+from pytools.netcdf import metrics
+from pytools.netcdf.sensors.merge import merge_timeseries
+
+# Far above anything else the stages in these tests hold
+ALLOCATION = 64 * 1024 * 1024
+
+
+@pytest.fixture
+def records(tmpdir):
+    """
+        A function returning the records written so far, by stage name.
+    """
+    path = str(tmpdir.join("metrics.jsonl"))
+    metrics.enable(path)
+
+    def read():
+        out = {}
+        with open(path) as f:
+            for line in f:
+                r = json.loads(line)
+                out.setdefault(r['stage'], []).append(r)
+        return out
+
+    yield read
+    metrics.disable()
+
+
+def allocate():
+    a = np.ones(ALLOCATION, dtype=np.uint8)
+    del a
+
+
+def test_peak_is_per_stage(records):
+    if metrics._status() is None or not metrics._reset_peak():
+        pytest.skip("The high water mark can't be reset here")
+    with metrics.stage("outer"):
+        with metrics.stage("big"):
+            allocate()
+        with metrics.stage("small"):
+            pass
+
+    r = records()
+    big, small, outer = r['big'][0], r['small'][0], r['outer'][0]
+    assert big['rss_growth'] >= ALLOCATION
+    # The later stage doesn't inherit the peak, the enclosing one keeps it
+    assert small['rss_growth'] < ALLOCATION
+    assert small['peak_rss'] < big['peak_rss']
+    assert outer['peak_rss'] >= big['peak_rss']
+    assert (big['parent'], small['parent'], outer['parent']) == ("outer", "outer", None)
+
+
+def test_process_wide_peak_without_reset(records, monkeypatch):
+    monkeypatch.setattr(metrics, "CLEAR_REFS", "/nonexistent/clear_refs")
+    with metrics.stage("big"):
+        allocate()
+    with metrics.stage("small"):
+        pass
+
+    big, small = records()['big'][0], records()['small'][0]
+    assert "peak_rss" not in small and "rss_growth" not in small
+    # The peak of the process so far, so the later stage still shows it
+    assert small['process_peak_rss'] >= big['process_peak_rss']
+    assert small['process_rss_growth'] == 0
+
+
+def test_prefetched_reads_keep_their_parent(tree, records):
+    merge_timeseries(tree, prefetch_depth=2)
+
+    reads = records()['merge.read']
+    assert reads
+    assert set(r['parent'] for r in reads) == set(["merge.sensor"])
+
+
+def test_disabled_stages_do_nothing():
+    assert not metrics.enabled()
+    with metrics.stage("nothing", parent=metrics.current()) as s:
+        s.add(samples=1)
+        s.set(read="nowhere")
+    assert metrics.current() is s
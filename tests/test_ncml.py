@@ -0,0 +1,64 @@
+#!python
+# coding=utf-8
+
+import os
+import json
+
+import netCDF4
+import numpy as np
+from lxml import etree
+
+from pytools.netcdf.sensors.merge import merge_timeseries
+from pytools.netcdf.sensors.ncml import create_ncml, NCML_NAMESPACE
+
+from conftest import sensor_files
+
+
+def parse(path):
+    return etree.parse(path).getroot()
+
+
+def file_times(path):
+    nc = netCDF4.Dataset(path)
+    try:
+        return nc.variables["time"][:]
+    finally:
+        nc.close()
+
+
+def test_aggregation_coordinates(tree):
+    merge_timeseries(tree)
+    create_ncml(tree, processes=2, list_path=os.path.join(tree, "ncml_files.json"))
+
+    sensors = sensor_files(tree)
+    for variable, (root, files) in sensors.iteritems():
+        ncml = parse(os.path.join(root, "%s.ncml" % os.path.basename(root)))
+        nested = ncml.findall("{%s}aggregation/{%s}netcdf" % (NCML_NAMESPACE, NCML_NAMESPACE))
+
+        # The component files in time order, without the merged file
+        assert [n.get("location") for n in nested] == files
+        for n in nested:
+            times = file_times(os.path.join(root, n.get("location")))
+            assert int(n.get("ncoords")) == times.size
+            np.testing.assert_array_equal(np.array(n.get("coordValue").split(), dtype=np.float64), times)
+
+    with open(os.path.join(tree, "ncml_files.json")) as f:
+        assert json.load(f) == sorted(os.path.join(root, "%s.ncml" % os.path.basename(root)) for root, files in sensors.itervalues())
+
+
+def test_target_file(tree, tmpdir, monkeypatch):
+    merge_timeseries(tree)
+    # The list of NcML files goes to the working directory by default
+    monkeypatch.chdir(str(tmpdir))
+    create_ncml(tree, output_filename="merged.ncml", target_file="merged.nc", max_coord_values=10)
+
+    with open(str(tmpdir.join("ncml_files.json"))) as f:
+        assert len(json.load(f)) == len(sensor_files(tree))
+    for variable, (root, files) in sensor_files(tree).iteritems():
+        ncml = parse(os.path.join(root, "merged.ncml"))
+        assert ncml.get("location") == "merged.nc"
+        assert ncml.find("{%s}aggregation" % NCML_NAMESPACE) is None
+        times = file_times(os.path.join(root, "merged.nc"))
+        attributes = dict((a.get("name"), a.get("value")) for a in ncml.findall("{%s}attribute" % NCML_NAMESPACE))
+        assert attributes["time_coverage_start"] == netCDF4.num2date(times[0], "seconds since 1970-01-01").strftime("%Y-%m-%dT%H:%M:%SZ")
+        assert attributes["time_coverage_end"] == netCDF4.num2date(times[-1], "seconds since 1970-01-01").strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,63 @@
+#!python
+# coding=utf-8
+
+import os
+
+import pytools.netcdf.sensors.pipeline as pipeline_module
+from pytools.netcdf.sensors.crawl import crawl_and_copy
+from pytools.netcdf.sensors.merge import merge_timeseries
+from pytools.netcdf.sensors.ncml import create_ncml
+from pytools.netcdf.sensors.pipeline import run_pipeline
+
+from conftest import sensor_files, read_merged, assert_same
+
+
+def read_text(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_pipeline_matches_crawl_merge_ncml(tree, tmpdir):
+    expected = str(tmpdir.join("expected"))
+    crawl_and_copy([tree], {}, {}, perform_copy=True, output_path=expected)
+    merge_timeseries(expected)
+    create_ncml(expected, target_file="merged.nc", list_path=str(tmpdir.join("ncml_files.json")))
+
+    output = str(tmpdir.join("output"))
+    summary = run_pipeline([tree], {}, {}, output, perform_copy=True, processes=2)
+
+    sensors = sensor_files(expected)
+    assert sorted(s['sensor'].split(":")[-1] for s in summary) == sorted(sensors)
+    for variable, (root, files) in sensors.iteritems():
+        name = os.path.basename(root)
+        directory = os.path.join(output, name)
+        assert sensor_files(output)[variable] == (directory, files)
+        assert_same(read_merged(os.path.join(root, "merged.nc"), variable),
+                     read_merged(os.path.join(directory, "merged.nc"), variable))
+        ncml = "%s.ncml" % name
+        assert read_text(os.path.join(directory, ncml)).replace(output, expected) == read_text(os.path.join(root, ncml))
+
+
+def test_pipeline_flushes_each_sensor(tree, tmpdir, monkeypatch):
+    reads  = []
+    merges = []
+    read_source            = pipeline_module.read_source
+    create_timeseries_file = pipeline_module.create_timeseries_file
+    def counted_read(filepath, *args):
+        reads.append(filepath)
+        return read_source(filepath, *args)
+    def counted_create(output_directory, *args, **kwargs):
+        merges.append((os.path.basename(output_directory), len(reads)))
+        return create_timeseries_file(output_directory, *args, **kwargs)
+    monkeypatch.setattr(pipeline_module, "read_source", counted_read)
+    monkeypatch.setattr(pipeline_module, "create_timeseries_file", counted_create)
+
+    run_pipeline([tree], {}, {}, str(tmpdir.join("output")), ncml=False)
+
+    # Each sensor is merged once its own files are read, before the next
+    # sensor's files are
+    read = 0
+    for name, count in merges:
+        read += len(sensor_files(tree)[name.split(":")[-1]][1])
+        assert count == read
+    assert read == len(reads)
@@ -0,0 +1,75 @@
+#!python
+# coding=utf-8
+
+import pytest
+
+from pytools.netcdf.sensors.crawl import crawl_and_copy, write_jsonl
+from pytools.netcdf.sensors.query import SensorFileIndex, _seconds
+from pytools.netcdf.sensors.synthetic import generate_tree
+
+
+@pytest.fixture
+def crawled(tmpdir):
+    tree = str(tmpdir.join("tree"))
+    generate_tree(tree, stations=4, sensors_per_station=3, files_per_sensor=5, samples_per_file=24, seed=5)
+    return crawl_and_copy([tree], {}, {})
+
+
+def records(out):
+    return [meta for variables in out.itervalues() for metas in variables.itervalues() for meta in metas]
+
+
+def overlapping(metas, sensor, start, end):
+    # Brute force version of SensorFileIndex.files
+    found = [m for m in metas if m['mapped_sensor'] == sensor
+             and (start is None or _seconds(m['end']) >= _seconds(start))
+             and (end is None or _seconds(m['start']) <= _seconds(end))]
+    return sorted(found, key=lambda m: (_seconds(m['start']), m['file']))
+
+
+def test_files_in_time_range(crawled):
+    metas = records(crawled)
+    index = SensorFileIndex.from_crawl(crawled)
+
+    assert index.sensors() == sorted(set(m['mapped_sensor'] for m in metas))
+    assert index.files("urn:ioos:sensor:synthetic:nowhere:air_pressure") == []
+    for sensor in index.sensors():
+        files = sorted(m['start'] for m in metas if m['mapped_sensor'] == sensor)
+        ranges = [(None, None),
+                  (files[1], None),
+                  (None, files[2]),
+                  (files[1], files[3]),
+                  # Inside a single file
+                  (_seconds(files[2]) + 60, _seconds(files[2]) + 120),
+                  # Before and after everything
+                  ("2000-01-01 00:00:00", "2000-01-02 00:00:00"),
+                  ("2030-01-01 00:00:00", None)]
+        for start, end in ranges:
+            assert index.files(sensor, start, end) == overlapping(metas, sensor, start, end)
+
+
+def test_stations_in_box(crawled):
+    metas = records(crawled)
+    index = SensorFileIndex.from_crawl(crawled, cell_size=2.5)
+    locations = dict((m['mapped_station'], (m['lat'], m['lon'])) for m in metas)
+
+    assert index.stations(-90., -180., 90., 180.) == sorted(locations)
+    for station, (lat, lon) in locations.iteritems():
+        assert station in index.stations(lat - 0.01, lon - 0.01, lat + 0.01, lon + 0.01)
+        inside = [s for s, (y, x) in locations.iteritems() if lat - 10 <= y <= lat + 10 and lon - 10 <= x <= lon + 10]
+        assert index.stations(lat - 10, lon - 10, lat + 10, lon + 10) == sorted(inside)
+    # The synthetic stations are all in the western hemisphere
+    assert index.stations(-90., 170., 90., -60.) == sorted(locations)
+    assert index.stations(-90., 170., 90., -170.) == []
+
+
+def test_from_jsonl_matches_from_crawl(crawled, tmpdir):
+    path = str(tmpdir.join("crawl.jsonl"))
+    write_jsonl(iter(records(crawled)), path)
+
+    expected = SensorFileIndex.from_crawl(crawled)
+    index    = SensorFileIndex.from_jsonl(path)
+    assert index.sensors() == expected.sensors()
+    for sensor in index.sensors():
+        assert index.files(sensor) == expected.files(sensor)
+    assert index.stations(-90., -180., 90., 180.) == expected.stations(-90., -180., 90., 180.)
@@ -0,0 +1,74 @@
+#!python
+# coding=utf-8
+
+import os
+
+import netCDF4
+import numpy as np
+
+from pytools.netcdf.sensors.merge import merge_timeseries
+from pytools.netcdf.sensors.station import merge_stations
+
+from conftest import sensor_files, read_merged, assert_same
+
+
+def station_file(tree):
+    stations = [name for name in os.listdir(tree) if name.startswith("urn:ioos:station:")]
+    assert len(stations) == 1
+    return os.path.join(tree, stations[0], "station.nc")
+
+
+def read_station_variable(nc, variable):
+    # (times, heights, values) of one sensor, through its coordinates attribute
+    var = nc.variables[variable]
+    time, height = var.coordinates.split()[:2]
+    assert var.dimensions[0] == time
+    return nc.variables[time][:], np.atleast_1d(nc.variables[height][:]), var[:]
+
+
+def test_station_file_matches_sensor_files(tree):
+    merge_timeseries(tree)
+    merge_stations(tree)
+
+    nc = netCDF4.Dataset(station_file(tree))
+    try:
+        sensors = sensor_files(tree)
+        times = {}
+        for variable, (root, files) in sensors.iteritems():
+            merged = read_merged(os.path.join(root, "merged.nc"), variable)
+            assert_same(merged, read_station_variable(nc, variable))
+            assert nc.variables[nc.variables[variable].instrument].long_name == os.path.basename(root)
+            times.setdefault(nc.variables[variable].dimensions[0], set()).add(merged[0].tobytes())
+
+        # Sensors share a time dimension exactly when they have the same times
+        assert len(times) > 1
+        assert all(len(t) == 1 for t in times.itervalues())
+        assert len(set(t.pop() for t in times.itervalues())) == len(times)
+        assert nc.featureType == "timeSeriesProfile"
+    finally:
+        nc.close()
+
+
+def test_aligned_station_file(tree):
+    merge_timeseries(tree)
+    merge_stations(tree, align=True)
+
+    nc = netCDF4.Dataset(station_file(tree))
+    try:
+        all_times = nc.variables["time"][:]
+        assert [d for d in nc.dimensions if d.startswith("time")] == ["time"]
+        for variable, (root, files) in sensor_files(tree).iteritems():
+            times, heights, values = read_merged(os.path.join(root, "merged.nc"), variable)
+            aligned_times, aligned_heights, aligned = read_station_variable(nc, variable)
+
+            np.testing.assert_array_equal(aligned_times, all_times)
+            assert_same([heights], [aligned_heights])
+            # The sensor's own records are where its times are, the rest is missing
+            rows = np.searchsorted(all_times, times)
+            np.testing.assert_array_equal(all_times[rows], times)
+            assert_same([values], [aligned[rows]])
+            others = np.ones(all_times.size, dtype=bool)
+            others[rows] = False
+            assert np.ma.getmaskarray(aligned[others]).all()
+    finally:
+        nc.close()
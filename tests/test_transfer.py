@@ -0,0 +1,68 @@
+#!python
+# coding=utf-8
+
+import os
+
+import pytest
+
+from pytools.netcdf.sensors.transfer import copy_file, COPY, HARDLINK, REFLINK, AUTO
+
+
+def write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("strategy", [COPY, HARDLINK, REFLINK, AUTO])
+def test_copy_replaces_destination(tmpdir, strategy):
+    src, dst = str(tmpdir.join("src.nc")), str(tmpdir.join("dst.nc"))
+    write(src, b"new")
+    write(dst, b"old content")
+
+    assert copy_file(src, dst, strategy=strategy) in ("hardlinked", "reflinked", "copy_file_range", "copied")
+    assert read(dst) == b"new"
+    assert read(src) == b"new"
+    assert sorted(os.listdir(str(tmpdir))) == ["dst.nc", "src.nc"]
+
+
+@pytest.mark.parametrize("strategy", [COPY, HARDLINK, REFLINK, AUTO])
+def test_copy_onto_itself_keeps_the_file(tmpdir, strategy):
+    src = str(tmpdir.join("src.nc"))
+    write(src, b"data")
+
+    assert copy_file(src, src, strategy=strategy) == "skipped"
+    assert copy_file(src, os.path.join(str(tmpdir), ".", "src.nc"), strategy=strategy) == "skipped"
+    assert read(src) == b"data"
+
+
+def test_copy_onto_a_hardlink_keeps_the_file(tmpdir):
+    src, dst = str(tmpdir.join("src.nc")), str(tmpdir.join("dst.nc"))
+    write(src, b"data")
+    os.link(src, dst)
+
+    assert copy_file(src, dst) == "skipped"
+    assert read(src) == read(dst) == b"data"
+
+
+def test_failed_copy_leaves_destination(tmpdir):
+    src, dst = str(tmpdir.join("missing.nc")), str(tmpdir.join("dst.nc"))
+    write(dst, b"old")
+
+    with pytest.raises((IOError, OSError)):
+        copy_file(src, dst)
+    assert read(dst) == b"old"
+    assert os.listdir(str(tmpdir)) == ["dst.nc"]
+
+
+def test_skip_unchanged(tmpdir):
+    src, dst = str(tmpdir.join("src.nc")), str(tmpdir.join("dst.nc"))
+    write(src, b"data")
+
+    assert copy_file(src, dst, skip_unchanged=True) == "copied"
+    assert copy_file(src, dst, skip_unchanged=True) == "skipped"
+    assert copy_file(src, dst, skip_unchanged=True, checksum=True) == "skipped"